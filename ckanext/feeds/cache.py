@@ -0,0 +1,420 @@
+# encoding: utf-8
+""" Caches used by the feeds """
+
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from ckanext.feeds import compression
+
+
+class LRUCache(object):
+    '''
+    A bounded, thread safe, least recently used cache.
+
+    Entries older than ``ttl`` seconds are treated as missing, so values
+    that are changed by another process go stale for at most ``ttl``.
+    '''
+
+    def __init__(self, max_entries=1000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stored_at = self._entries.pop(key)
+            except KeyError:
+                return default
+            if self._expired(stored_at):
+                return default
+            # re-insert as the most recently used entry
+            self._entries[key] = (value, stored_at)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FeedCache(object):
+    '''
+    Base class of the caches of rendered feeds.
+
+    Entries are grouped in namespaces, e.g. the id of the user who
+    requested the feed, and stored with the entity tag of the feed they
+    were rendered for. ``get`` only returns a body if it was rendered for
+    the current entity tag, so a cache that missed an invalidation never
+    serves an outdated feed.
+    '''
+
+    def __init__(self, max_entries=1000, max_size=50 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # the requests of all the threads of the process count their hits
+        self._counters_lock = threading.Lock()
+
+    def _count(self, hit):
+        with self._counters_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, namespace, key, etag):
+        '''Return the body cached for the entity tag, or None.'''
+        cached = self._get(namespace, key)
+        if cached is not None and cached[0] == etag:
+            self._count(True)
+            return cached[1]
+        self._count(False)
+        return None
+
+    def get_encoded(self, namespace, key, etag, encoding):
+        '''
+        Return the body cached for the entity tag compressed with a content
+        coding, or None.
+
+        The compressed bodies are cached next to the rendered one, under
+        their own key (see encoded_key), so the same feed is compressed
+        once rather than on every request.
+        '''
+        cached = self._get(namespace, encoded_key(key, encoding))
+        if cached is not None and cached[0] == etag:
+            self._count(True)
+            return cached[1]
+        body = self.get(namespace, key, etag)
+        if body is None:
+            return None
+        body = compression.compress(body, encoding)
+        self.set(namespace, encoded_key(key, encoding), etag, body)
+        return body
+
+    def set(self, namespace, key, etag, body):
+        if len(body) > self.max_size:
+            return
+        self._set(namespace, key, etag, body)
+
+    def tee(self, namespace, key, etag, chunks):
+        '''Pass the chunks of a streamed feed through and cache the whole feed at the end.'''
+        parts = []
+        size = 0
+        for chunk in chunks:
+            if parts is not None:
+                size += len(chunk)
+                if size <= self.max_size:
+                    parts.append(chunk)
+                else:
+                    # don't hold on to feeds too big to be cached
+                    parts = None
+            yield chunk
+        if parts is not None:
+            self.set(namespace, key, etag, ''.join(parts))
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': self.entries(),
+            'size': self.size(),
+            'max_entries': self.max_entries,
+            'max_size': self.max_size,
+        }
+
+    def _get(self, namespace, key):
+        raise NotImplementedError
+
+    def _set(self, namespace, key, etag, body):
+        raise NotImplementedError
+
+    def invalidate(self, namespace):
+        '''Drop all the entries of a namespace.'''
+        raise NotImplementedError
+
+    def entries(self):
+        raise NotImplementedError
+
+    def size(self):
+        raise NotImplementedError
+
+
+class NullFeedCache(FeedCache):
+    '''Caches nothing.'''
+
+    backend = 'none'
+
+    def _get(self, namespace, key):
+        return None
+
+    def _set(self, namespace, key, etag, body):
+        pass
+
+    def invalidate(self, namespace):
+        pass
+
+    def entries(self):
+        return 0
+
+    def size(self):
+        return 0
+
+
+class MemoryFeedCache(FeedCache):
+    '''Keeps the rendered feeds in a least recently used dict of this process.'''
+
+    backend = 'memory'
+
+    def __init__(self, **kwargs):
+        super(MemoryFeedCache, self).__init__(**kwargs)
+        self._entries = OrderedDict()
+        self._namespaces = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _get(self, namespace, key):
+        with self._lock:
+            try:
+                value = self._entries.pop((namespace, key))
+            except KeyError:
+                return None
+            self._entries[(namespace, key)] = value
+            return value
+
+    def _remove(self, namespace, key):
+        etag, body = self._entries.pop((namespace, key))
+        self._size -= len(body)
+        keys = self._namespaces.get(namespace)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._namespaces[namespace]
+
+    def _set(self, namespace, key, etag, body):
+        with self._lock:
+            if (namespace, key) in self._entries:
+                self._remove(namespace, key)
+            self._entries[(namespace, key)] = (etag, body)
+            self._namespaces.setdefault(namespace, set()).add(key)
+            self._size += len(body)
+            while len(self._entries) > self.max_entries or self._size > self.max_size:
+                oldest_namespace, oldest_key = next(iter(self._entries))
+                self._remove(oldest_namespace, oldest_key)
+                self.evictions += 1
+
+    def invalidate(self, namespace):
+        with self._lock:
+            for key in list(self._namespaces.get(namespace, ())):
+                self._remove(namespace, key)
+
+    def entries(self):
+        return len(self._entries)
+
+    def size(self):
+        return self._size
+
+
+class FileFeedCache(FeedCache):
+    '''
+    Keeps the rendered feeds in files of a local directory.
+
+    The directory can be shared by all the processes of a server. Every
+    namespace is a sub directory, every entry a file holding the entity tag
+    on its first line followed by the body. Files are replaced atomically
+    and the least recently read ones are removed when the directory grows
+    past its limits.
+    '''
+
+    backend = 'file'
+
+    def __init__(self, directory, **kwargs):
+        super(FileFeedCache, self).__init__(**kwargs)
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._size, self._entries = self._scan()[:2]
+
+    def _namespace_dir(self, namespace):
+        return os.path.join(self.directory, hashlib.sha1(namespace.encode('utf-8')).hexdigest())
+
+    def _path(self, namespace, key):
+        return os.path.join(self._namespace_dir(namespace),
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _get(self, namespace, key):
+        path = self._path(namespace, key)
+        try:
+            with open(path, 'rb') as f:
+                etag = f.readline().rstrip('\n')
+                body = f.read()
+            # the modification time orders the entries for eviction
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return etag, body
+
+    def _set(self, namespace, key, etag, body):
+        namespace_dir = self._namespace_dir(namespace)
+        try:
+            if not os.path.isdir(namespace_dir):
+                os.makedirs(namespace_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=namespace_dir, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(etag + '\n')
+                f.write(body)
+            path = self._path(namespace, key)
+            # the entry replaces the previous one of the key, if any
+            replaced = _file_size(path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            log.warning('Could not cache feed in %s: %s', namespace_dir, e)
+            return
+        with self._lock:
+            # the size of the file, as _scan counts it
+            self._size += len(etag) + 1 + len(body)
+            if replaced is None:
+                self._entries += 1
+            else:
+                self._size -= replaced
+            full = self._entries > self.max_entries or self._size > self.max_size
+        if full:
+            self._evict()
+
+    def _scan(self):
+        '''Return the total size, number and (mtime, size, path) of all the entries.'''
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        return sum(f[1] for f in files), len(files), files
+
+    def _evict(self):
+        # other processes write to the same directory, start from its real state
+        size, entries, files = self._scan()
+        files.sort()
+        evictions = 0
+        for mtime, file_size, path in files:
+            if entries <= self.max_entries and size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= file_size
+            entries -= 1
+            evictions += 1
+        with self._lock:
+            self._size, self._entries = size, entries
+            self.evictions += evictions
+
+    def invalidate(self, namespace):
+        namespace_dir = self._namespace_dir(namespace)
+        size = entries = 0
+        try:
+            filenames = os.listdir(namespace_dir)
+        except OSError:
+            return
+        for filename in filenames:
+            if filename.startswith('.tmp'):
+                continue
+            file_size = _file_size(os.path.join(namespace_dir, filename))
+            if file_size is not None:
+                size += file_size
+                entries += 1
+        shutil.rmtree(namespace_dir, ignore_errors=True)
+        with self._lock:
+            self._size = max(self._size - size, 0)
+            self._entries = max(self._entries - entries, 0)
+
+    def entries(self):
+        return self._entries
+
+    def size(self):
+        return self._size
+
+
+def _file_size(path):
+    '''Return the size of a file, or None if there is no such file.'''
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+FEED_CACHE_BACKENDS = {
+    'none': NullFeedCache,
+    'memory': MemoryFeedCache,
+    'file': FileFeedCache,
+}
+
+
+def make_feed_cache(config):
+    '''Return the rendered feed cache configured with the ckanext.feeds.cache.* options.'''
+    backend = config.get('ckanext.feeds.cache.backend', 'memory')
+    if backend not in FEED_CACHE_BACKENDS:
+        raise ValueError('Unknown feed cache backend: %s' % backend)
+
+    kwargs = {
+        'max_entries': int(config.get('ckanext.feeds.cache.max_entries', 1000)),
+        'max_size': int(config.get('ckanext.feeds.cache.max_size', 50 * 1024 * 1024)),
+    }
+    if backend == 'file':
+        kwargs['directory'] = config.get('ckanext.feeds.cache.directory') or \
+            os.path.join(config.get('cache_dir', tempfile.gettempdir()), 'feeds')
+
+    return FEED_CACHE_BACKENDS[backend](**kwargs)
+
+
+def encoded_key(key, encoding):
+    '''Return the key of a feed compressed with a content coding.'''
+    return u'%s\nencoding=%s' % (key, encoding)
+
+
+def object_namespace(object_id):
+    '''Return the namespace of the shared feeds of a dataset, group or organization.'''
+    return u'object:%s' % object_id
+
+
+# The cache of the rendered feeds, see FeedsPlugin.configure
+feed_cache = NullFeedCache()
@@ -0,0 +1,171 @@
+# encoding: utf-8
+""" Paster commands of the feeds """
+
+import sys
+
+import paste.script.command
+from ckan.lib.cli import CkanCommand
+
+
+class FeedsCommand(CkanCommand):
+    '''Maintains the inboxes of the dashboard feeds and generates the feeds
+
+    Usage:
+
+      feeds inbox backfill [USER]
+        - Add the activities missing from the inbox of a user, or of all
+          the users
+
+      feeds inbox rebuild [USER]
+        - Empty the inbox of a user, or of all the users, and fill it again
+
+      feeds inbox check [USER]
+        - Compare the inbox of a user, or of all the users, with the
+          dashboard as queried without the inbox. Exits with status 1 if
+          they differ.
+
+      feeds generate users|objects
+        - Write the atom, rss and json dashboard feeds of all the users,
+          or the feeds of all the datasets, groups and organizations, to
+          files that a web server can serve: DIRECTORY/dashboard/<user
+          id>.atom, DIRECTORY/dataset/<name>.rss, ... The dashboards need
+          a DIRECTORY of their own, that is not served without the login
+          of their user.
+
+    USER is the name or id of a user. backfill and rebuild take the
+    -l/--limit option, the number of the newest activities of every
+    dashboard to add (default: all of them); check takes it as the number
+    of the newest activities to compare (default: 100).
+
+    generate takes the -l/--limit option as the number of activities of
+    every feed (default: ckan.activity_list_limit), and the options:
+
+      -d/--directory DIRECTORY  where to write the feeds (required)
+      -p/--processes N          the number of worker processes (default: 1)
+      -z/--gzip                 also write gzip-compressed copies (.gz)
+      -i/--incremental          only write the feeds with activities newer
+                                than the ones of the last run
+
+    The feeds of deleted and private objects are removed.
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 3
+    min_args = 2
+
+    parser = paste.script.command.Command.standard_parser(verbose=True)
+    parser.add_option('-c', '--config', dest='config',
+                      default='development.ini', help='Config file to use.')
+    parser.add_option('-l', '--limit', dest='limit', type='int', default=None,
+                      help='The number of activities of every dashboard')
+    parser.add_option('-d', '--directory', dest='directory', default=None,
+                      help='The directory of the generated feeds')
+    parser.add_option('-p', '--processes', dest='processes', type='int', default=1,
+                      help='The number of processes generating the feeds')
+    parser.add_option('-z', '--gzip', dest='gzip', action='store_true', default=False,
+                      help='Also write gzip-compressed feeds')
+    parser.add_option('-i', '--incremental', dest='incremental', action='store_true', default=False,
+                      help='Only generate the feeds with new activities since the last run')
+
+    def command(self):
+        self._load_config()
+
+        if self.args[0] == 'generate':
+            return self.generate()
+        if self.args[0] != 'inbox':
+            self.parser.error('Unknown command: %s' % self.args[0])
+
+        action = self.args[1]
+        if action not in ('backfill', 'rebuild', 'check'):
+            self.parser.error('Unknown inbox command: %s' % action)
+
+        import ckan.model as model
+        from ckanext.feeds import inbox
+
+        inbox.setup()
+
+        if len(self.args) > 2:
+            user = model.User.get(self.args[2])
+            if user is None:
+                print('User not found: %s' % self.args[2])
+                sys.exit(1)
+            user_ids = [user.id]
+        else:
+            user_ids = [user_id for (user_id,) in
+                        model.Session.query(model.User.id).filter(model.User.state == 'active')]
+
+        getattr(self, action)(model.Session, user_ids)
+
+    def backfill(self, session, user_ids, clear=False):
+        from sqlalchemy.exc import IntegrityError
+        from ckanext.feeds import inbox, query
+
+        total = 0
+        for user_id in user_ids:
+            if clear:
+                inbox.clear(session, user_id)
+            try:
+                added = query.backfill_inbox(session, user_id, self.options.limit)
+                session.commit()
+            except IntegrityError:
+                # a new activity was added to the inbox in the meantime, add the others
+                session.rollback()
+                if clear:
+                    inbox.clear(session, user_id)
+                added = query.backfill_inbox(session, user_id, self.options.limit)
+                session.commit()
+            total += added
+            if self.verbose:
+                print('%s: %d activities added' % (user_id, added))
+        print('%d activities added to %d inboxes' % (total, len(user_ids)))
+
+    def rebuild(self, session, user_ids):
+        self.backfill(session, user_ids, clear=True)
+
+    def check(self, session, user_ids):
+        from ckanext.feeds import query
+
+        inconsistent = 0
+        for user_id in user_ids:
+            missing, extra = query.check_inbox(session, user_id, self.options.limit or 100)
+            if missing or extra:
+                inconsistent += 1
+                print('%s: %d activities missing, %d extra' % (user_id, len(missing), len(extra)))
+                for activity_id in sorted(missing):
+                    print('  missing %s' % activity_id)
+                for activity_id in sorted(extra):
+                    print('  extra %s' % activity_id)
+        print('%d of %d inboxes differ from the dashboards' % (inconsistent, len(user_ids)))
+        if inconsistent:
+            sys.exit(1)
+
+    def generate(self):
+        from pylons import config
+        from ckanext.feeds import generate
+
+        kind = self.args[1]
+        if kind not in generate.KINDS:
+            self.parser.error('Unknown kind of feeds: %s' % kind)
+        if not self.options.directory:
+            self.parser.error('The feeds need a directory: -d/--directory')
+        if self.options.processes < 1:
+            self.parser.error('Invalid number of processes: %d' % self.options.processes)
+        others = [other for other in generate.generated_kinds(self.options.directory)
+                  if other != kind]
+        if others:
+            self.parser.error('The feeds of the %s are already generated in %s: the '
+                              'dashboards and the public feeds need different directories'
+                              % (others[0], self.options.directory))
+
+        options = {
+            'directory': self.options.directory,
+            'compress': self.options.gzip,
+            'limit': self.options.limit or int(config.get('ckan.activity_list_limit', 31)),
+            'site_url': config.get('ckan.site_url', '').rstrip('/'),
+        }
+        results = generate.generate(kind, options, self.options.processes, self.options.incremental)
+        print('Feeds of %d %s: %d written, %d removed, %d failed' % (
+            sum(results.values()), kind, results['written'], results['removed'], results['failed']))
+        if results['failed']:
+            sys.exit(1)
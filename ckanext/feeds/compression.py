@@ -0,0 +1,77 @@
+# encoding: utf-8
+""" Compression of the feed responses (gzip and deflate content codings) """
+
+import zlib
+
+
+# the content codings of the feeds, by order of preference
+ENCODINGS = ['gzip', 'deflate']
+
+# the zlib window bits of the content codings: gzip has a gzip header (with
+# no file name and a zero modification time), the deflate content coding is
+# the zlib format
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+# Whether the feeds are sent compressed to the clients that accept it, and
+# the zlib compression level, see FeedsPlugin.configure
+enabled = True
+level = 6
+
+
+def accepted_encoding(accept_encoding):
+    '''Return the content coding the client prefers of the ones of the feeds
+
+    :param accept_encoding: the value of the Accept-Encoding header
+
+    :returns: 'gzip', 'deflate' or None to send the feed uncompressed
+    '''
+    qualities = {}
+    for part in (accept_encoding or '').split(','):
+        coding, _sep, params = part.partition(';')
+        coding = coding.strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _sep, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _compressor(encoding):
+    return zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+
+
+def compress(body, encoding):
+    '''Return a body compressed with a content coding.'''
+    compressor = _compressor(encoding)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compress_chunks(chunks, encoding):
+    '''
+    Compress a streamed body with a content coding. Every chunk is
+    flushed, so the client can read the feed as it is written.
+    '''
+    compressor = _compressor(encoding)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
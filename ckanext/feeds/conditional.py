@@ -0,0 +1,108 @@
+# encoding: utf-8
+""" Conditional GET (ETag / Last-Modified) support for the feeds """
+
+import time
+import hashlib
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+
+def feed_etag(latest, user_id, params):
+    '''Return the entity tag of a feed
+
+    :param latest: the newest activity of the feed, as returned by
+        ckanext.feeds.query.latest_activity
+    :param user_id: the id of the user viewing the feed
+    :type user_id: string
+    :param params: the request parameters the feed depends on, and e.g.
+        the follows of the user for a dashboard
+    :type params: dict
+
+    :rtype: quoted entity tag
+
+    The id of the newest activity is appended to the tag, so that a client
+    sending it back with ``A-IM: feed`` can be sent the newer activities
+    only (RFC 3229), see etag_activity_id.
+    '''
+    parts = [user_id]
+    if latest is not None:
+        parts.extend([latest.id, latest.timestamp.isoformat()])
+    parts.append(params_key(params))
+    digest = hashlib.sha1(u'\n'.join(parts).encode('utf-8')).hexdigest()
+    if latest is None:
+        return '"%s"' % digest
+    return '"%s.%s"' % (digest, latest.id)
+
+
+def etag_activity_id(if_none_match):
+    '''Return the id of the newest activity of the first feed entity tag of a If-None-Match header.'''
+    for candidate in (if_none_match or '').split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        digest, _sep, activity_id = candidate.strip('"').partition('.')
+        if activity_id:
+            return activity_id
+    return None
+
+
+def accepts_feed_delta(headers):
+    '''Return True if the client accepts the feed instance manipulation of RFC 3229.'''
+    a_im = headers.get('A-IM', '')
+    return 'feed' in [im.split(';')[0].strip() for im in a_im.split(',')]
+
+
+def params_key(params):
+    '''Return the request parameters a feed depends on as a string.'''
+    return u'&'.join(u'%s=%s' % (key, params[key]) for key in sorted(params))
+
+
+def timestamp_seconds(timestamp):
+    '''Return an activity timestamp (naive, server local time) as seconds since the epoch.'''
+    return int(time.mktime(timestamp.timetuple()))
+
+
+def http_date(timestamp):
+    '''Return an activity timestamp formatted for the Last-Modified header.'''
+    return formatdate(timestamp_seconds(timestamp), usegmt=True)
+
+
+def etag_matches(etag, if_none_match):
+    '''Return True if the entity tag is in the value of a If-None-Match header.'''
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        # weak comparison
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def not_modified_since(timestamp, if_modified_since):
+    '''Return True if nothing happened after the date of a If-Modified-Since header.'''
+    if not if_modified_since or timestamp is None:
+        return False
+    parsed = parsedate_tz(if_modified_since)
+    if parsed is None:
+        return False
+    return timestamp_seconds(timestamp) <= mktime_tz(parsed)
+
+
+def is_not_modified(headers, etag, timestamp):
+    '''Return True if the client already has the current version of a feed
+
+    If-None-Match takes precedence over If-Modified-Since as in RFC 7232.
+
+    :param headers: the request headers
+    :param etag: the current entity tag of the feed
+    :param timestamp: the timestamp of the newest activity of the feed,
+        or None if it is empty
+    '''
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match:
+        return etag_matches(etag, if_none_match)
+    return not_modified_since(timestamp, headers.get('If-Modified-Since'))
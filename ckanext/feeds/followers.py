@@ -0,0 +1,113 @@
+# encoding: utf-8
+""" Who sees which activity on their dashboard """
+
+from sqlalchemy import select, and_, or_
+from pylons import config
+
+from ckan.model.follower import user_following_user_table, \
+    user_following_dataset_table, user_following_group_table
+from ckan.model.group import member_table
+from ckan.model.package import package_table
+from ckan.model.user import user_table
+
+
+def dataset_groups(connection, object_ids):
+    '''Return the groups and organizations of the public datasets among the objects
+
+    :param connection: database connection
+    :param object_ids: the ids of datasets or other objects
+    :type object_ids: iterable of strings
+
+    :rtype: dict mapping dataset ids to sets of group ids
+    '''
+    groups = {}
+    rows = connection.execute(
+        select([member_table.c.table_id, member_table.c.group_id]).where(and_(
+            member_table.c.table_id.in_(object_ids),
+            member_table.c.table_name == 'package',
+            member_table.c.state == 'active',
+            package_table.c.id == member_table.c.table_id,
+            package_table.c.private == False,
+            package_table.c.state == 'active',
+        ))
+    )
+    for table_id, group_id in rows:
+        groups.setdefault(table_id, set()).add(group_id)
+    return groups
+
+
+def hidden_users(connection):
+    '''Return the ids of the users whose activities the streams hide
+
+    Like ckan.logic.action.get._activity_stream_get_filtered_users, the
+    users of ckan.hide_activity_from_users, or the site user, but with a
+    connection: the session can't be used after a commit.
+
+    :rtype: set of user ids
+    '''
+    names = config.get('ckan.hide_activity_from_users', '').split() \
+        or [config.get('ckan.site_id')]
+    rows = connection.execute(select([user_table.c.id]).where(or_(
+        user_table.c.name.in_(names),
+        user_table.c.id.in_(names),
+    )))
+    return set(row[0] for row in rows)
+
+
+def activity_recipients(connection, activities, groups=None):
+    '''Return the users whose dashboards show each of the given activities
+
+    This follows the rules of ckan.model.activity.dashboard_activity_list:
+    a dashboard shows the activities of and about the user, and the
+    activities of the users, datasets and groups the user follows,
+    including the activities of the public datasets of the followed groups.
+    The activities of the hidden users are on no dashboard, see
+    hidden_users.
+
+    :param connection: database connection
+    :param activities: the new activities
+    :type activities: list of (id, user_id, object_id, activity_type, ...)
+        tuples
+    :param groups: the groups of the datasets of the activities, if the
+        caller already has them, see dataset_groups
+    :type groups: dict
+
+    :rtype: dict mapping every activity id to a set of user ids
+    '''
+
+    if not activities:
+        return {}
+
+    hidden = hidden_users(connection)
+    recipients = dict((a[0], set()) for a in activities if a[1] in hidden)
+    activities = [a for a in activities if a[1] not in hidden]
+    if not activities:
+        return recipients
+
+    object_ids = set(a[2] for a in activities)
+    if groups is None:
+        groups = dataset_groups(connection, object_ids)
+
+    followees = object_ids | set(a[1] for a in activities)
+    for group_ids in groups.values():
+        followees |= group_ids
+
+    followers = {}
+    for table in (user_following_user_table, user_following_dataset_table, user_following_group_table):
+        rows = connection.execute(
+            select([table.c.object_id, table.c.follower_id])
+            .where(table.c.object_id.in_(followees))
+        )
+        for object_id, follower_id in rows:
+            followers.setdefault(object_id, set()).add(follower_id)
+
+    for activity in activities:
+        activity_id, user_id, object_id, activity_type = activity[:4]
+        user_ids = set([user_id])
+        if activity_type.endswith(' user'):
+            user_ids.add(object_id)
+        for followee in [user_id, object_id] + list(groups.get(object_id, ())):
+            user_ids |= followers.get(followee, set())
+        recipients[activity_id] = user_ids
+
+    return recipients
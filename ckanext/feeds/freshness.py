@@ -0,0 +1,91 @@
+# encoding: utf-8
+""" Adaptive freshness of the feeds: how long readers can wait before polling them again """
+
+import time
+
+from ckanext.feeds.cache import LRUCache
+from ckanext.feeds.conditional import timestamp_seconds
+
+
+# Whether the feeds advertise a ttl adapted to their activity, and its
+# bounds in seconds, see FeedsPlugin.configure
+enabled = False
+min_ttl = 60
+max_ttl = 3600
+
+# The share of the age of its newest activity a feed whose rate is unknown
+# stays fresh, like the heuristic freshness of HTTP caches (RFC 7234 4.2.2)
+HEURISTIC_FRACTION = 0.1
+
+
+class ActivityRates(object):
+    '''
+    Running estimates of the interval between the new activities of the
+    feeds, by feed cache namespace
+
+    Every namespace keeps the time of its last new activity and an
+    exponentially weighted moving average of the intervals, for the
+    ``max_entries`` most recently active namespaces of the process.
+    '''
+
+    def __init__(self, max_entries=10000, weight=0.3):
+        self.weight = weight
+        # namespace -> (time of the last activity, mean interval or None)
+        self._entries = LRUCache(max_entries=max_entries)
+
+    def observe(self, namespaces, when=None):
+        '''Record new activities in the feeds of the namespaces.'''
+        if when is None:
+            when = time.time()
+        for namespace in namespaces:
+            entry = self._entries.get(namespace)
+            if entry is None:
+                self._entries.set(namespace, (when, None))
+                continue
+            last, mean = entry
+            interval = max(when - last, 0)
+            if mean is not None:
+                interval = mean + self.weight * (interval - mean)
+            self._entries.set(namespace, (when, interval))
+
+    def interval(self, namespace, now=None):
+        '''
+        Return the expected number of seconds between the new activities
+        of the feeds of a namespace, or None if it is unknown.
+        '''
+        entry = self._entries.get(namespace)
+        if entry is None or entry[1] is None:
+            return None
+        if now is None:
+            now = time.time()
+        last, mean = entry
+        # a feed quiet for longer than usual is slowing down
+        return max(mean, now - last)
+
+
+# The estimates of the process, see FeedsPlugin.configure
+activity_rates = ActivityRates()
+
+
+def feed_ttl(namespace, latest, now=None):
+    '''Return the number of seconds a feed is expected to stay the same
+
+    :param namespace: the feed cache namespace of the feed
+    :param latest: the cursor of the newest activity of the feed, or None
+
+    :returns: seconds, between min_ttl and max_ttl
+    '''
+    if now is None:
+        now = time.time()
+    interval = activity_rates.interval(namespace, now)
+    if interval is None:
+        if latest is None:
+            interval = max_ttl
+        else:
+            interval = (now - timestamp_seconds(latest.timestamp)) * HEURISTIC_FRACTION
+    return int(min(max(interval, min_ttl), max_ttl))
+
+
+def cache_control(ttl, shared):
+    '''Return the Cache-Control header of a feed, shared by all the users or not.'''
+    return '%s, max-age=%d' % ('public' if shared else 'private', ttl)
@@ -0,0 +1,262 @@
+# encoding: utf-8
+""" Generation of the feeds ahead of time, see ckanext.feeds.commands """
+
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import errno
+import tempfile
+import multiprocessing
+
+import ckan.model as model
+
+from ckanext.feeds import compression, query, writers
+from ckanext.feeds.followers import activity_recipients, dataset_groups
+
+
+# the files of every feed: <directory>/dashboard/<user id>.atom, .rss, .json
+# and <directory>/<dataset|group|organization>/<name>.atom, .rss, .json; the
+# dashboards need the login of their user, their directory must not be the
+# public one of the objects
+FORMATS = list(writers.WRITERS)
+
+FEED_VERSION = '2.01'
+
+# the feeds of all the users, or of all the datasets, groups and organizations
+KINDS = ['users', 'objects']
+
+# the cursor of the newest activity of the last run of a kind, for --incremental
+STATE_FILE = '.%s.generated'
+
+# the options of the worker processes, see init_worker
+_options = None
+
+
+def write_file(path, body, compress=False):
+    '''Replace a file atomically: readers see either the old or the new file
+
+    With ``compress``, a gzip-compressed copy is written next to it, as
+    path + '.gz', for the web servers that serve precompressed files.
+    '''
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        # another worker created it
+        if e.errno != errno.EEXIST:
+            raise
+
+    files = [(path, body)]
+    if compress:
+        files.append((path + '.gz', compression.compress(body, 'gzip')))
+
+    for target, data in files:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # mkstemp creates files only their owner can read
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, target)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+
+def remove_files(path):
+    '''Remove the files of a feed, if they exist.'''
+    for target in (path, path + '.gz'):
+        try:
+            os.remove(target)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def feed_path(directory, feed_type, name, format):
+    return os.path.join(directory, feed_type, '%s.%s' % (name, format))
+
+
+def newest_cursor(session):
+    '''Return the Cursor of the newest activity, or None.'''
+    row = session.query(model.Activity.timestamp, model.Activity.id) \
+        .order_by(*query.cursor_order(model.Activity.timestamp, model.Activity.id)) \
+        .first()
+    return row and query.Cursor(row.timestamp, row.id)
+
+
+def read_state(directory, kind):
+    '''Return the newest activity of the last run of a kind, or None.'''
+    try:
+        with open(os.path.join(directory, STATE_FILE % kind)) as f:
+            return query.parse_cursor(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def generated_kinds(directory):
+    '''Return the kinds of feeds already generated in a directory.'''
+    return [kind for kind in KINDS
+            if os.path.exists(os.path.join(directory, STATE_FILE % kind))]
+
+
+def write_state(directory, kind, cursor):
+    if cursor is not None:
+        write_file(os.path.join(directory, STATE_FILE % kind),
+                   (u'%s,%s' % (cursor.timestamp.isoformat(), cursor.id)).encode('utf-8'))
+
+
+def _new_activities(session, since):
+    return session.query(model.Activity.id, model.Activity.user_id,
+                         model.Activity.object_id, model.Activity.activity_type) \
+        .filter(query.after_cursor(since)).all()
+
+
+def user_jobs(session, since=None):
+    '''Return the dashboard feeds to generate
+
+    :param since: only the dashboards that show an activity newer than
+        this cursor, all of them if None
+    :type since: Cursor
+
+    :rtype: list of ('dashboard', user id, user name, True) tuples
+    '''
+    q = session.query(model.User.id, model.User.name).filter(model.User.state == 'active')
+    if since is not None:
+        activities = _new_activities(session, since)
+        if not activities:
+            return []
+        recipients = activity_recipients(session.connection(), activities)
+        user_ids = set().union(*recipients.values())
+        if not user_ids:
+            return []
+        q = q.filter(model.User.id.in_(user_ids))
+    return [('dashboard', user_id, name, True) for user_id, name in q]
+
+
+def object_jobs(session, since=None):
+    '''Return the dataset, group and organization feeds to generate
+
+    :param since: only the objects with an activity newer than this
+        cursor, and the groups of their datasets, all of them if None
+    :type since: Cursor
+
+    :rtype: list of (filter type, object id, name, active) tuples
+    '''
+    packages = session.query(model.Package.id, model.Package.name, model.Package.state)
+    groups = session.query(model.Group.id, model.Group.name, model.Group.state,
+                           model.Group.is_organization)
+    if since is not None:
+        activities = _new_activities(session, since)
+        if not activities:
+            return []
+        object_ids = set(activity[2] for activity in activities)
+        object_ids.update(*dataset_groups(session.connection(), object_ids).values())
+        packages = packages.filter(model.Package.id.in_(object_ids))
+        groups = groups.filter(model.Group.id.in_(object_ids))
+
+    jobs = [('dataset', package_id, name, state == 'active')
+            for package_id, name, state in packages]
+    jobs.extend(('organization' if is_organization else 'group', group_id, name, state == 'active')
+                for group_id, name, state, is_organization in groups)
+    return jobs
+
+
+def init_worker(options):
+    '''Set up a worker process
+
+    The workers are forked from the command, each one opens connections
+    of its own rather than sharing the ones of its parent.
+
+    :param options: directory, compress, limit and site_url
+    :type options: dict
+    '''
+    global _options
+    _options = options
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+
+def render_job(job):
+    '''Render the feeds of a job of user_jobs or object_jobs
+
+    The feeds of the deleted objects and of the ones the anonymous users
+    can't see are removed.
+
+    :returns: the job and 'written', 'removed' or 'failed'
+    '''
+    from ckanext.feeds.plugin import DashboardFeedController
+
+    filter_type, object_id, name, active = job
+    controller = DashboardFeedController()
+    context = {'model': model, 'session': model.Session, 'for_view': True,
+               'site_url': _options['site_url']}
+    try:
+        if filter_type == 'dashboard':
+            context['user'] = name
+            sources, name, route, channel = [(u'', u'')], object_id, None, None
+        else:
+            context['user'] = ''
+            sources = [(filter_type, object_id)]
+            route = ('object_feed', {'filter_type': filter_type, 'id': name})
+            if not (active and query.public_object(filter_type, object_id)):
+                for format in FORMATS:
+                    remove_files(feed_path(_options['directory'], filter_type, name, format))
+                return job, 'removed'
+            channel = controller.object_channel(filter_type, object_id)
+
+        for format in FORMATS:
+            page_url = route and controller._page_url(format, FEED_VERSION, route=route)
+            body = ''.join(controller.stream_feed(context, format, FEED_VERSION, sources,
+                                                  0, _options['limit'], page_url=page_url,
+                                                  channel=channel))
+            write_file(feed_path(_options['directory'], filter_type, name, format),
+                       body, _options['compress'])
+    except Exception:
+        log.exception('Could not generate the feeds of %s %s', filter_type, name)
+        return job, 'failed'
+    finally:
+        model.Session.remove()
+    return job, 'written'
+
+
+def generate(kind, options, processes=1, incremental=False):
+    '''Render the feeds of all the users, or of all the objects, to files
+
+    :param kind: 'users' or 'objects'
+    :param options: see init_worker
+    :param processes: the number of worker processes
+    :param incremental: only render the feeds with activities newer than
+        the ones of the last run of the same kind
+
+    :returns: the number of feeds written, removed and failed
+    :rtype: dict
+    '''
+    session = model.Session
+    since = read_state(options['directory'], kind) if incremental else None
+    newest = newest_cursor(session)
+    jobs = (user_jobs if kind == 'users' else object_jobs)(session, since)
+    log.info('Generating the feeds of %d %s', len(jobs), kind)
+
+    results = {'written': 0, 'removed': 0, 'failed': 0}
+    if processes > 1:
+        # the forked workers must not share the connections of this process
+        session.remove()
+        model.meta.engine.dispose()
+        pool = multiprocessing.Pool(processes, init_worker, (options,))
+        try:
+            for job, result in pool.imap_unordered(render_job, jobs, chunksize=16):
+                results[result] += 1
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        init_worker(options)
+        for job in jobs:
+            results[render_job(job)[1]] += 1
+
+    if not results['failed']:
+        # the next incremental run starts from here
+        write_state(options['directory'], kind, newest)
+    return results
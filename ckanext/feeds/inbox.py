@@ -0,0 +1,86 @@
+# encoding: utf-8
+""" Materialized dashboards: the activities of every user's dashboard """
+
+import logging
+log = logging.getLogger(__name__)
+
+from sqlalchemy import Table, Column, UnicodeText, DateTime, select, literal, exists, and_
+from sqlalchemy.exc import IntegrityError
+
+import ckan.model as model
+from ckan.model.user import user_table
+
+
+# One row per activity on the dashboard of a user. The primary key is the
+# index the dashboard feeds are read with, newest first.
+inbox_table = Table(
+    'feeds_inbox', model.meta.metadata,
+    Column('user_id', UnicodeText, primary_key=True),
+    Column('timestamp', DateTime, primary_key=True),
+    Column('activity_id', UnicodeText, primary_key=True),
+)
+
+# Whether the dashboard feeds are read from the inbox, see FeedsPlugin.configure
+enabled = False
+
+
+def setup():
+    '''Create the inbox table if it does not exist yet.'''
+    inbox_table.create(model.meta.engine, checkfirst=True)
+
+
+def fan_out(connection, activities, recipients):
+    '''Add new activities to the inboxes of the users who see them
+
+    :param connection: database connection
+    :param activities: the new activities
+    :type activities: list of (id, user_id, object_id, activity_type,
+        timestamp) tuples
+    :param recipients: the users of every activity, see activity_recipients
+    :type recipients: dict mapping activity ids to sets of user ids
+
+    Only the rows missing from the inboxes are added, so a backfill
+    running at the same time doesn't make the other users miss an
+    activity.
+
+    :returns: the number of rows added
+    '''
+    added = 0
+    for activity in activities:
+        user_ids = recipients.get(activity[0])
+        if not user_ids:
+            continue
+        for attempt in range(2):
+            trans = connection.begin()
+            try:
+                added += connection.execute(_insert_missing(activity[0], activity[4], user_ids)) \
+                    .rowcount
+                trans.commit()
+                break
+            except IntegrityError:
+                # a backfill added some of the rows in the meantime, add the others
+                trans.rollback()
+        else:
+            log.warning('Could not add activity %s to the inboxes', activity[0])
+    return added
+
+
+def _insert_missing(activity_id, timestamp, user_ids):
+    table = inbox_table
+    missing = select([user_table.c.id, literal(timestamp, DateTime), literal(activity_id)]).where(and_(
+        user_table.c.id.in_(user_ids),
+        ~exists().where(and_(table.c.user_id == user_table.c.id,
+                             table.c.activity_id == activity_id)),
+    ))
+    return table.insert().from_select(['user_id', 'timestamp', 'activity_id'], missing)
+
+
+def clear(connection, user_id=None):
+    '''Empty the inbox of a user, or of all the users.
+
+    :param connection: database connection or session
+    '''
+    delete = inbox_table.delete()
+    if user_id is not None:
+        delete = delete.where(inbox_table.c.user_id == user_id)
+    return connection.execute(delete).rowcount
@@ -0,0 +1,132 @@
+# encoding: utf-8
+""" Batch loaders for the data needed to render a feed """
+
+import logging
+log = logging.getLogger(__name__)
+
+import ckan.model as model
+import ckan.lib.helpers as h
+from ckan.lib.dictization import model_dictize
+
+from ckanext.feeds.cache import LRUCache
+
+
+def activity_details_by_activity_id(context, activity_ids):
+    '''Return the details of several activities, keyed by activity id
+
+    This does the work of one ``activity_detail_list`` call per activity
+    with a single query for the whole page.
+
+    :param context: context dictionary
+    :type context: dict
+    :param activity_ids: the ids of the activities to load the details for
+    :type activity_ids: iterable of strings
+
+    :rtype: dict mapping each activity id to its list of detail dictionaries
+    '''
+
+    details = dict((activity_id, []) for activity_id in activity_ids)
+    if not details:
+        return details
+
+    session = context.get('session', model.Session)
+    q = session.query(model.ActivityDetail) \
+        .filter(model.ActivityDetail.activity_id.in_(details.keys()))
+
+    for activity_detail in q:
+        details[activity_detail.activity_id].append(activity_detail)
+
+    return dict(
+        (activity_id, model_dictize.activity_detail_list_dictize(objects, context))
+        for activity_id, objects in details.iteritems()
+    )
+
+
+# Display names of users, groups and organizations shared by all the feeds
+# rendered in this process, see FeedsPlugin.configure and FeedsPlugin.before_flush
+name_cache = LRUCache(max_entries=10000, ttl=300)
+
+
+def user_activity(activity):
+    '''Return True if the object of the activity is a user.'''
+    return activity['activity_type'].endswith(' user')
+
+
+def group_activity(activity):
+    '''Return True if the object of the activity is a group or an organization.'''
+    return activity['activity_type'].endswith((' group', ' organization'))
+
+
+class NameResolver(object):
+    '''
+    Resolves the names of the users and groups an activity stream refers to
+
+    ``prefetch`` loads all the names of a page of activities with one query
+    per object type and keeps them in the shared ``name_cache``.
+    '''
+
+    def __init__(self, context):
+        self.context = context
+
+    def prefetch(self, activity_stream):
+        user_ids = set()
+        group_ids = set()
+        for activity in activity_stream:
+            user_ids.add(activity['user_id'])
+            if user_activity(activity):
+                user_ids.add(activity['object_id'])
+            elif group_activity(activity):
+                group_ids.add(activity['object_id'])
+
+        self._load_users(user_ids)
+        self._load_groups(group_ids)
+
+    def _missing(self, object_type, ids):
+        return [i for i in ids if i and ('%s:%s' % (object_type, i)) not in name_cache]
+
+    def _load_users(self, user_ids):
+        user_ids = self._missing('user', user_ids)
+        if not user_ids:
+            return
+        session = self.context.get('session', model.Session)
+        q = session.query(model.User.id, model.User.name) \
+            .filter(model.User.id.in_(user_ids))
+        for user_id, name in q:
+            name_cache.set('user:%s' % user_id, name)
+
+    def _load_groups(self, group_ids):
+        group_ids = self._missing('group', group_ids)
+        if not group_ids:
+            return
+        session = self.context.get('session', model.Session)
+        q = session.query(model.Group.id, model.Group.name, model.Group.title) \
+            .filter(model.Group.id.in_(group_ids))
+        for group_id, name, title in q:
+            # same as h.dataset_display_name
+            name_cache.set('group:%s' % group_id, title or name)
+
+    def user_name(self, user_id):
+        '''Return the name of a user, or its id if there is no such user.'''
+        key = 'user:%s' % user_id
+        if key not in name_cache:
+            self._load_users([user_id])
+        return name_cache.get(key, user_id)
+
+    def group_display_name(self, group_dict):
+        '''
+        Return the display name of a group or organization.
+
+        Falls back to the snapshot in the activity data if the group does
+        not exist anymore.
+        '''
+        key = 'group:%s' % group_dict.get('id')
+        if key not in name_cache:
+            self._load_groups([group_dict.get('id')])
+        return name_cache.get(key) or h.dataset_display_name(group_dict)
+
+
+def name_resolver(context):
+    '''Return the name resolver of the feed being rendered with the context.'''
+    if 'name_resolver' not in context:
+        context['name_resolver'] = NameResolver(context)
+    return context['name_resolver']
@@ -0,0 +1,44 @@
+# encoding: utf-8
+""" Action and auth functions of the feeds extension """
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.feeds import cache, timing
+
+
+@tk.side_effect_free
+def feeds_cache_stats(context, data_dict):
+    '''Return the counters of the rendered feed cache
+
+    The counters are those of the process that handles the request.
+
+    :rtype: dictionary with the backend, the hits, misses and evictions,
+        the number of entries and their size in bytes
+    '''
+    tk.check_access('feeds_cache_stats', context, data_dict)
+    return cache.feed_cache.stats()
+
+
+def feeds_cache_stats_auth(context, data_dict):
+    # only sysadmins
+    return {'success': False}
+
+
+@tk.side_effect_free
+def feeds_timing_stats(context, data_dict):
+    '''Return the timings of the stages of the feed requests
+
+    The timings are those of the last requests of the process that handles
+    the request, if ckanext.feeds.timing is enabled.
+
+    :rtype: dictionary with the number of requests, and the count, mean,
+        p50, p90, p99 and max of the duration of every stage in
+        milliseconds and of every counter (e.g. the SQL queries)
+    '''
+    tk.check_access('feeds_timing_stats', context, data_dict)
+    return timing.stats.stats()
+
+
+def feeds_timing_stats_auth(context, data_dict):
+    # only sysadmins
+    return {'success': False}
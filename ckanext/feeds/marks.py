@@ -0,0 +1,72 @@
+# encoding: utf-8
+""" Deferred marking of the dashboard activities as old """
+
+import logging
+log = logging.getLogger(__name__)
+
+import time
+import threading
+from datetime import datetime
+
+from sqlalchemy import or_
+
+import ckan.model as model
+
+
+class DeferredMarks(object):
+    '''
+    Coalesces the dashboard_mark_activities_old calls of the feed requests
+
+    Every feed request only records when the user viewed the feed. At most
+    every ``interval`` seconds, the next feed request stores the latest
+    view of every recorded user in one batch, with one commit.
+    '''
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self._pending = {}
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, user_id, viewed=None):
+        '''Record that the user viewed their dashboard feed.'''
+        with self._lock:
+            self._pending[user_id] = viewed or datetime.now()
+
+    def due(self):
+        return bool(self._pending) and time.time() - self._last_flush >= self.interval
+
+    def flush(self, session):
+        '''Mark the activities of all the recorded users as old.
+
+        :returns: the number of users whose dashboards were updated
+        '''
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+
+        if not pending:
+            return 0
+
+        last_viewed = model.Dashboard.activity_stream_last_viewed
+        for user_id, viewed in pending.iteritems():
+            # never move the last view back, e.g. when the user opened the
+            # html dashboard since
+            updated = session.query(model.Dashboard) \
+                .filter(model.Dashboard.user_id == user_id) \
+                .filter(or_(last_viewed == None, last_viewed < viewed)) \
+                .update({'activity_stream_last_viewed': viewed}, synchronize_session=False)
+            if not updated and not session.query(model.Dashboard) \
+                    .filter(model.Dashboard.user_id == user_id).count():
+                # like model.Dashboard.get, create the missing dashboard
+                dashboard = model.Dashboard(user_id)
+                dashboard.activity_stream_last_viewed = viewed
+                session.add(dashboard)
+        session.commit()
+
+        log.debug('Marked the dashboard activities of %d users as old', len(pending))
+        return len(pending)
+
+
+# see FeedsPlugin.configure
+deferred_marks = DeferredMarks()
@@ -0,0 +1,76 @@
+# encoding: utf-8
+""" Activity message templates of the feeds """
+
+import re
+
+import ckan.lib.activity_streams as activity_streams
+from ckan.common import _
+
+
+# the snippets of an activity message, e.g. {actor}
+PLACEHOLDER = re.compile('\{([^}]*)\}')
+
+
+class MessageTemplate(object):
+    '''
+    The message and title of an activity type in one language
+
+    The message is parsed once, the feed items only fill in the values of
+    its placeholders.
+    '''
+
+    def __init__(self, activity_type, msg, title):
+        self.activity_type = activity_type
+        self.msg = msg
+        self.title = title
+        self.placeholders = tuple(str(match) for match in PLACEHOLDER.findall(msg))
+
+    def format(self, data):
+        return self.msg.format(**data)
+
+
+# (activity type, language, variant) -> MessageTemplate
+_message_templates = {}
+
+
+def _variant(activity):
+    # the messages of the related items depend on whether they belong to a dataset
+    return bool(activity.get('data', {}).get('dataset'))
+
+
+def message_template(context, activity_type, activity, lang=None):
+    '''Return the message template of an activity type in the current language
+
+    :param context: context dictionary
+    :type context: dict
+    :param activity_type: the activity type, e.g. 'changed package'
+    :type activity_type: string
+    :param activity: an activity of that type
+    :type activity: dict
+    :param lang: the current language
+    :type lang: string
+
+    :rtype: MessageTemplate
+    '''
+    key = (activity_type, lang, _variant(activity))
+    template = _message_templates.get(key)
+    if template is None:
+        # The activity stream string functions only depend on the activity
+        # type, the language and whether the activity has a dataset, not on
+        # the rest of the activity.
+        msg = activity_streams.activity_stream_string_functions[activity_type](context, activity)
+        template = MessageTemplate(activity_type, msg, _(activity_type.title()))
+        _message_templates[key] = template
+    return template
+
+
+def prime_message_templates(context, lang=None):
+    '''Prepare the message templates of all the activity types for a language
+
+    Once primed, message_template does not need the translations of the
+    current request anymore, e.g. when a feed is written after the
+    controller returned.
+    '''
+    for activity_type in activity_streams.activity_stream_string_functions:
+        for activity in ({'data': {}}, {'data': {'dataset': True}}):
+            message_template(context, activity_type, activity, lang)
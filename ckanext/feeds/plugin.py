@@ -8,19 +8,30 @@ import ckan.plugins as p
 import ckan.plugins.toolkit as tk
 import ckan.lib.helpers as h
 
-from datetime import datetime
+from datetime import timedelta
 
-import re
+import urllib
+import urlparse
+import itertools
 from ckan.lib.base import abort
 
-from ckan.logic.action.get import package_activity_list, user_activity_list, group_activity_list, organization_activity_list
-
 import ckan.model as model
 from ckan.common import _, c, g, request, response
+from pylons import config
 from pylons.i18n import get_lang
 
 import ckan.lib.activity_streams as activity_streams
-from webhelpers.feedgenerator import Atom1Feed, RssUserland091Feed, Rss201rev2Feed
+from ckanext.feeds import loaders, cache, compression, freshness, logic, marks, query, inbox, \
+    timing, websub, writers
+from ckanext.feeds.cache import LRUCache, make_feed_cache
+from ckanext.feeds.loaders import activity_details_by_activity_id, name_resolver
+from ckanext.feeds.messages import message_template, prime_message_templates
+from ckanext.feeds.stream import closing_session
+from ckanext.feeds.query import parse_cursor, format_cursor
+from ckanext.feeds.followers import activity_recipients, dataset_groups
+from ckanext.feeds.conditional import feed_etag, params_key, http_date, is_not_modified, \
+    accepts_feed_delta, etag_activity_id
+from ckanext.feeds.writers import FeedItem
 from ckan.controllers.user import UserController
 from ckan.lib.plugins import DefaultTranslation
 from ckan.logic.auth.get import dashboard_activity_list as dashboard_auth
@@ -29,11 +40,20 @@ from ckan.controllers.user import UserController
 
 
 
+def current_lang():
+    lang = get_lang()
+    return lang[0] if lang else None
+
+
 class FeedsPlugin(p.SingletonPlugin, DefaultTranslation):
     """
     Several improvements to the feeds
     """
 
+    # always: mark the activities old on every feed request, never: the
+    # feeds are read-only, deferred: mark them old in batches
+    MARK_ACTIVITIES_OLD_MODES = ['always', 'never', 'deferred']
+
     # enable the custom translations
     p.implements(p.ITranslation)
 
@@ -42,6 +62,183 @@ class FeedsPlugin(p.SingletonPlugin, DefaultTranslation):
         # add the template dir
         tk.add_template_directory(config, 'templates')
 
+    p.implements(p.IConfigurable)
+    def configure(self, config):
+        loaders.name_cache = LRUCache(
+            max_entries=tk.asint(config.get('ckanext.feeds.name_cache.max_entries', 10000)),
+            ttl=tk.asint(config.get('ckanext.feeds.name_cache.ttl', 300)),
+        )
+        cache.feed_cache = make_feed_cache(config)
+
+        mark_activities_old = config.get('ckanext.feeds.mark_activities_old', 'always')
+        if mark_activities_old not in self.MARK_ACTIVITIES_OLD_MODES:
+            raise ValueError('Unknown value of ckanext.feeds.mark_activities_old: %s' % mark_activities_old)
+        DashboardFeedController.mark_activities_old = mark_activities_old
+        DashboardFeedController.chunk_size = tk.asint(config.get('ckanext.feeds.chunk_size', 50))
+        coalesce_window = tk.asint(config.get('ckanext.feeds.coalesce_window', 0))
+        DashboardFeedController.coalesce_window = coalesce_window and timedelta(seconds=coalesce_window) or None
+        marks.deferred_marks = marks.DeferredMarks(
+            interval=tk.asint(config.get('ckanext.feeds.mark_activities_old.interval', 60))
+        )
+
+        inbox.enabled = tk.asbool(config.get('ckanext.feeds.inbox', False))
+        if inbox.enabled:
+            inbox.setup()
+
+        freshness.enabled = tk.asbool(config.get('ckanext.feeds.adaptive_ttl', False))
+        freshness.min_ttl = tk.asint(config.get('ckanext.feeds.adaptive_ttl.min', 60))
+        freshness.max_ttl = tk.asint(config.get('ckanext.feeds.adaptive_ttl.max', 3600))
+        freshness.activity_rates = freshness.ActivityRates(
+            max_entries=tk.asint(config.get('ckanext.feeds.adaptive_ttl.max_entries', 10000)))
+
+        compression.enabled = tk.asbool(config.get('ckanext.feeds.compression', True))
+        compression.level = tk.asint(config.get('ckanext.feeds.compression.level', 6))
+
+        timing.enabled = tk.asbool(config.get('ckanext.feeds.timing', False))
+        if timing.enabled:
+            timing.install()
+
+        websub.enabled = tk.asbool(config.get('ckanext.feeds.websub', False))
+        if websub.enabled:
+            websub.site_url = config.get('ckan.site_url', '').rstrip('/')
+            websub.hub_url = websub.site_url + '/feeds/hub'
+            websub.dispatcher = websub.Dispatcher(
+                workers=tk.asint(config.get('ckanext.feeds.websub.workers', 2)),
+                max_queue=tk.asint(config.get('ckanext.feeds.websub.max_queue', 1000)),
+                retries=tk.asint(config.get('ckanext.feeds.websub.retries', 3)),
+                backoff=float(config.get('ckanext.feeds.websub.backoff', 2)),
+                timeout=float(config.get('ckanext.feeds.websub.timeout', 10)),
+            )
+            websub.allowed_callbacks = tk.aslist(
+                config.get('ckanext.feeds.websub.allowed_callbacks', ''))
+            websub.max_pending = tk.asint(config.get('ckanext.feeds.websub.max_pending', 100))
+            websub.setup()
+
+    p.implements(p.ISession, inherit=True)
+    def before_flush(self, session, flush_context, instances):
+        # the cached names of renamed or deleted users and groups, forgotten
+        # once the changes are committed: a request reading the old name
+        # before the commit would otherwise cache it again
+        names = set()
+        for obj in itertools.chain(session.dirty, session.deleted):
+            if isinstance(obj, model.User):
+                names.add('user:%s' % obj.id)
+            elif isinstance(obj, model.Group):
+                names.add('group:%s' % obj.id)
+        if names:
+            if not hasattr(session, '_feeds_names'):
+                session._feeds_names = set()
+            session._feeds_names |= names
+
+        # the dashboards of the users who follow or unfollow something change
+        # without a new activity, drop them once the follows are committed
+        followers = set(
+            obj.follower_id for obj in itertools.chain(session.new, session.dirty, session.deleted)
+            if isinstance(obj, (model.UserFollowingUser, model.UserFollowingDataset,
+                                model.UserFollowingGroup))
+        )
+        if followers:
+            if not hasattr(session, '_feeds_followers'):
+                session._feeds_followers = set()
+            session._feeds_followers |= followers
+
+        # remember the new activities until they are committed
+        new_activities = [
+            (obj.id, obj.user_id, obj.object_id, obj.activity_type, obj.timestamp)
+            for obj in session.new if isinstance(obj, model.Activity)
+        ]
+        if new_activities:
+            if not hasattr(session, '_feeds_new_activities'):
+                session._feeds_new_activities = []
+            session._feeds_new_activities.extend(new_activities)
+
+    def after_commit(self, session):
+        names = getattr(session, '_feeds_names', None)
+        if names:
+            del session._feeds_names
+            for name in names:
+                loaders.name_cache.delete(name)
+
+        followers = getattr(session, '_feeds_followers', None)
+        if followers:
+            del session._feeds_followers
+            for user_id in followers:
+                cache.feed_cache.invalidate(user_id)
+
+        new_activities = getattr(session, '_feeds_new_activities', None)
+        if not new_activities:
+            return
+        del session._feeds_new_activities
+
+        try:
+            self.activities_created(new_activities)
+        except Exception:
+            # the activities are committed, don't fail the action that created them
+            log.exception('Could not process the new activities')
+
+    def after_rollback(self, session):
+        if hasattr(session, '_feeds_new_activities'):
+            del session._feeds_new_activities
+        if hasattr(session, '_feeds_followers'):
+            del session._feeds_followers
+        if hasattr(session, '_feeds_names'):
+            del session._feeds_names
+
+    def activities_created(self, activities):
+        '''
+        Called with the (id, user_id, object_id, activity_type, timestamp)
+        tuples of the activities of a committed transaction.
+        '''
+        if cache.feed_cache.backend == 'none' and not inbox.enabled and not websub.enabled \
+                and not freshness.enabled:
+            return
+
+        # The session can't be used after the commit, use a connection of its own
+        connection = model.meta.engine.connect()
+        try:
+            object_ids = set(activity[2] for activity in activities)
+            groups = dataset_groups(connection, object_ids)
+            recipients = activity_recipients(connection, activities, groups)
+            if inbox.enabled:
+                # fan out on write: the dashboard feeds read the inboxes
+                inbox.fan_out(connection, activities, recipients)
+            if websub.enabled:
+                # push the new entries to the subscribers of the shared feeds
+                websub.publish(connection, activities, object_ids.union(*groups.values()))
+        finally:
+            connection.close()
+
+        # drop the cached dashboards that show one of the new activities
+        user_ids = set(itertools.chain(*recipients.values()))
+        for user_id in user_ids:
+            cache.feed_cache.invalidate(user_id)
+
+        # and the shared feeds of their objects and of the groups of their datasets
+        object_namespaces = [cache.object_namespace(object_id)
+                             for object_id in object_ids.union(*groups.values())]
+        for namespace in object_namespaces:
+            cache.feed_cache.invalidate(namespace)
+
+        if freshness.enabled:
+            freshness.activity_rates.observe(itertools.chain(user_ids, object_namespaces))
+
+    # -------
+    # Actions
+    # -------
+    p.implements(p.IActions)
+    def get_actions(self):
+        return {
+            'feeds_cache_stats': logic.feeds_cache_stats,
+            'feeds_timing_stats': logic.feeds_timing_stats,
+        }
+
+    p.implements(p.IAuthFunctions)
+    def get_auth_functions(self):
+        return {
+            'feeds_cache_stats': logic.feeds_cache_stats_auth,
+            'feeds_timing_stats': logic.feeds_timing_stats_auth,
+        }
+
     # ----------------
     # Template Helpers
     # ----------------
@@ -67,45 +264,59 @@ class FeedsPlugin(p.SingletonPlugin, DefaultTranslation):
                     controller='ckanext.feeds.plugin:DashboardFeedController',
                     action='view_dashboard_feed'
         )
+        # the feeds of one dataset, group or organization, the same for everyone
+        map.connect('object_feed',
+                    '/feeds/{filter_type}/{id}/activity',
+                    controller='ckanext.feeds.plugin:DashboardFeedController',
+                    action='view_object_feed',
+                    requirements={'filter_type': 'dataset|group|organization'}
+        )
+        # the WebSub hub of the shared feeds
+        map.connect('websub_hub',
+                    '/feeds/hub',
+                    controller='ckanext.feeds.plugin:DashboardFeedController',
+                    action='websub_hub',
+                    conditions={'method': ['POST']}
+        )
         return map
 
 
 
 def rss_snippet_actor(activity, detail, context=None):
-    user_dict = tk.get_action('user_show')(context, {'id': activity['user_id']})
-    return user_dict['name']
+    return name_resolver(context).user_name(activity['user_id'])
 
 
 def rss_snippet_user(activity, detail, context=None):
-    user_dict = tk.get_action('user_show')(context, {'id': activity['object_id']})
-    return user_dict['name']
+    return name_resolver(context).user_name(activity['object_id'])
+
+
+def site_url(context):
+    # feeds written after the request ended get the site url from the context
+    return context.get('site_url') or g.site_url
 
 
 def rss_snippet_dataset(activity, detail, context=None):
     data = activity['data']
     dataset = data.get('package') or data.get('dataset')
-    dataset['url'] = '%s/dataset/%s' % (g.site_url, dataset['name'])
-    # return dataset
-    return dataset['url']
+    # the activity data may be cached, don't modify it
+    return '%s/dataset/%s' % (site_url(context), dataset['name'])
 
 def rss_snippet_tag(activity, detail, context=None):
     return detail['data']['tag']
 
 def rss_snippet_group(activity, detail, context=None):
-    group = h.dataset_display_name(activity['data']['group'])
+    group = name_resolver(context).group_display_name(activity['data']['group'])
     return group
 
 def rss_snippet_organization(activity, detail, context=None):
-    return h.dataset_display_name(activity['data']['group'])
+    return name_resolver(context).group_display_name(activity['data']['group'])
 
 def rss_snippet_extra(activity, detail, context=None):
     return '"%s"' % detail['data']['package_extra']['key']
 
 def rss_snippet_resource(activity, detail, context=None):
     resource = detail['data']['resource']
-    resource['url'] = '%s/dataset/%s' % (g.site_url, resource['url'])
-    # return resource
-    return resource['url']
+    return '%s/dataset/%s' % (site_url(context), resource['url'])
 
 def rss_snippet_related_item(activity, detail, context=None):
     return activity['data']['related']
@@ -122,12 +333,27 @@ def rss_snippet_related_type(activity, detail, context=None):
 class DashboardFeedController(UserController):
     """ Dashboard Feed Controller """
 
-    AVAILABLE_FORMATS = ['atom', 'rss']
+    AVAILABLE_FORMATS = list(writers.WRITERS)
+
+    CONTENT_TYPES = writers.CONTENT_TYPES
 
     RSS_FEED_VERSIONS = ['0.91', '2.01']
 
     MAXRESULTS = 200
 
+    # the maximum number of type/name pairs of a merged feed
+    MAXSOURCES = 20
+
+    # see FeedsPlugin.configure
+    mark_activities_old = 'always'
+
+    # the number of activities read, enriched and written at a time, see FeedsPlugin.configure
+    chunk_size = 50
+
+    # bursts of activities on one object within this timedelta are one feed item,
+    # None to show every activity, see FeedsPlugin.configure
+    coalesce_window = None
+
     # A dictionary mapping activity snippets to functions that expand the snippets.
     activity_snippet_functions = {
         'actor': rss_snippet_actor,
@@ -142,61 +368,88 @@ class DashboardFeedController(UserController):
         'related_type': rss_snippet_related_type,
     }
 
-    def get_feed(self, feed_type='rss', feed_version='2.01'):
+    def get_feed(self, feed_type='rss', feed_version='2.01', **kwargs):
 
         meta = {
             'title': _('News feed'),
             'link': h.url_for(controller='user', action='dashboard', id=''),
             'description': _('Subscribed Activity'), #_("Activity from items that I'm following"),
         }
+        # e.g. the next_url and previous_url paging links
+        meta.update(kwargs)
         
         lang = get_lang()
         if lang:
             meta['language'] = unicode(lang[0])
 
         # optional version of feed, e.g. rss 0.91 or rss 2.01 (default)
-        if feed_type == 'atom':
-
-            # class webhelpers.feedgenerator.Atom1Feed(title, link, description, language=None, author_email=None, author_name=None, author_link=None, subtitle=None, categories=None, feed_url=None, feed_copyright=None, feed_guid=None, ttl=None, **kwargs)
-            feed = Atom1Feed(**meta)
-            feed.content_type = 'application/atom+xml'
-
-        elif feed_type == 'rss':
+        if feed_type not in writers.WRITERS:
+            abort(400, _('Unknown feed format'))
 
-            # if feed_version not in self.RSS_FEED_VERSIONS:
-            #     feed_version = '2.01'
+        # e.g. ckanext.feeds.writers.Rss201Writer(title, link, description, language=None, encoding='utf-8', **kwargs)
+        feed = writers.writer_class(feed_type, feed_version)(**meta)
 
-            if feed_version == '0.91':
-                # class webhelpers.feedgenerator.RssUserland091Feed(title, link, description, language=None, author_email=None, author_name=None, author_link=None, subtitle=None, categories=None, feed_url=None, feed_copyright=None, feed_guid=None, ttl=None, **kwargs)
-                feed = RssUserland091Feed(**meta)
-            else:
-                # class webhelpers.feedgenerator.Rss201rev2Feed(title, link, description, language=None, author_email=None, author_name=None, author_link=None, subtitle=None, categories=None, feed_url=None, feed_copyright=None, feed_guid=None, ttl=None, **kwargs)
-                feed = Rss201rev2Feed(**meta)
+        return feed
 
-            feed.content_type = 'application/rss+xml'
 
+    def object_channel(self, filter_type, object_id):
+        '''
+        Return the title, link and description of the feed of a dataset,
+        group or organization: its display name and its page.
+        '''
+        if filter_type == 'dataset':
+            obj = model.Package.get(object_id)
+            title = obj.title or obj.name
+            link = h.url_for(controller='package', action='read', id=obj.name, qualified=True)
         else:
-            abort(400, _('Unknown feed format'))
-
-        return feed
-
+            obj = model.Group.get(object_id)
+            title = obj.display_name
+            link = h.url_for(controller=filter_type, action='read', id=obj.name, qualified=True)
+        return {
+            'title': title,
+            'link': link,
+            'description': _('Activity of {name}').format(name=title),
+        }
 
     # adapted from ckan.lib.activity_streams.activity_list_to_html
-    def activity_list_to_feed(self, context, activity_stream): # extra_vars={}
-        '''Return the given activity stream as a dictionary
+    def activity_list_to_feed(self, context, activity_stream):
+        '''Return the given activity stream as feed items
 
-        :param context: context dictionary
+        The activities are enriched in one pass: the message, pubdate and
+        links of an item are computed from its activity and written
+        straight into its FeedItem. The activity dictionaries, which may be
+        cached, are left unchanged.
+
+        :param context: context dictionary, see stream_feed
         :type context: dict
         :param activity_stream: the activity stream to render
         :type activity_stream: list of activity dictionaries
-        :param extra_vars: extra variables to pass to the activity stream items
-            template when rendering it
-        :type extra_vars: dictionary
 
-        :rtype: dict to add to the feed
+        :rtype: list of ckanext.feeds.writers.FeedItem
         '''
 
-        activity_list = [] # These are the activity stream messages.
+        timer = timing.current()
+
+        # Some activity types may have details, load them for the whole
+        # stream at once rather than once per activity.
+        activity_stream = list(activity_stream)
+        with timer.stage('details'):
+            activity_details = activity_details_by_activity_id(context, [
+                activity['id'] for activity in activity_stream
+                if activity['activity_type'] in activity_streams.activity_stream_actions_with_detail
+            ])
+        # Load the names of all the users and groups of the stream at once.
+        with timer.stage('names'):
+            name_resolver(context).prefetch(activity_stream)
+
+        lang = context['lang'] if 'lang' in context else current_lang()
+        revision_url = '%s/revision/%%s' % site_url(context)
+        snippet_functions = self.activity_snippet_functions
+        string_functions = activity_streams.activity_stream_string_functions
+
+        started = timer.clock()
+
+        items = []
         for activity in activity_stream:
 
             # sample activity:
@@ -220,52 +473,54 @@ class DashboardFeedController(UserController):
             detail = None
             activity_type = activity['activity_type']
             # Some activity types may have details.
-            if activity_type in activity_streams.activity_stream_actions_with_detail:
-                details = tk.get_action('activity_detail_list')(
-                    context=context,
-                    data_dict={'id': activity['id']}
-                )
-                # If an activity has just one activity detail then render the
-                # detail instead of the activity.
-                if len(details) == 1:
-                    detail = details[0]
-                    object_type = detail['object_type']
-
-                    if object_type == 'PackageExtra':
-                        object_type = 'package_extra'
-
-                    new_activity_type = '%s %s' % (detail['activity_type'],
-                                                object_type.lower())
-                    if new_activity_type in activity_streams.activity_stream_string_functions:
-                        activity_type = new_activity_type
-
-            if not activity_type in activity_streams.activity_stream_string_functions:
+            details = activity_details.get(activity['id'])
+            # If an activity has just one activity detail then render the
+            # detail instead of the activity.
+            if details and len(details) == 1:
+                detail = details[0]
+                object_type = detail['object_type']
+
+                if object_type == 'PackageExtra':
+                    object_type = 'package_extra'
+
+                new_activity_type = '%s %s' % (detail['activity_type'],
+                                            object_type.lower())
+                if new_activity_type in string_functions:
+                    activity_type = new_activity_type
+
+            if not activity_type in string_functions:
                 raise NotImplementedError("No activity renderer for activity "
                     "type '%s'" % activity_type)
 
-            activity_msg = activity_streams.activity_stream_string_functions[activity_type](context, activity)
+            template = message_template(context, activity_type, activity, lang)
 
             # Get the data needed to render the message.
-            matches = re.findall('\{([^}]*)\}', activity_msg)
             data = {}
-            for match in matches:
-                snippet = self.activity_snippet_functions[match](activity, detail, context)
-                data[str(match)] = snippet
+            for match in template.placeholders:
+                data[match] = snippet_functions[match](activity, detail, context)
+
+            msg = template.format(data)
+            count = activity.get('count', 1)
+            if count > 1:
+                msg = context['burst_message'].format(msg=msg, count=count)
+
+            items.append(FeedItem(
+                title=template.title,
+                link=revision_url % activity['revision_id'],
+                description=msg,
+                author_name=data['actor'],
+                pubdate=query.parse_timestamp(activity['timestamp']),
+                unique_id=activity['object_id'],
+                activity_id=activity['id'],
+                cursor=format_cursor(activity),
+            ))
 
-            activity_list.append({'msg': activity_msg,
-                                  'revision_id': activity['revision_id'],
-                                  'object_id': activity['object_id'],
-                                  'type': activity_type.replace(' ', '-').lower(),
-                                  'title': activity_type.title(),
-                                  'data': data,
-                                  'timestamp': activity['timestamp'],
-                                  'is_new': activity.get('is_new', False)}
-                                )
+        timer.add('snippets', started)
 
-        # extra_vars['activities'] = activity_list
-        # return base.render('activity_streams/activity_stream_items.html', extra_vars=extra_vars)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('feed items: %s', [item.description for item in items])
 
-        return activity_list
+        return items
 
 
     def view_dashboard_feed(self, id=None, offset=0):
@@ -291,87 +546,505 @@ class DashboardFeedController(UserController):
         if format not in self.AVAILABLE_FORMATS:
             abort(400, _('Unknown output format'))
 
-        context = {'model': model, 'session': model.Session,
-                   'user': c.user, 'auth_user_obj': c.userobj,
-                   'for_view': True}
-
-        # check if user is logged in
-        # if user is not logged, the user is redirected to the login page
-        if not dashboard_auth(context, {}).get('success', False):
-            abort(401, _('You must be logged in to access your dashboard.'))
-
-        # request parameters
-        q = request.params.get('q', u'') # optional query parameter
-        filter_type = request.params.get('type', u'') # e.g. 'dataset' to view only the activities related to datasets
-        filter_id = request.params.get('name', u'') # e.g. the name or id of the dataset to filter for
-
-        offset = request.params.get('offset', 0)
-        limit = request.params.get('limit', 0)
-
-        # TODO: this would allow to view only unread items
-        is_new = bool(request.params.get('is_new', False))
-
-        self._setup_template_variables(context, {'id': id, 'user_obj': c.userobj, 'offset': offset})
-
-        c.followee_list = tk.get_action('followee_list')(context, {'id': c.userobj.id, 'q': u''})
-        c.dashboard_activity_stream_context = self._get_dashboard_context(filter_type, filter_id, q)
+        try:
+            mark_old = tk.asbool(request.params.get('mark_old', True))
+        except ValueError:
+            abort(400, _('Invalid mark_old parameter'))
+
+        timer = timing.start()
+
+        try:
+            context = {'model': model, 'session': model.Session,
+                       'user': c.user, 'auth_user_obj': c.userobj,
+                       'for_view': True}
+
+            # check if user is logged in
+            # if user is not logged, the user is redirected to the login page
+            with timer.stage('auth'):
+                authorized = dashboard_auth(context, {}).get('success', False)
+            if not authorized:
+                abort(401, _('You must be logged in to access your dashboard.'))
+
+            body = self._serve_feed(context, format, self._feed_sources(), c.userobj.id)
+            if body is None:
+                return ''
+
+            # Mark the user's new activities as old whenever they view their dashboard feed,
+            # unless the feeds are read-only or the request asks for a read-only feed
+            if mark_old:
+                self._mark_activities_old(context)
+
+            response.headers['Content-Type'] = self.CONTENT_TYPES[format]
+            return body
+        finally:
+            # the timer of an aborted request is dropped
+            timing.discard()
+
+    def view_object_feed(self, filter_type, id):
+        """
+        Shows the activities of a dataset, group or organization as a RSS
+        or ATOM feed
 
-        # https://github.com/ckan/ckan/blob/55ae76ec73e97bcae05b778ab35f23ed518e6e24/ckan/controllers/user.py#L672
+        The feeds of public objects are the same for every user, logged in
+        or not, and are cached once for all of them. The feeds of private
+        objects are the ones of the logged in user.
 
-        query_dict = {
-            'id': filter_id,
-            'offset': offset,
-            'limit': limit,
-        }
+        :param filter_type: 'dataset', 'group' or 'organization'
+        :type filter_type: string
+        :param id: the name or id of the object
+        :type id: string
 
-        if filter_type == 'dataset':
-            activity_stream = package_activity_list(context, query_dict)
-        elif filter_type == 'user':
-            activity_stream = user_activity_list(context, query_dict)
-        elif filter_type == 'group':
-            activity_stream = group_activity_list(context, query_dict)
-        elif filter_type == 'organization':
-            activity_stream = organization_activity_list(context, query_dict)
-        else:
-            # full, unfiltered, activity stream
-            # activity_stream = h.dashboard_activity_stream(c.user, filter_type, filter_id, offset)
-            activity_stream = tk.get_action('dashboard_activity_list')(context, {
-                'offset': offset,
-                'is_new': is_new,
-            })
+        :rtype: rendered feed
+        """
 
-        # log.debug('activity_stream: %s' % activity_stream)
+        format = request.params.get('format', u'rss')
+        if format not in self.AVAILABLE_FORMATS:
+            abort(400, _('Unknown output format'))
 
-        activity_list = self.activity_list_to_feed(context, activity_stream)
+        timer = timing.start()
+
+        try:
+            with timer.stage('auth'):
+                try:
+                    object_id = query.object_id(query.OBJECT_MODELS[filter_type], id)
+                except tk.ObjectNotFound:
+                    abort(404, _('Not found'))
+                public = query.public_object(filter_type, object_id)
+
+            if public:
+                # render the feed as an anonymous user, so it's the same for everyone
+                context = {'model': model, 'session': model.Session,
+                           'user': '', 'for_view': True}
+                namespace = cache.object_namespace(object_id)
+            else:
+                context = {'model': model, 'session': model.Session,
+                           'user': c.user, 'auth_user_obj': c.userobj,
+                           'for_view': True}
+                if not c.userobj:
+                    abort(401, _('Not authorized to see this page'))
+                namespace = c.userobj.id
+
+            page_url = self._page_url(format, request.params.get('version', '2.01'),
+                                      route=('object_feed', {'filter_type': filter_type, 'id': id}))
+            # the public feeds are WebSub topics, pushed by the hub of the extension
+            hub_topic = page_url if public and websub.enabled else None
+            if hub_topic is not None:
+                response.headers['Link'] = websub.link_header(hub_topic)
+            body = self._serve_feed(context, format, [(filter_type, object_id)], namespace, page_url,
+                                    hub_topic, self.object_channel(filter_type, object_id))
+            if body is None:
+                return ''
+
+            response.headers['Content-Type'] = self.CONTENT_TYPES[format]
+            return body
+        finally:
+            # the timer of an aborted request is dropped
+            timing.discard()
+
+    def websub_hub(self):
+        """
+        The WebSub hub of the public dataset, group and organization feeds
 
-        log.debug('activity_list: %s' % str(activity_list))
+        Subscribes a callback to a feed (or unsubscribes it) once the
+        callback confirmed it, see websub.Verification. The new entries of
+        the feed are then posted to the callback, see websub.publish.
 
-        # activity_list_limit = int(g.activity_list_limit)
-        # has_more = len(activity_list) > activity_list_limit
+        :rtype: empty response, 202 Accepted
+        """
+        if not websub.enabled:
+            abort(404, _('Not found'))
+
+        mode = request.params.get('hub.mode')
+        if mode not in ('subscribe', 'unsubscribe'):
+            abort(400, _('Invalid hub.mode'))
+        callback = request.params.get('hub.callback', u'')
+        if not websub.allowed_callback(callback):
+            abort(400, _('Invalid hub.callback'))
+        # a secret sent in clear is no secret, the hub ignores it
+        secret = request.params.get('hub.secret') if request.scheme == 'https' else None
+        secret = secret or None
+        if secret is not None and len(secret.encode('utf-8')) >= 200:
+            abort(400, _('Invalid hub.secret'))
+        try:
+            lease_seconds = int(request.params.get('hub.lease_seconds', websub.DEFAULT_LEASE_SECONDS))
+        except ValueError:
+            abort(400, _('Invalid hub.lease_seconds'))
+        if lease_seconds <= 0:
+            abort(400, _('Invalid hub.lease_seconds'))
+        lease_seconds = min(lease_seconds, websub.MAX_LEASE_SECONDS)
+
+        topic = request.params.get('hub.topic', u'')
+        filter_type, object_id, format, feed_version = self._websub_topic(topic)
+
+        # every intent makes the hub send a request, their number is bounded
+        if not websub.reserve_verification():
+            abort(503, _('Too many pending subscriptions, try again later'))
+        if not websub.dispatcher.submit(websub.Verification(
+                mode, topic, callback, filter_type, object_id, format, feed_version,
+                secret, lease_seconds)):
+            websub.release_verification()
+            abort(503, _('Too many pending subscriptions, try again later'))
+        response.status_int = 202
+        return ''
+
+    def _websub_topic(self, topic):
+        '''
+        Return the filter type, object id, format and version of the feed
+        of a WebSub topic, the url of the feed of a public dataset, group
+        or organization.
+        '''
+        if not topic.startswith(websub.site_url + '/'):
+            abort(400, _('Invalid hub.topic'))
+        url = urlparse.urlparse(topic[len(websub.site_url):])
+        match = config['routes.map'].match(url.path)
+        if not match or match.get('action') != 'view_object_feed':
+            abort(400, _('Invalid hub.topic'))
+
+        params = urlparse.parse_qs(url.query)
+        format = params.get('format', [u'rss'])[0]
+        feed_version = params.get('version', [u'2.01'])[0]
+        if format not in self.AVAILABLE_FORMATS:
+            abort(400, _('Invalid hub.topic'))
+
+        filter_type = match['filter_type']
+        try:
+            object_id = query.object_id(query.OBJECT_MODELS[filter_type], match['id'])
+        except tk.ObjectNotFound:
+            abort(400, _('Invalid hub.topic'))
+        if not query.public_object(filter_type, object_id):
+            # the feeds of private objects are never pushed
+            abort(403, _('Not authorized to see this page'))
+        return filter_type, object_id, format, feed_version
+
+    def _feed_sources(self):
+        '''
+        Return the (type, name) pairs of the dashboard feed request
 
-        # feed object
-        feed = self.get_feed(feed_type=format, feed_version=request.params.get('version', '2.01'))
+        type is e.g. 'dataset' to view only the activities related to a
+        dataset, and name the name or id of the dataset to filter for.
+        Several type and name parameters merge the feeds of several
+        objects into one.
+        '''
+        types = request.params.getall('type')
+        names = request.params.getall('name')
+        if len(types) <= 1:
+            return [(request.params.get('type', u''), request.params.get('name', u''))]
+        if len(types) != len(names) or len(types) > self.MAXSOURCES:
+            abort(400, _('Invalid feed sources'))
+        return zip(types, names)
+
+    def _serve_feed(self, context, format, sources, namespace, page_url=None, hub_topic=None,
+                    channel=None):
+        """
+        Answers a feed request: from the newest activity alone if the
+        client has the current version of the feed, from the feed cache,
+        or by rendering the feed
 
-        for activity in activity_list:
+        If the requests are timed, the feed is rendered before it is
+        returned rather than streamed, so that the Server-Timing header
+        has all the stages.
 
-            log.debug(activity['msg'])
+        See _feed_body for the parameters.
 
-            activity['msg'] = activity['msg'].format(**activity['data'])
+        :rtype: the body of the response, or None if the feed is not modified
+        """
+        timer = timing.current()
+        body = self._feed_body(context, format, sources, namespace, page_url, hub_topic, channel)
+        if timer.enabled:
+            if body is not None and not isinstance(body, basestring):
+                body = ''.join(body)
+            response.headers['Server-Timing'] = timer.server_timing()
+            timing.finish(timer, path=request.path, format=format, status=response.status_int)
+        return body
+
+    def _feed_body(self, context, format, sources, namespace, page_url=None, hub_topic=None,
+                   channel=None):
+        """
+        Answers a feed request: from the newest activity alone if the
+        client has the current version of the feed, from the feed cache,
+        or by rendering the feed
+
+        :param sources: the (type, name) pairs of the feed, see
+            query.feed_activities
+        :type sources: list of tuples
+        :param namespace: the feed cache namespace of the feed, the id of
+            the user for the feeds that depend on the user
+        :type namespace: string
+        :param page_url: the url of the feed without the paging parameters,
+            the dashboard feed by default
+        :param hub_topic: the WebSub topic of the feed, see stream_feed
+        :param channel: the title, link and description of the feed, see
+            stream_feed
+
+        :rtype: the body of the response, or None if the feed is not modified
+        """
 
-            # http://docs.pylonsproject.org/projects/webhelpers/en/latest/modules/feedgenerator.html#webhelpers.feedgenerator.SyndicationFeed.add_item
-            # required fields: title, link, description
-            # optional fields: author_email, author_name, author_link, pubdate, comments, unique_id, enclosure, categories, item_copyright, ttl, **kwargs
-            feed.add_item(
-                title=_(activity['title']),
-                link='%s/revision/%s' % (g.site_url, activity['revision_id']),
-                description=activity['msg'],
-                author_name=activity['data']['actor'],
-                pubdate=datetime.strptime(activity['timestamp'], '%Y-%m-%dT%H:%M:%S.%f'), # '2016-06-30T15:42:52.663910'
-                unique_id=activity['object_id'],
-            )
+        # request parameters
+        q = request.params.get('q', u'') # optional query parameter
 
-        # Mark the user's new activities as old whenever they view their dashboard feed
-        tk.get_action('dashboard_mark_activities_old')(context, {})
+        try:
+            offset = int(request.params.get('offset', 0))
+            limit = int(request.params.get('limit', 0)) or \
+                int(config.get('ckan.activity_list_limit', 31))
+            before = request.params.get('before')
+            before = before and parse_cursor(before)
+            since = request.params.get('since')
+            since = since and parse_cursor(since)
+            # cursors can be activity ids alone
+            before = query.resolve_cursor(context, before)
+            since = query.resolve_cursor(context, since)
+        except ValueError:
+            abort(400, _('Invalid paging parameters'))
+        if offset < 0 or limit < 0:
+            abort(400, _('Invalid paging parameters'))
+        limit = min(limit, self.MAXRESULTS)
+
+        feed_version = request.params.get('version', '2.01')
+
+        timer = timing.current()
+
+        # conditional GET: answer from the newest activity alone if the
+        # client already has the current version of the feed
+        try:
+            with timer.stage('latest'):
+                latest = query.latest_activity(context, sources)
+        except tk.ObjectNotFound:
+            abort(404, _('Not found'))
+        except tk.NotAuthorized:
+            abort(403, _('Not authorized to see this page'))
+
+        if page_url is None:
+            page_url = self._page_url(format, feed_version, sources)
+
+        params = {
+            # the feeds of two routes have other links, e.g. a private
+            # object feed and the dashboard filtered by the same object
+            'page': page_url,
+            'format': format, 'version': feed_version,
+            'type': u','.join(filter_type for filter_type, _filter_id in sources),
+            'name': u','.join(filter_id for _filter_type, filter_id in sources),
+            'q': q, 'offset': offset, 'limit': limit,
+            'before': request.params.get('before', u''),
+            'since': request.params.get('since', u''),
+            'lang': u','.join(get_lang() or []),
+        }
+        if any(filter_type not in query.OBJECT_FILTER_TYPES for filter_type, _filter_id in sources):
+            # following or unfollowing changes the dashboard without a new activity
+            with timer.stage('latest'):
+                params['followees'] = query.followees_key(context)
+        # the feed is compressed if the client accepts it, see compression.accepted_encoding
+        encoding = None
+        if compression.enabled:
+            encoding = compression.accepted_encoding(request.headers.get('Accept-Encoding'))
+            response.headers['Vary'] = 'Accept-Encoding'
+
+        # how long the client can wait before asking again, see
+        # freshness.feed_ttl: the body has it in whole minutes, a part of
+        # the ETag and of the cache key like the other parameters
+        ttl = body_ttl = None
+        if freshness.enabled:
+            ttl = freshness.feed_ttl(namespace, latest)
+            params['ttl'] = -(-ttl // 60)
+            body_ttl = params['ttl'] * 60
+
+        etag = feed_etag(latest, namespace, params)
+        response.headers['ETag'] = self._etag_header(etag, encoding)
+        if latest is not None:
+            response.headers['Last-Modified'] = http_date(latest.timestamp)
+        if ttl is not None:
+            response.headers['Cache-Control'] = freshness.cache_control(ttl, not context['user'])
+            response.headers['Retry-After'] = str(ttl)
+
+        if is_not_modified(request.headers, etag, latest and latest.timestamp):
+            response.status_int = 304
+            return None
+
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+
+        delta = self._delta_cursor(context, before, since)
+        if delta is not None:
+            # RFC 3229 feed delta: only send the activities newer than the
+            # version of the feed the client has
+            state = {}
+            body = ''.join(self.stream_feed(context, format, feed_version, sources,
+                                            0, limit, since=delta, state=state, page_url=page_url,
+                                            hub_topic=hub_topic, ttl=body_ttl, channel=channel))
+            if encoding is not None:
+                body = compression.compress(body, encoding)
+            if state['count'] == limit:
+                # there may be more new activities, the client gets them with its next request
+                newest = state['newest']
+                response.headers['ETag'] = self._etag_header(feed_etag(newest, namespace, params),
+                                                             encoding)
+                response.headers['Last-Modified'] = http_date(newest.timestamp)
+            response.status = '226 IM Used'
+            response.headers['IM'] = 'feed'
+            response.headers['Cache-Control'] = 'no-store, im'
+            return body
+
+        # the same user (or anyone, for the shared feeds) asking for the
+        # same feed gets the same bytes until a new activity arrives
+        cache_key = params_key(params)
+        with timer.stage('cache'):
+            if encoding is not None:
+                body = cache.feed_cache.get_encoded(namespace, cache_key, etag, encoding)
+            else:
+                body = cache.feed_cache.get(namespace, cache_key, etag)
+        if body is None:
+            # stream the feed, it is written after this controller returned
+            chunks = self.stream_feed(context, format, feed_version, sources,
+                                      offset, limit, before, since, page_url=page_url,
+                                      hub_topic=hub_topic, ttl=body_ttl, channel=channel)
+            chunks = cache.feed_cache.tee(namespace, cache_key, etag, chunks)
+            if encoding is not None:
+                # compressed as it is streamed, and cached next to the rendered feed
+                chunks = cache.feed_cache.tee(namespace, cache.encoded_key(cache_key, encoding), etag,
+                                              compression.compress_chunks(chunks, encoding))
+            body = closing_session(chunks)
+        return body
+
+    def _etag_header(self, etag, encoding):
+        '''
+        Return the ETag header of a feed: the compressed feeds have other
+        bytes than the rendered one, their entity tag is weak.
+        '''
+        if encoding is None:
+            return etag
+        return 'W/' + etag
 
-        return feed.writeString('utf-8')
+    def _delta_cursor(self, context, before, since):
+        '''
+        Return the cursor of the newest activity the client has if it
+        asks for a feed delta (A-IM: feed), or None.
+        '''
+        if before is not None or since is not None or not accepts_feed_delta(request.headers):
+            return None
+        activity_id = etag_activity_id(request.headers.get('If-None-Match'))
+        if activity_id is None:
+            return None
+        try:
+            return query.resolve_cursor(context, query.Cursor(None, activity_id))
+        except ValueError:
+            # the activity is gone, send the full feed
+            return None
+
+    def _mark_activities_old(self, context):
+        if self.mark_activities_old == 'always':
+            tk.get_action('dashboard_mark_activities_old')(context, {})
+        elif self.mark_activities_old == 'deferred':
+            marks.deferred_marks.add(c.userobj.id)
+            if marks.deferred_marks.due():
+                marks.deferred_marks.flush(model.Session)
+
+    def stream_feed(self, context, format, feed_version, sources, offset, limit,
+                    before=None, since=None, state=None, page_url=None, hub_topic=None,
+                    ttl=None, channel=None):
+        """
+        Renders the activities of the dashboard as a RSS or ATOM feed
+
+        Unlike the HTML dashboard, this only queries the activities: the
+        template variables (c.user_dict, c.followee_list, ...) are not set.
+
+        The feed is returned in chunks: the activities are read from the
+        database, enriched and written ``chunk_size`` at a time. Everything
+        that needs the request (translations, urls) is done before the
+        first chunk, so the chunks can be written after the request ended.
+        With a ``coalesce_window``, the bursts of activities on one object
+        are merged before they are enriched, see query.coalesce_activities.
+
+        :param state: if given, the number of activities of the feed and
+            the cursor of the newest one are stored in it as 'count' and
+            'newest' once the feed is written
+        :type state: dict
+        :param page_url: the url of the feed without the paging parameters,
+            the dashboard feed by default
+        :type page_url: string
+        :param hub_topic: if given, the feed advertises the WebSub hub of
+            the extension, with this url as its topic
+        :type hub_topic: string
+        :param ttl: if given, the number of seconds readers can wait before
+            polling the feed again, written in the feed
+        :type ttl: int
+        :param channel: the title, link and description of the feed, the
+            ones of the dashboard by default, see object_channel
+        :type channel: dict
+
+        :rtype: iterator of utf-8 strings
+        """
 
+        lang = current_lang()
+        prime_message_templates(context, lang)
+
+        stream_context = {'model': model, 'session': model.Session,
+                          'user': context['user'], 'for_view': True,
+                          'site_url': site_url(context), 'lang': lang,
+                          'burst_message': _('{msg} ({count} times)')}
+
+        timer = timing.current()
+        with timer.stage('query'):
+            activity_chunks = query.iter_activity_list(stream_context, sources, limit,
+                                                       offset, before, since, self.chunk_size)
+        activity_chunks = timer.iter('query', activity_chunks)
+        if self.coalesce_window is not None:
+            activity_chunks = query.coalesce_activities(activity_chunks, self.coalesce_window)
+
+        if page_url is None:
+            page_url = self._page_url(format, feed_version, sources)
+
+        writer = self.get_feed(feed_type=format, feed_version=feed_version, ttl=ttl,
+                               **(channel or {}))
+        if hub_topic is not None:
+            writer.feed['hub_url'] = websub.hub_url
+            writer.feed['self_url'] = hub_topic
+        return self._write_feed(stream_context, writer, activity_chunks,
+                                '%s&limit=%d' % (page_url, limit), limit, state)
+
+    def _write_feed(self, context, writer, activity_chunks, page_url, limit, state=None):
+        timer = timing.current()
+        count = 0
+        newest = oldest = None
+
+        for activity_stream in activity_chunks:
+            items = self.activity_list_to_feed(context, activity_stream)
+            started = timer.clock()
+            parts = []
+            if newest is None:
+                newest = activity_stream[0]
+                # RFC 5005 paging links: the previous page has the newer activities
+                writer.feed['previous_url'] = '%s&since=%s' % (page_url, urllib.quote(format_cursor(newest)))
+                parts.append(writer.start(items[0]))
+            parts.extend(writer.write_item(item) for item in items)
+            timer.add('serialize', started)
+            timer.count('items', len(items))
+            yield ''.join(parts)
+            # the coalesced activities count as many as they replace
+            count += sum(activity.get('count', 1) for activity in activity_stream)
+            oldest = activity_stream[-1].get('oldest', activity_stream[-1])
+
+        started = timer.clock()
+        parts = []
+        if newest is None:
+            parts.append(writer.start())
+
+        links = {}
+        if count == limit:
+            # ... and the next page the older ones
+            links['next'] = '%s&before=%s' % (page_url, urllib.quote(format_cursor(oldest)))
+        parts.append(writer.end(**links))
+        timer.add('serialize', started)
+        timer.count('activities', count)
+        yield ''.join(parts)
+
+        if state is not None:
+            state['count'] = count
+            state['newest'] = newest and query.activity_cursor(newest)
+
+    def _page_url(self, format, feed_version, sources=(), route=('dashboard_feed', {})):
+        params = [('format', format), ('version', feed_version)]
+        for filter_type, filter_id in sources:
+            if filter_type:
+                params.extend([('type', filter_type), ('name', filter_id)])
+        route_name, route_args = route
+        return '%s?%s' % (h.url_for(route_name, qualified=True, **route_args),
+                          urllib.urlencode([(k, unicode(v).encode('utf-8')) for k, v in params]))
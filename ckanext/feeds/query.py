@@ -0,0 +1,720 @@
+# encoding: utf-8
+""" Activity queries of the feeds """
+
+import logging
+log = logging.getLogger(__name__)
+
+import re
+import json
+import heapq
+import itertools
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import and_, or_, asc, desc, select, union, union_all, cast, exists, literal, \
+    false, func
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.types import UserDefinedType
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+from ckan.logic.action.get import _activity_stream_get_filtered_users
+from ckan.model.follower import user_following_user_table, \
+    user_following_dataset_table, user_following_group_table
+
+from ckanext.feeds import inbox
+
+
+# A position in an activity stream. Activities are ordered by timestamp,
+# and by id if they have the same timestamp.
+Cursor = namedtuple('Cursor', ['timestamp', 'id'])
+
+TIMESTAMP_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']
+
+ACTIVITY_ID = re.compile('^[0-9a-f-]{36}$')
+
+# the feeds of one object, any other filter type is the dashboard of the user
+OBJECT_FILTER_TYPES = ('dataset', 'user', 'group', 'organization')
+
+OBJECT_MODELS = {
+    'dataset': model.Package,
+    'user': model.User,
+    'group': model.Group,
+    'organization': model.Group,
+}
+
+# the actions whose authorization functions decide who sees an object
+SHOW_ACTIONS = {
+    'dataset': 'package_show',
+    'user': 'user_show',
+    'group': 'group_show',
+    'organization': 'organization_show',
+}
+
+
+def parse_cursor(value):
+    '''Parse a cursor as used in the before and since parameters
+
+    A cursor is 'timestamp,id', a timestamp alone or an activity id alone.
+    The timestamp of the latter is looked up by resolve_cursor.
+
+    :raises: ValueError if the value is not a valid cursor
+    '''
+    timestamp, _sep, activity_id = value.partition(',')
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return Cursor(datetime.strptime(timestamp, timestamp_format), activity_id or None)
+        except ValueError:
+            continue
+    if not activity_id and ACTIVITY_ID.match(value):
+        return Cursor(None, value)
+    raise ValueError('Invalid cursor: %s' % value)
+
+
+def parse_timestamp(value):
+    '''Parse the timestamp of an activity dictionary, as written by isoformat()
+
+    The fields are at fixed positions, '2016-06-30T15:42:52.663910' or
+    '2016-06-30T15:42:52' without microseconds, so they are sliced rather
+    than matched with strptime. Only for trusted values: unlike
+    parse_cursor, the separators are not checked.
+    '''
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                    int(value[20:26]) if len(value) > 19 else 0)
+
+
+def resolve_cursor(context, cursor):
+    '''Return the cursor with the timestamp of its activity if it only has an id
+
+    :raises: ValueError if there is no such activity
+    '''
+    if cursor is None or cursor.timestamp is not None:
+        return cursor
+    timestamp = context['session'].query(model.Activity.timestamp) \
+        .filter(model.Activity.id == cursor.id).scalar()
+    if timestamp is None:
+        raise ValueError('Unknown activity: %s' % cursor.id)
+    return Cursor(timestamp, cursor.id)
+
+
+def format_cursor(activity):
+    '''Return the cursor of an activity dictionary.'''
+    return u'%s,%s' % (activity['timestamp'], activity['id'])
+
+
+def activity_cursor(activity):
+    '''Return the Cursor of an activity dictionary.'''
+    return parse_cursor(format_cursor(activity))
+
+
+# The columns of the activities of the feeds...
+ACTIVITY_COLUMNS = ['id', 'timestamp', 'user_id', 'object_id', 'revision_id', 'activity_type']
+
+# ... and the paths of their data the snippets read, see the rss_snippet_*
+# functions of the plugin. Paths of one key are whole objects, the others
+# text values.
+FEED_DATA_PATHS = [
+    ('package', 'name'),
+    ('dataset', 'name'),
+    ('group', 'id'),
+    ('group', 'name'),
+    ('group', 'title'),
+    ('related',),
+]
+
+
+def _json_type(session):
+    '''Return the type the database reads paths of the activity data as,
+    jsonb, json, or None if it can't.'''
+    dialect = session.get_bind().dialect
+    version = dialect.server_version_info or ()
+    if dialect.name != 'postgresql' or version < (9, 3):
+        return None
+    # jsonb is parsed once, json again by every path read from it
+    return 'jsonb' if version >= (9, 4) else 'json'
+
+
+class _JSONB(UserDefinedType):
+    # the jsonb type for the versions of SQLAlchemy that don't have it
+    def get_col_spec(self):
+        return 'JSONB'
+
+
+def _set_path(data, path, value):
+    if value is None:
+        return
+    if len(path) == 1:
+        data[path[0]] = value
+    else:
+        data.setdefault(path[0], {})[path[1]] = value
+
+
+def project_data(data):
+    '''Return the parts of an activity data the feeds read.'''
+    projected = {}
+    for path in FEED_DATA_PATHS:
+        value = data
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        _set_path(projected, path, value)
+    return projected
+
+
+def activity_rows(session, page, ascending=False):
+    '''Return the query of the activities of a feed page, and the function
+    returning the projected data of one of its rows
+
+    Activity.data is a snapshot of the whole dataset or group, with all its
+    resources and extras. On PostgreSQL only the paths of FEED_DATA_PATHS
+    are read from it: the data of every row of the page is cast once, in a
+    subquery, and the paths are read from the cast value. Other databases
+    decode the data of every row.
+
+    :param page: the query of the activities of the page, ordered and
+        limited, see _activity_chunks
+    :param ascending: the order of the page, oldest first or newest first
+    '''
+    columns = [getattr(model.Activity, name) for name in ACTIVITY_COLUMNS]
+
+    json_type = _json_type(session)
+    if json_type is None:
+        q = page.with_entities(*(columns + [model.Activity.data]))
+        return q, lambda row: project_data(row.data or {})
+
+    data_type = _JSONB() if json_type == 'jsonb' else postgresql.JSON()
+    extract_path_text = getattr(func, '%s_extract_path_text' % json_type)
+    # the limit of the page keeps PostgreSQL from inlining the subquery, and
+    # casting the data again for every path
+    rows = page.with_entities(*(columns + [cast(model.Activity.data, data_type).label('data')])) \
+        .subquery()
+    q = session.query(*([getattr(rows.c, name) for name in ACTIVITY_COLUMNS] + [
+        extract_path_text(rows.c.data, *path).label('data_%s' % '_'.join(path))
+        for path in FEED_DATA_PATHS
+    ])).order_by(*cursor_order(rows.c.timestamp, rows.c.id, ascending))
+
+    def row_data(row):
+        projected = {}
+        for path, value in zip(FEED_DATA_PATHS, row[len(ACTIVITY_COLUMNS):]):
+            if len(path) == 1 and value is not None:
+                # whole objects come as json text
+                value = json.loads(value)
+            _set_path(projected, path, value)
+        return projected
+    return q, row_data
+
+
+def activity_row_dictize(row, data):
+    '''Return an activity row like activity_dictize, with the given data.'''
+    return {
+        'id': row.id,
+        'timestamp': row.timestamp.isoformat(),
+        'user_id': row.user_id,
+        'object_id': row.object_id,
+        'revision_id': row.revision_id,
+        'activity_type': row.activity_type,
+        'data': data,
+    }
+
+
+def _user_id(context):
+    '''Return the id of the user of the context.'''
+    user = context.get('auth_user_obj') or model.User.by_name(context['user'])
+    return user.id
+
+
+def object_id(model_class, ref):
+    '''Return the id of the dataset, user or group with the given name or id.
+
+    :raises: ckan.plugins.toolkit.ObjectNotFound if there is no such object
+    '''
+    obj = model_class.get(ref)
+    if obj is None:
+        raise tk.ObjectNotFound
+    return obj.id
+
+
+# ---------------------------------------------------------------------------
+# The activities of a feed are the union of one or more simple queries, the
+# branches, that can each use an index on activity.timestamp. They follow the
+# rules of the queries of ckan.model.activity.
+# ---------------------------------------------------------------------------
+
+def _activities(session):
+    return session.query(model.Activity)
+
+
+def _public_dataset_activities(session):
+    return _activities(session) \
+        .join(model.Package, model.Package.id == model.Activity.object_id) \
+        .filter(model.Package.private == False)
+
+
+def _group_dataset_activities(session, group_ids):
+    '''The activities of the public datasets of the groups.'''
+    return _public_dataset_activities(session) \
+        .join(model.Member, model.Member.table_id == model.Activity.object_id) \
+        .filter(model.Member.group_id.in_(group_ids)) \
+        .filter(model.Member.table_name == 'package') \
+        .filter(model.Member.state == 'active')
+
+
+def _followee_ids(table, user_id):
+    return select([table.c.object_id]).where(table.c.follower_id == user_id)
+
+
+def dataset_branches(session, package_id):
+    return [_activities(session).filter(model.Activity.object_id == package_id)]
+
+
+def user_branches(session, user_id):
+    return [
+        _activities(session).filter(model.Activity.user_id == user_id),
+        _activities(session).filter(model.Activity.object_id == user_id),
+    ]
+
+
+def group_branches(session, group_id):
+    return [
+        _activities(session).filter(model.Activity.object_id == group_id),
+        _group_dataset_activities(session, [group_id]),
+    ]
+
+
+def organization_branches(session, org_id):
+    return [
+        _activities(session).filter(model.Activity.object_id == org_id),
+        _public_dataset_activities(session).filter(model.Package.owner_org == org_id),
+    ]
+
+
+def dashboard_branches(session, user_id):
+    followed_users = _followee_ids(user_following_user_table, user_id)
+    followed_datasets = _followee_ids(user_following_dataset_table, user_id)
+    followed_groups = _followee_ids(user_following_group_table, user_id)
+    return user_branches(session, user_id) + [
+        _activities(session).filter(model.Activity.user_id.in_(followed_users)),
+        _activities(session).filter(model.Activity.object_id.in_(followed_users)),
+        _activities(session).filter(model.Activity.object_id.in_(followed_datasets)),
+        _activities(session).filter(model.Activity.object_id.in_(followed_groups)),
+        _group_dataset_activities(session, followed_groups),
+    ]
+
+
+OBJECT_BRANCHES = {
+    'dataset': dataset_branches,
+    'user': user_branches,
+    'group': group_branches,
+    'organization': organization_branches,
+}
+
+
+def public_object(filter_type, object_id):
+    '''Return True if anyone, logged in or not, can see the object.'''
+    context = {'model': model, 'session': model.Session, 'user': ''}
+    try:
+        tk.check_access(SHOW_ACTIONS[filter_type], context, {'id': object_id})
+    except tk.NotAuthorized:
+        return False
+    return True
+
+
+def feed_branches(context, filter_type, filter_id):
+    '''Return the queries whose union are the activities of a feed
+
+    :param context: context dictionary
+    :type context: dict
+    :param filter_type: 'dataset', 'user', 'group', 'organization' or
+        anything else for the dashboard of the logged in user
+    :type filter_type: string
+    :param filter_id: the name or id of the object to filter for
+    :type filter_id: string
+
+    :raises: ckan.plugins.toolkit.ObjectNotFound if there is no such object,
+        ckan.plugins.toolkit.NotAuthorized if the user can't see it
+    :rtype: list of queries of model.Activity
+    '''
+
+    session = context['session']
+
+    if filter_type not in OBJECT_FILTER_TYPES:
+        branches = dashboard_branches(session, _user_id(context))
+    else:
+        obj_id = object_id(OBJECT_MODELS[filter_type], filter_id)
+        tk.check_access(SHOW_ACTIONS[filter_type], context, {'id': obj_id})
+        branches = OBJECT_BRANCHES[filter_type](session, obj_id)
+    return _visible(branches)
+
+
+def followees_key(context):
+    '''Return a string that changes whenever the logged in user follows or
+    unfollows a user, dataset or group: the number of their follows and the
+    time of the newest one.'''
+    user_id = _user_id(context)
+    follows = union_all(*[
+        select([table.c.datetime]).where(table.c.follower_id == user_id)
+        for table in (user_following_user_table, user_following_dataset_table,
+                      user_following_group_table)
+    ]).alias('follows')
+    count, newest = context['session'].execute(
+        select([func.count(), func.max(follows.c.datetime)])).first()
+    return u'%d,%s' % (count, newest.isoformat() if newest else u'')
+
+
+def _visible(branches):
+    # like the *_activity_list actions, hide the activities of the site user
+    hidden_users = _activity_stream_get_filtered_users()
+    if hidden_users:
+        branches = [b.filter(~model.Activity.user_id.in_(hidden_users)) for b in branches]
+    return branches
+
+
+def cursor_order(timestamp_column, id_column, ascending=False):
+    '''Return the order of activities by cursor, newest first unless ``ascending``.'''
+    direction = asc if ascending else desc
+    return [direction(timestamp_column), direction(id_column)]
+
+
+def after_cursor(cursor, timestamp_column=model.Activity.timestamp, id_column=model.Activity.id):
+    '''Return the condition of the activities newer than a Cursor.'''
+    if cursor.id is None:
+        return timestamp_column > cursor.timestamp
+    return or_(timestamp_column > cursor.timestamp,
+               and_(timestamp_column == cursor.timestamp, id_column > cursor.id))
+
+
+def before_cursor(cursor, timestamp_column=model.Activity.timestamp, id_column=model.Activity.id):
+    '''Return the condition of the activities older than a Cursor.'''
+    if cursor.id is None:
+        return timestamp_column < cursor.timestamp
+    return or_(timestamp_column < cursor.timestamp,
+               and_(timestamp_column == cursor.timestamp, id_column < cursor.id))
+
+
+def _union(branches, limit, before=None, since=None, ascending=False):
+    '''Return the ids and timestamps of the first activities of all the branches.'''
+    selects = []
+    for branch in branches:
+        branch = branch.with_entities(model.Activity.id, model.Activity.timestamp)
+        if before is not None:
+            branch = branch.filter(before_cursor(before))
+        if since is not None:
+            branch = branch.filter(after_cursor(since))
+        branch = branch.order_by(*cursor_order(model.Activity.timestamp, model.Activity.id, ascending))
+        selects.append(branch.limit(limit).subquery().select())
+    if len(selects) == 1:
+        return selects[0].alias('feed_activities')
+    return union(*selects).alias('feed_activities')
+
+
+def _inbox(user_id, limit, before=None, since=None, ascending=False):
+    '''Return the ids and timestamps of the first activities of the inbox of a user.'''
+    table = inbox.inbox_table
+    q = select([table.c.activity_id.label('id'), table.c.timestamp]) \
+        .where(table.c.user_id == user_id)
+    if before is not None:
+        q = q.where(before_cursor(before, table.c.timestamp, table.c.activity_id))
+    if since is not None:
+        q = q.where(after_cursor(since, table.c.timestamp, table.c.activity_id))
+    q = q.order_by(*cursor_order(table.c.timestamp, table.c.activity_id, ascending))
+    return q.limit(limit).alias('feed_activities')
+
+
+def feed_activities(context, sources, limit, before=None, since=None, ascending=False):
+    '''Return the ids and timestamps of the first activities of a feed
+
+    The dashboard feeds are read from the inbox of the user if it is
+    enabled, the other feeds (and the dashboards otherwise) from the union
+    of their branches. The feeds of several sources are merged, see
+    _merged.
+
+    :param sources: the (filter_type, filter_id) pairs of the feed, see
+        feed_branches
+    :type sources: list of tuples
+
+    :raises: see feed_branches
+    :rtype: an aliased select with id and timestamp columns
+    '''
+    if len(sources) > 1:
+        return _merged(context, sources, limit, before, since, ascending)
+    filter_type, filter_id = sources[0]
+    if inbox.enabled and filter_type not in OBJECT_FILTER_TYPES:
+        return _inbox(_user_id(context), limit, before, since, ascending)
+    return _union(feed_branches(context, filter_type, filter_id), limit, before, since, ascending)
+
+
+class _Newest(object):
+    '''Orders cursors newest first, so heapq pops the newest activity.'''
+
+    __slots__ = ('cursor',)
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __lt__(self, other):
+        return self.cursor > other.cursor
+
+    def __eq__(self, other):
+        return self.cursor == other.cursor
+
+
+def merge_activities(streams, limit, ascending=False):
+    '''Merge ordered activity streams into one, without duplicates
+
+    A k-way merge: only the current activity of every stream is held, and
+    the streams are read no further than the ``limit`` merged activities
+    need.
+
+    :param streams: iterables of rows with id and timestamp, each ordered
+        newest first (oldest first if ascending)
+    :param limit: the maximum number of activities
+    :type limit: int
+
+    :rtype: iterator of rows, newest first (oldest first if ascending)
+    '''
+    key = Cursor if ascending else lambda timestamp, id: _Newest(Cursor(timestamp, id))
+
+    heap = []
+    for index, stream in enumerate(streams):
+        stream = iter(stream)
+        for row in stream:
+            # the index breaks ties, so the rows are never compared
+            heap.append((key(row.timestamp, row.id), index, row, stream))
+            break
+    heapq.heapify(heap)
+
+    seen = set()
+    while heap and len(seen) < limit:
+        _key, index, row, stream = heap[0]
+        if row.id not in seen:
+            # the same activity can be in several of the feeds
+            seen.add(row.id)
+            yield row
+        for row in stream:
+            heapq.heapreplace(heap, (key(row.timestamp, row.id), index, row, stream))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def _merged(context, sources, limit, before=None, since=None, ascending=False):
+    '''Return the ids and timestamps of the first activities of the merged
+    feeds of several sources
+
+    Only the ids and timestamps of the first ``limit`` activities of every
+    source are read, and they are merged by merge_activities.
+    '''
+    session = context['session']
+
+    # check the access to all the sources before reading any of them
+    streams = []
+    for source in sources:
+        activities = feed_activities(context, [source], limit, before, since, ascending)
+        streams.append(session.query(activities.c.id, activities.c.timestamp)
+                       .order_by(*cursor_order(activities.c.timestamp, activities.c.id, ascending)))
+
+    ids = [row.id for row in merge_activities(streams, limit, ascending)]
+    q = select([model.activity_table.c.id, model.activity_table.c.timestamp])
+    q = q.where(model.activity_table.c.id.in_(ids)) if ids else q.where(false())
+    return q.alias('feed_activities')
+
+
+def latest_activity(context, sources):
+    '''Return the newest activity of a feed without loading its data
+
+    The newest activity of several sources is the newest of the newest
+    activity of each of them, see _merged.
+
+    :param sources: the (filter_type, filter_id) pairs of the feed, see
+        feed_branches
+    :type sources: list of tuples
+
+    :raises: see feed_branches
+    :rtype: a (id, timestamp) row, or None if the feed is empty
+    '''
+    activities = feed_activities(context, sources, 1)
+    return context['session'].query(activities.c.id, activities.c.timestamp) \
+        .order_by(*cursor_order(activities.c.timestamp, activities.c.id)) \
+        .first()
+
+
+def iter_activity_list(context, sources, limit, offset=0, before=None,
+                       since=None, chunk_size=50):
+    '''Return a page of the activities of a feed as chunks, newest first
+
+    Pages are selected with the before and since cursors, so the database
+    only reads the rows of the page. With only ``since``, the page is the
+    one right after the cursor. The rows are streamed from the database
+    and dictized ``chunk_size`` at a time. The activities only have the
+    data the feeds read, see activity_rows.
+
+    :param sources: the (filter_type, filter_id) pairs of the feed, see
+        feed_activities
+    :type sources: list of tuples
+    :param limit: the maximum number of activities
+    :type limit: int
+    :param offset: the number of activities to skip
+    :type offset: int
+    :param before: only return activities older than this cursor
+    :type before: Cursor
+    :param since: only return activities newer than this cursor
+    :type since: Cursor
+    :param chunk_size: the number of activities of each chunk
+    :type chunk_size: int
+
+    :raises: see feed_branches
+    :rtype: iterator of lists of activity dictionaries
+    '''
+
+    ascending = since is not None and before is None
+
+    # check the access and read when the user last viewed their dashboard
+    # now, the chunks may be read after the request ended
+    activities = feed_activities(context, sources, limit + offset, before, since, ascending)
+
+    user_id = last_viewed = None
+    if any(filter_type not in OBJECT_FILTER_TYPES for filter_type, _filter_id in sources):
+        user_id = _user_id(context)
+        last_viewed = model.Dashboard.get(user_id).activity_stream_last_viewed
+
+    return _activity_chunks(context, activities, limit, offset, ascending, chunk_size,
+                            user_id, last_viewed)
+
+
+def _activity_chunks(context, activities, limit, offset, ascending, chunk_size,
+                     user_id=None, last_viewed=None):
+    session = context['session']
+    page = session.query(model.Activity.id) \
+        .join(activities, activities.c.id == model.Activity.id) \
+        .order_by(*cursor_order(activities.c.timestamp, activities.c.id, ascending)) \
+        .offset(offset).limit(limit)
+    q, row_data = activity_rows(session, page, ascending)
+
+    if ascending:
+        # the page has to be read entirely to be returned newest first
+        activity_rows = q.all()
+        activity_rows.reverse()
+    else:
+        activity_rows = q.yield_per(chunk_size)
+
+    for chunk in _chunks(activity_rows, chunk_size):
+        activity_dicts = []
+        for row in chunk:
+            activity = activity_row_dictize(row, row_data(row))
+            if last_viewed is not None:
+                # Mark the new (not yet seen by user) activities, like dashboard_activity_list
+                # Never mark the user's own activities as new.
+                activity['is_new'] = row.user_id != user_id and row.timestamp > last_viewed
+            activity_dicts.append(activity)
+        yield activity_dicts
+
+
+def activity_list(context, sources, limit, offset=0, before=None, since=None):
+    '''Return a page of the activities of a feed, newest first
+
+    See iter_activity_list.
+
+    :rtype: list of activity dictionaries
+    '''
+    return list(itertools.chain.from_iterable(
+        iter_activity_list(context, sources, limit, offset, before, since)
+    ))
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for obj in iterable:
+        chunk.append(obj)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def coalesce_activities(activity_chunks, window):
+    '''Merge the bursts of activities of one object into one activity
+
+    Consecutive activities of the same type on the same object, within
+    ``window`` of the newest of them, e.g. a harvester changing a dataset
+    50 times in a minute, become the newest of them with a ``count``, and
+    the oldest of them as ``oldest`` for the paging links.
+
+    :param activity_chunks: the activities, newest first, see
+        iter_activity_list
+    :type activity_chunks: iterator of lists of activity dictionaries
+    :param window: the maximum time between the newest and the oldest
+        activity of a burst
+    :type window: datetime.timedelta
+
+    :rtype: iterator of lists of activity dictionaries
+    '''
+    burst = newest = None
+    for chunk in activity_chunks:
+        coalesced = []
+        for activity in chunk:
+            timestamp = activity_cursor(activity).timestamp
+            if burst is not None and activity['object_id'] == burst['object_id'] and \
+                    activity['activity_type'] == burst['activity_type'] and \
+                    newest - timestamp <= window:
+                burst['count'] += 1
+                burst['oldest'] = activity
+                continue
+            if burst is not None:
+                coalesced.append(burst)
+            burst, newest = activity, timestamp
+            burst['count'] = 1
+        if coalesced:
+            yield coalesced
+    # the last burst may go on in the next chunk, it is only complete at the end
+    if burst is not None:
+        yield [burst]
+
+
+# ---------------------------------------------------------------------------
+# Maintenance of the inboxes, see ckanext.feeds.commands
+# ---------------------------------------------------------------------------
+
+def backfill_inbox(session, user_id, limit=None):
+    '''Add the activities of the dashboard of a user missing from their inbox
+
+    :param limit: only add the newest ``limit`` activities of the dashboard,
+        all of them if None
+    :returns: the number of activities added
+    '''
+    table = inbox.inbox_table
+    activities = _union(_visible(dashboard_branches(session, user_id)), limit)
+    missing = select([literal(user_id), activities.c.timestamp, activities.c.id]).where(
+        ~exists().where(and_(table.c.user_id == user_id, table.c.activity_id == activities.c.id))
+    )
+    result = session.execute(
+        table.insert().from_select(['user_id', 'timestamp', 'activity_id'], missing)
+    )
+    return result.rowcount
+
+
+def check_inbox(session, user_id, limit=100):
+    '''Compare the inbox of a user with their dashboard as queried on the fly
+
+    Looks at the newest ``limit`` activities of the dashboard, and at the
+    activities of the inbox since the oldest of them.
+
+    :returns: the ids of the activities missing from the inbox, and the
+        ids of the activities the inbox should not have
+    :rtype: (set, set)
+    '''
+    dashboard = _union(_visible(dashboard_branches(session, user_id)), limit)
+    expected = session.query(dashboard.c.id, dashboard.c.timestamp) \
+        .order_by(*cursor_order(dashboard.c.timestamp, dashboard.c.id)) \
+        .limit(limit).all()
+
+    table = inbox.inbox_table
+    q = select([table.c.activity_id]).where(table.c.user_id == user_id)
+    if len(expected) == limit:
+        q = q.where(table.c.timestamp >= expected[-1].timestamp)
+    else:
+        q = q.order_by(*cursor_order(table.c.timestamp, table.c.activity_id)).limit(limit)
+    actual = set(row[0] for row in session.execute(q))
+
+    expected = set(row.id for row in expected)
+    return expected - actual, actual - expected
@@ -0,0 +1,18 @@
+# encoding: utf-8
+""" Streaming of the feeds """
+
+import ckan.model as model
+
+
+def closing_session(chunks):
+    '''
+    Remove the database session of the thread once the chunks are written.
+
+    A streamed response is written after the controller removed the
+    session of the request, the chunks then use a session of their own.
+    '''
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        model.Session.remove()
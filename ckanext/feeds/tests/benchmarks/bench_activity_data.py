@@ -0,0 +1,105 @@
+# encoding: utf-8
+'''
+Cost of reading the data of the activities of a feed page on PostgreSQL.
+
+Creates the synthetic data of bench_feeds.py (wide snapshots, see its
+--extras and --notes options), then reads pages of the newest activities
+with their projected data, see ckanext.feeds.query.activity_rows:
+
+- whole: the whole snapshots, decoded in Python
+- per path: a cast of the snapshot for every path of FEED_DATA_PATHS
+- cast once: the snapshot of every row cast once, the paths read from it
+
+and prints the median and 90th percentile of each, in milliseconds, and
+the server execution time reported by EXPLAIN ANALYZE. Run from the
+extension directory with the CKAN test configuration::
+
+    python ckanext/feeds/tests/benchmarks/bench_activity_data.py -c test.ini
+'''
+
+import os
+import sys
+from timeit import default_timer as clock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_feeds import parse_args, load_app, create_data, summary
+
+
+def page_query(session, limit):
+    import ckan.model as model
+    from ckanext.feeds import query
+
+    return session.query(model.Activity.id) \
+        .order_by(*query.cursor_order(model.Activity.timestamp, model.Activity.id)) \
+        .limit(limit)
+
+
+def whole(session, limit):
+    import ckan.model as model
+    from ckanext.feeds import query
+
+    q = page_query(session, limit).with_entities(model.Activity.id, model.Activity.data)
+    return q, lambda row: query.project_data(row.data or {})
+
+
+def per_path(session, limit):
+    import ckan.model as model
+    from sqlalchemy import cast
+    from sqlalchemy.dialects import postgresql
+    from ckanext.feeds import query
+
+    data = cast(model.Activity.data, postgresql.JSON)
+    q = page_query(session, limit).with_entities(model.Activity.id, *[
+        data[path].astext for path in query.FEED_DATA_PATHS])
+    return q, lambda row: row
+
+
+def cast_once(session, limit):
+    from ckanext.feeds import query
+
+    return query.activity_rows(session, page_query(session, limit))
+
+
+VARIANTS = [('whole', whole), ('per path', per_path), ('cast once', cast_once)]
+
+
+def server_ms(session, q):
+    '''Return the execution time of a query reported by EXPLAIN ANALYZE.'''
+    statement = q.statement.compile(dialect=session.get_bind().dialect,
+                                    compile_kwargs={'literal_binds': True})
+    plan = session.execute('EXPLAIN ANALYZE %s' % statement).fetchall()
+    for (line,) in plan:
+        if line.startswith(('Execution time', 'Execution Time', 'Total runtime')):
+            return float(line.split(':')[1].split()[0])
+    return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    load_app(args.config)
+
+    import ckan.model as model
+    from ckanext.feeds import query
+
+    if query._json_type(model.Session) is None:
+        sys.exit('The activity data is only read by path on PostgreSQL 9.3 or later')
+    create_data(args)
+    session = model.Session
+
+    for name, variant in VARIANTS:
+        latencies, server = [], []
+        for n in range(args.requests):
+            q, row_data = variant(session, args.limit)
+            started = clock()
+            for row in q:
+                row_data(row)
+            latencies.append((clock() - started) * 1000)
+            server.append(server_ms(session, q))
+        stats = summary(latencies)
+        sys.stderr.write('%-10s p50 %7.2f ms  p90 %7.2f ms  server p50 %7.2f ms\n' % (
+            name, stats['p50'], stats['p90'], summary(server)['p50']))
+
+
+if __name__ == '__main__':
+    main()
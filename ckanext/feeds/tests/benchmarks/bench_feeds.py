@@ -0,0 +1,365 @@
+# encoding: utf-8
+'''
+Benchmark of the feeds against the test database.
+
+Creates synthetic users, groups, organizations and datasets with wide
+snapshots (many extras and long descriptions), their activity histories
+and the follows of the users, then requests every feed format and filter
+type, with an empty and with a warm feed cache. For every case it measures
+the latency percentiles, the SQL queries, the size of the feeds, the
+durations of the stages of the feed pipeline (see ckanext.feeds.timing,
+activity_list_to_feed is the details, names and snippets stages) and the
+peak memory of a request, and writes them as a JSON report. Run from the
+extension directory with the CKAN test configuration::
+
+    python ckanext/feeds/tests/benchmarks/bench_feeds.py -c test.ini --report feeds.json
+
+The sizes of the data are options, see --help. The script rebuilds the
+database of the configuration, like the tests: never run it against a
+database with data to keep. Compare two reports with --compare.
+'''
+
+import os
+import sys
+import json
+import random
+import platform
+import argparse
+from datetime import datetime
+from timeit import default_timer as clock
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2: the growth of the resident memory of a child process
+    tracemalloc = None
+import resource
+
+
+FORMATS = [('atom', '2.01'), ('rss', '2.01'), ('rss', '0.91'), ('json', '1.1')]
+
+FILTERS = ['dashboard', 'dataset', 'user', 'group', 'organization', 'merged',
+           'object:dataset', 'object:group', 'object:organization']
+
+# the metrics of two reports that --compare reports
+COMPARED = [('latency_ms', 'p50'), ('latency_ms', 'p90'), ('sql', 'mean')]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-c', '--config', default='test.ini', help='the CKAN test configuration')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--groups', type=int, default=3)
+    parser.add_argument('--datasets', type=int, default=30)
+    parser.add_argument('--activities', type=int, default=10,
+                        help='the number of changes of every dataset')
+    parser.add_argument('--follows', type=int, default=10,
+                        help='the number of datasets, and of users, every user follows')
+    parser.add_argument('--extras', type=int, default=50,
+                        help='the number of extras of every dataset')
+    parser.add_argument('--notes', type=int, default=5000,
+                        help='the length of the description of every dataset')
+    parser.add_argument('--limit', type=int, default=31, help='the number of items of the feeds')
+    parser.add_argument('--requests', type=int, default=20, help='the number of requests of every case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--report', help='the file of the JSON report, stdout by default')
+    parser.add_argument('--compare', metavar='REPORT',
+                        help='a previous report to compare the latencies and queries with')
+    return parser.parse_args(argv)
+
+
+def load_app(config_file):
+    '''Load the configuration and return the CKAN application with the feeds plugin.'''
+    import webtest
+    from paste.deploy import appconfig
+
+    conf = appconfig('config:' + os.path.abspath(config_file))
+
+    from ckan.config.middleware import make_app
+    import ckan.plugins as p
+
+    app = webtest.TestApp(make_app(conf.global_conf, **conf.local_conf))
+    if not p.plugin_loaded('feeds'):
+        p.load('feeds')
+    return app
+
+
+def create_data(args):
+    '''Create the synthetic users, groups, datasets, activities and follows
+
+    :returns: the names of the users, groups, organization and datasets
+    :rtype: dict
+    '''
+    import ckan.model as model
+    import ckan.tests.factories as factories
+    import ckan.tests.helpers as testhelpers
+
+    rnd = random.Random(args.seed)
+    model.repo.rebuild_db()
+
+    users = [factories.User() for i in range(args.users)]
+    members = [{'name': user['id'], 'capacity': 'admin'} for user in users]
+    org = factories.Organization(users=members)
+    groups = [factories.Group(users=members) for i in range(args.groups)]
+
+    # wide snapshots: the activities store the whole dataset
+    notes = u''.join(rnd.choice(u'abcdefghij ') for i in range(args.notes))
+    extras = [{'key': u'extra_%d' % i, 'value': notes[:100]} for i in range(args.extras)]
+
+    datasets = []
+    for i in range(args.datasets):
+        datasets.append(factories.Dataset(
+            user=users[i % len(users)], owner_org=org['id'], notes=notes, extras=extras,
+            groups=[{'id': groups[i % len(groups)]['id']}] if groups else [],
+        ))
+
+    for n in range(args.activities):
+        for dataset in datasets:
+            actor = rnd.choice(users)
+            testhelpers.call_action('package_patch', context={'user': actor['name']},
+                                    id=dataset['id'], notes=u'%s %d' % (notes, n))
+
+    for user in users:
+        context = {'user': user['name']}
+        for dataset in rnd.sample(datasets, min(args.follows, len(datasets))):
+            testhelpers.call_action('follow_dataset', context=context, id=dataset['id'])
+        others = [u for u in users if u['id'] != user['id']]
+        for other in rnd.sample(others, min(args.follows, len(others))):
+            testhelpers.call_action('follow_user', context=context, id=other['id'])
+        for group in groups[:1]:
+            testhelpers.call_action('follow_group', context=context, id=group['id'])
+
+    return {
+        'users': [user['name'] for user in users],
+        'groups': [group['name'] for group in groups],
+        'organization': org['name'],
+        'datasets': [dataset['name'] for dataset in datasets],
+    }
+
+
+def feed_request(data, filter_type, format, version, limit, n):
+    '''Return the url, parameters and user of the n-th request of a case.'''
+    users, datasets, groups = data['users'], data['datasets'], data['groups']
+    user = users[n % len(users)]
+    params = [('format', format), ('version', version), ('limit', limit), ('mark_old', 'false')]
+
+    if filter_type.startswith('object:'):
+        object_type = filter_type.split(':')[1]
+        name = {
+            'dataset': datasets[n % len(datasets)],
+            'group': groups[n % len(groups)] if groups else None,
+            'organization': data['organization'],
+        }[object_type]
+        return '/feeds/%s/%s/activity' % (object_type, name), params, None
+
+    if filter_type == 'dataset':
+        params.extend([('type', 'dataset'), ('name', datasets[n % len(datasets)])])
+    elif filter_type == 'user':
+        params.extend([('type', 'user'), ('name', users[(n + 1) % len(users)])])
+    elif filter_type == 'group' and groups:
+        params.extend([('type', 'group'), ('name', groups[n % len(groups)])])
+    elif filter_type == 'organization':
+        params.extend([('type', 'organization'), ('name', data['organization'])])
+    elif filter_type == 'merged':
+        params.extend([('type', 'dataset'), ('name', datasets[n % len(datasets)]),
+                       ('type', 'organization'), ('name', data['organization'])])
+    return '/dashboard', params, user
+
+
+class QueryCounter(object):
+
+    '''Counts the SQL statements sent to the database.'''
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def summary(values):
+    from ckanext.feeds.timing import percentile
+    ordered = sorted(values)
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / float(len(ordered)),
+        'p50': percentile(ordered, 50),
+        'p90': percentile(ordered, 90),
+        'p99': percentile(ordered, 99),
+        'max': ordered[-1],
+    }
+
+
+def resident_kb():
+    '''Return the resident memory of the process in KiB, or None if unknown.'''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() / 1024
+
+
+def peak_memory_kb(app, url, params, extra_environ):
+    '''Return the peak memory of one request in KiB, or None if it can't be measured.'''
+    if tracemalloc is None:
+        return forked_peak_memory_kb(app, url, params, extra_environ)
+    tracemalloc.start()
+    try:
+        app.get(url, params=params, extra_environ=extra_environ)
+        return tracemalloc.get_traced_memory()[1] / 1024.0
+    finally:
+        tracemalloc.stop()
+
+
+def forked_peak_memory_kb(app, url, params, extra_environ):
+    '''
+    Run one request in a child process and return how much its resident
+    memory grew past the memory it had at the fork, in KiB: the high-water
+    mark of the benchmark process itself says nothing of one request.
+    '''
+    import ckan.model as model
+
+    if resident_kb() is None or not hasattr(os, 'fork'):
+        return None
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            # the pooled connections belong to the parent, open new ones
+            model.meta.engine.pool = model.meta.engine.pool.recreate()
+            before = resident_kb()
+            app.get(url, params=params, extra_environ=extra_environ)
+            # the high-water mark of the child, in KiB on Linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write_fd, str(max(peak - before, 0)))
+        finally:
+            # no cleanup: it would close the connections of the parent
+            os._exit(0)
+    os.close(write_fd)
+    try:
+        with os.fdopen(read_fd) as f:
+            answer = f.read()
+    finally:
+        os.waitpid(pid, 0)
+    return int(answer) if answer else None
+
+
+def run_case(app, data, counter, filter_type, format, version, args, warm):
+    from ckanext.feeds import cache, timing
+
+    cache.feed_cache = cache.MemoryFeedCache() if warm else cache.NullFeedCache()
+
+    requests = []
+    for n in range(args.requests):
+        url, params, user = feed_request(data, filter_type, format, version, args.limit, n)
+        environ = {'REMOTE_USER': user.encode('ascii')} if user else {}
+        requests.append((url, params, environ))
+        if warm:
+            # fill the cache
+            app.get(url, params=params, extra_environ=environ)
+
+    timing.stats.clear()
+    latencies, queries, sizes = [], [], []
+    for url, params, environ in requests:
+        counter.count = 0
+        started = clock()
+        resp = app.get(url, params=params, extra_environ=environ)
+        latencies.append((clock() - started) * 1000)
+        queries.append(counter.count)
+        sizes.append(len(resp.body))
+
+    stages = timing.stats.stats()
+    memory = peak_memory_kb(app, *requests[0])
+
+    return {
+        'filter': filter_type,
+        'format': format,
+        'version': version,
+        'cache': 'warm' if warm else 'cold',
+        'latency_ms': summary(latencies),
+        'sql': summary(queries),
+        'bytes': summary(sizes),
+        'stages_ms': stages['durations'],
+        'counters': stages['counters'],
+        'peak_memory_kb': memory,
+        # the Python allocations of the request, or the growth of the
+        # resident memory of a process running it
+        'peak_memory': 'traced' if tracemalloc is not None else 'resident',
+    }
+
+
+def compare(report, previous):
+    '''Print the changes of the latencies and queries since a previous report.'''
+    def key(case):
+        return case['filter'], case['format'], case['version'], case['cache']
+    before = dict((key(case), case) for case in previous['cases'])
+    for case in report['cases']:
+        old = before.get(key(case))
+        if old is None:
+            continue
+        changes = []
+        for metric, stat in COMPARED:
+            a, b = old[metric][stat], case[metric][stat]
+            changes.append('%s %s %.1f -> %.1f (%+.0f%%)' % (
+                metric, stat, a, b, (b - a) * 100.0 / a if a else 0))
+        sys.stderr.write('%-20s %-4s %-4s %-4s %s\n' % (key(case) + ('; '.join(changes),)))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app = load_app(args.config)
+
+    import ckan.model as model
+    from ckanext.feeds import timing
+
+    started = clock()
+    data = create_data(args)
+    setup_seconds = clock() - started
+
+    counter = QueryCounter(model.meta.engine)
+    timing.enabled = True
+    cases = []
+    try:
+        for filter_type in FILTERS:
+            if 'group' in filter_type and not data['groups']:
+                continue
+            for format, version in FORMATS:
+                for warm in (False, True):
+                    case = run_case(app, data, counter, filter_type, format, version, args, warm)
+                    cases.append(case)
+                    sys.stderr.write('%-20s %-4s %-4s %-4s p50 %7.1f ms  p90 %7.1f ms  %5.1f queries\n' % (
+                        filter_type, format, version, case['cache'],
+                        case['latency_ms']['p50'], case['latency_ms']['p90'], case['sql']['mean']))
+    finally:
+        timing.enabled = False
+
+    report = {
+        'created': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'sizes': dict((name, getattr(args, name)) for name in
+                      ('users', 'groups', 'datasets', 'activities', 'follows', 'extras',
+                       'notes', 'limit', 'requests', 'seed')),
+        'activities': model.Session.query(model.Activity).count(),
+        'setup_seconds': setup_seconds,
+        'cases': cases,
+    }
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# encoding: utf-8
+'''
+Micro-benchmark of the activity messages of a 200 item feed.
+
+Compares parsing every message with re.findall and translating every title
+(as before) with the precompiled MessageTemplate objects. Run with::
+
+    python ckanext/feeds/tests/benchmarks/bench_messages.py
+'''
+
+import re
+import gettext
+import timeit
+
+from ckanext.feeds.messages import MessageTemplate
+
+
+ITEMS = 200
+
+MESSAGES = {
+    'new package': u'{actor} created the dataset {dataset}',
+    'changed package': u'{actor} updated the dataset {dataset}',
+    'deleted package': u'{actor} deleted the dataset {dataset}',
+    'new resource': u'{actor} added the resource {resource} to the dataset {dataset}',
+    'changed resource': u'{actor} updated the resource {resource} in the dataset {dataset}',
+    'added tag': u'{actor} added the tag {tag} to the dataset {dataset}',
+    'changed group': u'{actor} updated the group {group}',
+    'changed organization': u'{actor} updated the organization {organization}',
+    'follow dataset': u'{actor} started following {dataset}',
+    'changed user': u'{actor} updated their profile',
+}
+
+SNIPPETS = {
+    'actor': u'some-user',
+    'dataset': u'http://localhost/dataset/some-dataset',
+    'resource': u'http://localhost/dataset/some-resource',
+    'tag': u'some-tag',
+    'group': u'Some Group',
+    'organization': u'Some Organization',
+}
+
+# a stand-in for pylons' _()
+translate = gettext.NullTranslations().ugettext
+
+activity_types = sorted(MESSAGES)
+activities = [activity_types[i % len(activity_types)] for i in range(ITEMS)]
+
+
+def render_findall():
+    for activity_type in activities:
+        msg = MESSAGES[activity_type]
+        data = {}
+        for match in re.findall('\{([^}]*)\}', msg):
+            data[str(match)] = SNIPPETS[match]
+        msg.format(**data)
+        translate(activity_type.title())
+
+
+templates = dict(
+    (activity_type, MessageTemplate(activity_type, msg, translate(activity_type.title())))
+    for activity_type, msg in MESSAGES.items()
+)
+
+
+def render_templates():
+    for activity_type in activities:
+        template = templates[activity_type]
+        data = {}
+        for match in template.placeholders:
+            data[match] = SNIPPETS[match]
+        template.format(data)
+        template.title
+
+
+def main(number=1000, repeat=5):
+    results = []
+    for name, func in [('re.findall', render_findall), ('MessageTemplate', render_templates)]:
+        best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+        results.append((name, best))
+        print('%-16s %8.1f us per %d item feed' % (name, best * 1e6, ITEMS))
+    print('speedup: %.2fx' % (results[0][1] / results[1][1]))
+    return results
+
+
+if __name__ == '__main__':
+    main()
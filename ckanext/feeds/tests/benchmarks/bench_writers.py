@@ -0,0 +1,71 @@
+# encoding: utf-8
+'''
+Throughput of the feed writers on a 200 item feed.
+
+Compares webhelpers.feedgenerator (add_item and writeString, as before)
+with the writers of ckanext.feeds.writers for the three formats. Run with::
+
+    python ckanext/feeds/tests/benchmarks/bench_writers.py
+'''
+
+import timeit
+from datetime import datetime, timedelta
+
+from webhelpers import feedgenerator
+
+from ckanext.feeds import writers
+
+
+ITEMS = 200
+
+FORMATS = [
+    ('atom', feedgenerator.Atom1Feed, writers.AtomWriter),
+    ('rss 2.01', feedgenerator.Rss201rev2Feed, writers.Rss201Writer),
+    ('rss 0.91', feedgenerator.RssUserland091Feed, writers.Rss091Writer),
+]
+
+META = {
+    'title': u'News feed',
+    'link': u'http://localhost/dashboard/',
+    'description': u'Subscribed Activity',
+    'language': u'en',
+}
+
+now = datetime(2016, 6, 30, 15, 42, 52, 663910)
+items = [{
+    'title': u'Changed Package',
+    'link': u'http://localhost/revision/c257ab4f-5b52-44c4-aee8-807ea6a8a78e',
+    'description': u'some-user updated the dataset http://localhost/dataset/test-dataset-%d & more' % i,
+    'author_name': u'some-user',
+    'pubdate': now - timedelta(minutes=i),
+    'unique_id': u'60e93d90-6fb9-4553-a91f-7089b91af0e3',
+} for i in range(ITEMS)]
+
+
+def render_feedgenerator(feed_class):
+    feed = feed_class(**META)
+    for item in items:
+        feed.add_item(**item)
+    return feed.writeString('utf-8')
+
+
+feed_items = [writers.FeedItem(**item) for item in items]
+
+
+def render_writer(writer_class):
+    return writer_class(**META).write_string(feed_items)
+
+
+def main(number=200, repeat=5):
+    results = []
+    for name, feed_class, writer_class in FORMATS:
+        before = min(timeit.repeat(lambda: render_feedgenerator(feed_class), number=number, repeat=repeat)) / number
+        after = min(timeit.repeat(lambda: render_writer(writer_class), number=number, repeat=repeat)) / number
+        results.append((name, before, after))
+        print('%-9s feedgenerator %7.2f ms, writer %7.2f ms, speedup: %.2fx' % (
+            name, before * 1e3, after * 1e3, before / after))
+    return results
+
+
+if __name__ == '__main__':
+    main()
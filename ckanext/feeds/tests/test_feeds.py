@@ -3,6 +3,19 @@
 Tests for the ckanext-feeds extension.
 '''
 
+import os
+import copy
+import gzip
+import json
+import zlib
+import time
+import shutil
+import urlparse
+import tempfile
+import threading
+import BaseHTTPServer
+from datetime import datetime, timedelta
+
 import paste.fixture
 import pylons.test
 import pylons.config as config
@@ -17,10 +30,98 @@ import ckan.plugins as p
 import ckan.tests.factories as factories
 import ckan.logic as logic
 
+from ckanext.feeds import cache, freshness, generate, inbox, loaders, marks, query, timing, \
+    websub, writers
+from ckanext.feeds.followers import activity_recipients
+from ckanext.feeds.plugin import DashboardFeedController
+
 # webtest_submit = testhelpers.webtest_submit
 # submit_and_follow = testhelpers.submit_and_follow
 
 from nose.tools import assert_raises, assert_equal, raises, nottest, istest
+from sqlalchemy import event
+from webhelpers import feedgenerator
+from xml.etree import ElementTree
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+
+
+def parsed_feed(body):
+    '''Return an XML feed as nested (tag, attributes, text, children) tuples.'''
+    def parse(element):
+        return (element.tag, sorted(element.attrib.items()), (element.text or '').strip(),
+                [parse(child) for child in element])
+    return parse(ElementTree.fromstring(body))
+
+
+class QueryCounter(object):
+
+    '''Collects the SQL statements sent to the database inside a with block.'''
+
+    def __init__(self):
+        self.statements = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(model.meta.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(model.meta.engine, 'before_cursor_execute', self._before_cursor_execute)
+
+    def count(self, fragment):
+        '''Return the number of statements that contain the given fragment.'''
+        return len([s for s in self.statements if fragment in s])
+
+
+class StandInSubscriber(object):
+
+    '''A WebSub subscriber on a local port: confirms every intent and records the deliveries.'''
+
+    def __init__(self):
+        self.verifications = []
+        self.deliveries = []
+        # the number of deliveries to refuse before accepting them
+        self.failures = 0
+        self.posts = 0
+        subscriber = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                params = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+                subscriber.verifications.append(params)
+                self._answer(200, params.get('hub.challenge', ''))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.getheader('Content-Length')))
+                subscriber.posts += 1
+                if subscriber.failures:
+                    subscriber.failures -= 1
+                    return self._answer(503, '')
+                subscriber.deliveries.append((dict(self.headers), body))
+                self._answer(200, '')
+
+            def _answer(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
 
 
 class TestFeeds(object):
@@ -122,3 +223,792 @@ class TestFeeds(object):
         resp.mustcontain('<?xml')
         assert_equal(resp.header('Content-Type'), 'application/atom+xml')
 
+    @istest
+    def test_feed_loads_activity_details_in_one_query(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+
+        # every update creates a 'changed package' activity with details
+        for i in range(5):
+            testhelpers.call_action('package_patch', context={'user': self.user['name']},
+                                    id=self.dataset['id'], notes='notes %d' % i)
+
+        with QueryCounter() as queries:
+            resp = self.webtest_app.get(url=self.url, params='format=rss', status=200, extra_environ=env)
+
+        assert_equal(resp.status_int, 200)
+        resp.mustcontain('<?xml')
+        assert_equal(queries.count('FROM activity_detail'), 1)
+
+        # and the whole feed takes as many queries for one activity as for all of them,
+        # once the names of the users and datasets are cached
+        self.webtest_app.get(url=self.url, params='format=json&mark_old=false', status=200,
+                             extra_environ=env)
+        counts = []
+        for limit in (1, resp.body.count('<item>')):
+            with QueryCounter() as queries:
+                feed = self.webtest_app.get(url=self.url, status=200, extra_environ=env,
+                                            params={'format': 'atom', 'mark_old': 'false',
+                                                    'limit': limit})
+            assert_equal(len(ElementTree.fromstring(feed.body).findall(ATOM + 'entry')), limit)
+            counts.append(len(queries.statements))
+        assert_equal(counts[0], counts[1])
+
+    @istest
+    def test_feed_shows_new_name_of_renamed_user(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+        resp = self.webtest_app.get(url=self.url, params='format=rss', status=200, extra_environ=env)
+        resp.mustcontain(self.user['name'])
+
+        user = testhelpers.call_action('user_show', id=self.user['id'])
+        user.update({'name': 'renamed-user', 'email': 'renamed@example.com'})
+        testhelpers.call_action('user_update', context={'user': self.user['name'], 'ignore_auth': True}, **user)
+
+        env = {'REMOTE_USER': 'renamed-user'}
+        resp = self.webtest_app.get(url=self.url, params='format=rss', status=200, extra_environ=env)
+        resp.mustcontain('renamed-user')
+
+    @istest
+    def test_renamed_user_name_dropped_on_commit(self):
+
+        key = 'user:%s' % self.user['id']
+        user = model.User.get(self.user['id'])
+        user.name = 'renamed-user'
+        model.Session.flush()
+        # a request reads the old name before the commit
+        loaders.name_cache.set(key, self.user['name'])
+        model.Session.commit()
+        assert key not in loaders.name_cache
+
+    @istest
+    def test_feed_not_modified(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+
+        resp = self.webtest_app.get(url=self.url, params='format=rss', status=200, extra_environ=env)
+        etag = resp.header('ETag')
+        last_modified = resp.header('Last-Modified')
+
+        resp = self.webtest_app.get(url=self.url, params='format=rss', status=304, extra_environ=env,
+                                    headers={'If-None-Match': etag})
+        assert_equal(resp.status_int, 304)
+        assert_equal(resp.body, '')
+
+        resp = self.webtest_app.get(url=self.url, params='format=rss', status=304, extra_environ=env,
+                                    headers={'If-Modified-Since': last_modified})
+        assert_equal(resp.status_int, 304)
+
+        # a different representation of the same feed has another entity tag
+        resp = self.webtest_app.get(url=self.url, params='format=atom', status=200, extra_environ=env,
+                                    headers={'If-None-Match': etag})
+        assert resp.header('ETag') != etag
+
+    @istest
+    def test_feed_modified_by_unfollowing(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+        other_user = factories.User()
+        other_dataset = factories.Dataset(user=other_user)
+        testhelpers.call_action('follow_dataset', context={'user': self.user['name']},
+                                id=other_dataset['id'])
+        params = 'format=rss&mark_old=false'
+
+        followed = self.webtest_app.get(url=self.url, params=params, status=200, extra_environ=env)
+        followed.mustcontain('/dataset/%s' % other_dataset['name'])
+
+        # unfollowing creates no activity, but the dashboard changes
+        testhelpers.call_action('unfollow_dataset', context={'user': self.user['name']},
+                                id=other_dataset['id'])
+        unfollowed = self.webtest_app.get(url=self.url, params=params, status=200, extra_environ=env,
+                                          headers={'If-None-Match': followed.header('ETag')})
+        assert other_dataset['name'] not in unfollowed.body
+
+    @istest
+    def test_feed_cache(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+        stats = testhelpers.call_action('feeds_cache_stats')
+
+        first = self.webtest_app.get(url=self.url, params='format=rss', status=200, extra_environ=env)
+        second = self.webtest_app.get(url=self.url, params='format=rss', status=200, extra_environ=env)
+        assert_equal(first.body, second.body)
+
+        new_stats = testhelpers.call_action('feeds_cache_stats')
+        assert_equal(new_stats['misses'], stats['misses'] + 1)
+        assert_equal(new_stats['hits'], stats['hits'] + 1)
+
+        # a new activity invalidates the cached feed
+        testhelpers.call_action('package_patch', context={'user': self.user['name']},
+                                id=self.dataset['id'], notes='new notes')
+        third = self.webtest_app.get(url=self.url, params='format=rss', status=200, extra_environ=env)
+        assert_equal(third.body.count('<item>'), first.body.count('<item>') + 1)
+
+    @istest
+    def test_file_feed_cache_counts(self):
+
+        directory = tempfile.mkdtemp()
+        try:
+            feed_cache = cache.FileFeedCache(directory)
+            feed_cache.set(u'user', u'rss', '"1"', 'a' * 10)
+            feed_cache.set(u'user', u'atom', '"1"', 'b' * 20)
+            # replacing an entry counts the new body only
+            feed_cache.set(u'user', u'rss', '"2"', 'c' * 30)
+            feed_cache.set(u'other', u'rss', '"1"', 'd' * 5)
+            assert_equal(feed_cache.entries(), 3)
+            assert_equal(feed_cache.size(), cache.FileFeedCache(directory).size())
+
+            feed_cache.invalidate(u'user')
+            assert_equal(feed_cache.entries(), 1)
+            assert_equal(feed_cache.size(), cache.FileFeedCache(directory).size())
+        finally:
+            shutil.rmtree(directory)
+
+    @istest
+    def test_read_only_feed(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+        last_viewed = model.Dashboard.get(self.user['id']).activity_stream_last_viewed
+
+        self.webtest_app.get(url=self.url, params='format=rss&mark_old=false', status=200, extra_environ=env)
+
+        model.Session.expire_all()
+        assert_equal(model.Dashboard.get(self.user['id']).activity_stream_last_viewed, last_viewed)
+
+        self.webtest_app.get(url=self.url, params='format=rss', status=200, extra_environ=env)
+
+        model.Session.expire_all()
+        assert model.Dashboard.get(self.user['id']).activity_stream_last_viewed > last_viewed
+
+        self.webtest_app.get(url=self.url, params='format=rss&mark_old=maybe', status=400,
+                             extra_environ=env)
+
+        # a deferred mark never moves the last view back
+        last_viewed = model.Dashboard.get(self.user['id']).activity_stream_last_viewed
+        deferred = marks.DeferredMarks()
+        deferred.add(self.user['id'], last_viewed - timedelta(hours=1))
+        deferred.flush(model.Session)
+        model.Session.expire_all()
+        assert_equal(model.Dashboard.get(self.user['id']).activity_stream_last_viewed, last_viewed)
+
+    @istest
+    def test_feed_does_not_query_followees(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+
+        with QueryCounter() as queries:
+            self.webtest_app.get(url=self.url, params={'format': 'rss', 'type': 'dataset', 'name': self.dataset['name']},
+                                 status=200, extra_environ=env)
+
+        # followee_list reads the user_following_* tables, the dataset feed does not
+        assert_equal(queries.count('user_following_'), 0)
+
+    @istest
+    def test_feed_paging(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+
+        for i in range(4):
+            testhelpers.call_action('package_patch', context={'user': self.user['name']},
+                                    id=self.dataset['id'], notes='notes %d' % i)
+
+        resp = self.webtest_app.get(url=self.url, params='format=atom&limit=3', status=200, extra_environ=env)
+        first_page = ElementTree.fromstring(resp.body)
+        first_updated = [e.findtext(ATOM + 'updated') for e in first_page.findall(ATOM + 'entry')]
+        assert_equal(len(first_updated), 3)
+
+        links = dict((l.get('rel'), l.get('href')) for l in first_page.findall(ATOM + 'link'))
+        assert 'before=' in links['next']
+
+        resp = self.webtest_app.get(url=links['next'], status=200, extra_environ=env)
+        second_page = ElementTree.fromstring(resp.body)
+        second_updated = [e.findtext(ATOM + 'updated') for e in second_page.findall(ATOM + 'entry')]
+        assert len(second_updated) > 0
+        assert max(second_updated) <= min(first_updated)
+
+    @istest
+    def test_feed_invalid_paging_parameters(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+
+        self.webtest_app.get(url=self.url, params='format=rss&limit=ten', status=400, extra_environ=env)
+        self.webtest_app.get(url=self.url, params='format=rss&before=yesterday', status=400, extra_environ=env)
+
+    @istest
+    def test_feed_delta(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+
+        resp = self.webtest_app.get(url=self.url, params='format=rss', status=200, extra_environ=env)
+        etag = resp.header('ETag')
+        assert resp.body.count('<item>') > 1
+
+        testhelpers.call_action('package_patch', context={'user': self.user['name']},
+                                id=self.dataset['id'], notes='new notes')
+
+        resp = self.webtest_app.get(url=self.url, params='format=rss', status=226, extra_environ=env,
+                                    headers={'If-None-Match': etag, 'A-IM': 'feed'})
+        assert_equal(resp.status_int, 226)
+        assert_equal(resp.header('IM'), 'feed')
+        assert_equal(resp.body.count('<item>'), 1)
+
+        # nothing new since the delta
+        self.webtest_app.get(url=self.url, params='format=rss', status=304, extra_environ=env,
+                             headers={'If-None-Match': resp.header('ETag'), 'A-IM': 'feed'})
+
+    @istest
+    def test_streamed_feed_is_cached(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+
+        for i in range(5):
+            testhelpers.call_action('package_patch', context={'user': self.user['name']},
+                                    id=self.dataset['id'], notes='notes %d' % i)
+
+        # several chunks of activities make one document
+        chunk_size = DashboardFeedController.chunk_size
+        DashboardFeedController.chunk_size = 2
+        try:
+            streamed = self.webtest_app.get(url=self.url, params='format=atom', status=200, extra_environ=env)
+        finally:
+            DashboardFeedController.chunk_size = chunk_size
+        entries = ElementTree.fromstring(streamed.body).findall(ATOM + 'entry')
+        assert len(entries) > 5
+
+        cached = self.webtest_app.get(url=self.url, params='format=atom', status=200, extra_environ=env)
+        assert_equal(cached.body, streamed.body)
+
+    @istest
+    def test_feed_reads_only_the_activity_data_it_shows(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+
+        with QueryCounter() as queries:
+            resp = self.webtest_app.get(url=self.url, params='format=rss', status=200, extra_environ=env)
+
+        # the snapshots of the datasets are not loaded, only their names, and
+        # PostgreSQL casts the snapshot of every row once
+        assert_equal(queries.count('activity.data AS activity_data'), 0)
+        assert_equal([s for s in queries.statements if s.count('CAST(activity.data') > 1], [])
+        resp.mustcontain('/dataset/%s' % self.dataset['name'])
+
+    @istest
+    def test_feed_from_inbox(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+
+        inbox.setup()
+        query.backfill_inbox(model.Session, self.user['id'])
+        model.Session.commit()
+
+        inbox.enabled = True
+        try:
+            # new activities are added to the inbox when they are created
+            testhelpers.call_action('package_patch', context={'user': self.user['name']},
+                                    id=self.dataset['id'], notes='new notes')
+            assert_equal(query.check_inbox(model.Session, self.user['id']), (set(), set()))
+
+            with QueryCounter() as queries:
+                from_inbox = self.webtest_app.get(url=self.url, params='format=rss&mark_old=false',
+                                                  status=200, extra_environ=env)
+            assert_equal(queries.count('user_following_'), 0)
+        finally:
+            inbox.enabled = False
+
+        cache.feed_cache.invalidate(self.user['id'])
+        on_the_fly = self.webtest_app.get(url=self.url, params='format=rss&mark_old=false',
+                                          status=200, extra_environ=env)
+        assert_equal(from_inbox.body, on_the_fly.body)
+
+    @istest
+    def test_fan_out_skips_the_rows_already_in_the_inbox(self):
+
+        inbox.setup()
+        other_user = factories.User()
+        activity = model.Session.query(model.Activity) \
+            .order_by(model.Activity.timestamp.desc()).first()
+        row = (activity.id, activity.user_id, activity.object_id, activity.activity_type,
+               activity.timestamp)
+        connection = model.meta.engine.connect()
+        try:
+            # e.g. a backfill added it to the inbox of one of the users
+            assert_equal(inbox.fan_out(connection, [row], {activity.id: set([self.user['id']])}), 1)
+            assert_equal(inbox.fan_out(connection, [row], {
+                activity.id: set([self.user['id'], other_user['id']])}), 1)
+            rows = connection.execute(inbox.inbox_table.select().where(
+                inbox.inbox_table.c.activity_id == activity.id)).fetchall()
+            assert_equal(sorted(r.user_id for r in rows), sorted([self.user['id'], other_user['id']]))
+        finally:
+            inbox.clear(connection)
+            connection.close()
+
+    @istest
+    def test_shared_object_feed(self):
+
+        url = helpers.url_for('object_feed', filter_type='dataset', id=self.dataset['name'])
+        other_user = factories.User()
+        stats = testhelpers.call_action('feeds_cache_stats')
+
+        anonymous = self.webtest_app.get(url=url, params='format=atom', status=200)
+        logged_in = self.webtest_app.get(url=url, params='format=atom', status=200,
+                                         extra_environ={'REMOTE_USER': other_user['name'].encode('ascii')})
+        assert_equal(anonymous.body, logged_in.body)
+        assert_equal(anonymous.header('ETag'), logged_in.header('ETag'))
+        assert len(ElementTree.fromstring(anonymous.body).findall(ATOM + 'entry')) > 0
+
+        # the feed is the one of the dataset, not of a dashboard
+        feed = ElementTree.fromstring(anonymous.body)
+        assert_equal(feed.find(ATOM + 'title').text, self.dataset['title'])
+        assert '/dataset/%s' % self.dataset['name'] in anonymous.body
+        assert '/dashboard' not in anonymous.body
+
+        # rendered once for everyone
+        new_stats = testhelpers.call_action('feeds_cache_stats')
+        assert_equal(new_stats['misses'], stats['misses'] + 1)
+        assert_equal(new_stats['hits'], stats['hits'] + 1)
+
+        # a new activity of the dataset invalidates it
+        testhelpers.call_action('package_patch', context={'user': self.user['name']},
+                                id=self.dataset['id'], notes='new notes')
+        updated = self.webtest_app.get(url=url, params='format=atom', status=200)
+        assert_equal(len(ElementTree.fromstring(updated.body).findall(ATOM + 'entry')),
+                     len(ElementTree.fromstring(anonymous.body).findall(ATOM + 'entry')) + 1)
+
+    @istest
+    def test_hidden_users(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+        hidden = factories.Sysadmin()
+        testhelpers.call_action('follow_dataset', context={'user': self.user['name']},
+                                id=self.dataset['id'])
+        params = 'format=atom&mark_old=false'
+
+        config['ckan.hide_activity_from_users'] = hidden['name']
+        try:
+            before = self.webtest_app.get(url=self.url, params=params, status=200, extra_environ=env)
+            testhelpers.call_action('package_patch', context={'user': hidden['name']},
+                                    id=self.dataset['id'], notes='hidden notes')
+            after = self.webtest_app.get(url=self.url, params=params, status=200, extra_environ=env)
+
+            # the dashboards don't show the activities of the hidden users
+            assert_equal(len(ElementTree.fromstring(after.body).findall(ATOM + 'entry')),
+                         len(ElementTree.fromstring(before.body).findall(ATOM + 'entry')))
+            connection = model.Session.connection()
+            activity = model.Session.query(model.Activity) \
+                .filter(model.Activity.user_id == hidden['id']).one()
+            assert_equal(activity_recipients(connection, [(activity.id, activity.user_id,
+                                                           activity.object_id,
+                                                           activity.activity_type)]),
+                         {activity.id: set()})
+        finally:
+            del config['ckan.hide_activity_from_users']
+
+        # the organization feeds show the deleted datasets
+        testhelpers.call_action('package_delete', context={'user': self.user['name']},
+                                id=self.dataset['id'])
+        url = helpers.url_for('object_feed', filter_type='organization', id=self.owner_org['name'])
+        resp = self.webtest_app.get(url=url, params='format=atom', status=200, extra_environ=env)
+        resp.mustcontain('/dataset/%s' % self.dataset['name'])
+
+    @istest
+    def test_private_object_feed(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+        dataset = factories.Dataset(owner_org=self.owner_org['id'], private=True)
+        url = helpers.url_for('object_feed', filter_type='dataset', id=dataset['id'])
+
+        # private datasets are only shown to the users who can see them
+        self.webtest_app.get(url=url, params='format=rss', status=302)
+        object_feed = self.webtest_app.get(url=url, params='format=rss', status=200,
+                                           extra_environ=env)
+
+        # the dashboard filtered by the same dataset is another feed, with its own links
+        dashboard = self.webtest_app.get(url=self.url, status=200, extra_environ=env, params={
+            'format': 'rss', 'version': '2.01', 'type': 'dataset', 'name': dataset['id']})
+        assert object_feed.header('ETag') != dashboard.header('ETag')
+        assert '/dashboard' not in object_feed.body
+        assert '/dashboard' in dashboard.body
+
+    @istest
+    def test_merged_feed(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+        other_dataset = factories.Dataset(user=self.user)
+        sources = [('dataset', other_dataset['name']), ('organization', self.owner_org['name'])]
+
+        context = {'model': model, 'session': model.Session, 'user': self.user['name']}
+        separate = {}
+        for source in sources:
+            for activity in query.activity_list(context, [source], 10):
+                separate[activity['id']] = activity
+        expected = sorted(separate.values(), key=lambda a: (a['timestamp'], a['id']), reverse=True)
+
+        # the activities of the dataset of the organization are in both feeds, once in the merged one
+        merged = query.activity_list(context, sources, 10)
+        assert_equal([a['id'] for a in merged], [a['id'] for a in expected[:10]])
+
+        params = [('format', 'atom'), ('limit', 10),
+                  ('type', 'dataset'), ('name', other_dataset['name']),
+                  ('type', 'organization'), ('name', self.owner_org['name'])]
+        resp = self.webtest_app.get(url=self.url, params=params, status=200, extra_environ=env)
+        assert_equal(len(ElementTree.fromstring(resp.body).findall(ATOM + 'entry')), len(merged))
+
+        # every type needs a name
+        self.webtest_app.get(url=self.url, params=params[:-1], status=400, extra_environ=env)
+
+    @istest
+    def test_merged_feed_not_modified(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+        other_dataset = factories.Dataset(user=self.user)
+        params = [('format', 'rss'), ('mark_old', 'false'),
+                  ('type', 'dataset'), ('name', other_dataset['name']),
+                  ('type', 'organization'), ('name', self.owner_org['name'])]
+
+        resp = self.webtest_app.get(url=self.url, params=params, status=200, extra_environ=env)
+        etag = resp.header('ETag')
+        self.webtest_app.get(url=self.url, params=params, status=304, extra_environ=env,
+                             headers={'If-None-Match': etag})
+
+        context = {'model': model, 'session': model.Session, 'user': self.user['name']}
+        sources = [('dataset', other_dataset['id']), ('organization', self.owner_org['id'])]
+        latest = query.latest_activity(context, sources)
+        newest = query.activity_list(context, sources, 1)[0]
+        assert_equal(latest.id, newest['id'])
+
+    @istest
+    def test_generate_feeds(self):
+
+        directory = tempfile.mkdtemp()
+        options = {'directory': directory, 'compress': True, 'limit': 31,
+                   'site_url': 'http://localhost'}
+        try:
+            results = generate.generate('objects', options)
+            assert_equal(results['failed'], 0)
+
+            path = os.path.join(directory, 'dataset', '%s.atom' % self.dataset['name'])
+            with open(path, 'rb') as f:
+                body = f.read()
+            assert len(ElementTree.fromstring(body).findall(ATOM + 'entry')) > 0
+            assert_equal(gzip.open(path + '.gz').read(), body)
+            path = os.path.join(directory, 'dataset', '%s.json' % self.dataset['name'])
+            with open(path, 'rb') as f:
+                assert len(json.loads(f.read())['items']) > 0
+
+            # no new activities, nothing to write
+            assert_equal(generate.generate('objects', options, incremental=True)['written'], 0)
+
+            # the dataset and its organization
+            testhelpers.call_action('package_patch', context={'user': self.user['name']},
+                                    id=self.dataset['id'], notes='new notes')
+            assert_equal(generate.generate('objects', options, incremental=True)['written'], 2)
+
+            # the command refuses to write the dashboards next to them
+            assert_equal(generate.generated_kinds(directory), ['objects'])
+        finally:
+            shutil.rmtree(directory)
+
+    @istest
+    def test_coalesced_bursts(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+
+        for i in range(5):
+            testhelpers.call_action('package_patch', context={'user': self.user['name']},
+                                    id=self.dataset['id'], notes='notes %d' % i)
+        params = 'format=atom&mark_old=false'
+        every = self.webtest_app.get(url=self.url, params=params, status=200, extra_environ=env)
+
+        cache.feed_cache.invalidate(self.user['id'])
+        DashboardFeedController.coalesce_window = timedelta(minutes=1)
+        try:
+            coalesced = self.webtest_app.get(url=self.url, params=params, status=200, extra_environ=env)
+        finally:
+            DashboardFeedController.coalesce_window = None
+
+        # the changes of the dataset are one entry
+        every_entries = ElementTree.fromstring(every.body).findall(ATOM + 'entry')
+        coalesced_entries = ElementTree.fromstring(coalesced.body).findall(ATOM + 'entry')
+        assert len(coalesced_entries) <= len(every_entries) - 4
+        coalesced.mustcontain('times)')
+        # with the newest activity
+        assert_equal(coalesced_entries[0].findtext(ATOM + 'updated'),
+                     every_entries[0].findtext(ATOM + 'updated'))
+
+    @istest
+    def test_feed_items_leave_the_activities_unchanged(self):
+
+        testhelpers.call_action('resource_patch', context={'user': self.user['name']},
+                                id=self.resource['id'], url='http://example.com/new.csv')
+        context = {'model': model, 'session': model.Session, 'user': self.user['name'],
+                   'site_url': 'http://localhost', 'lang': None,
+                   'burst_message': u'{msg} ({count} times)'}
+        activities = query.activity_list(context, [('dataset', self.dataset['id'])], 10)
+        before = copy.deepcopy(activities)
+
+        items = DashboardFeedController().activity_list_to_feed(context, activities)
+        assert_equal(activities, before)
+        assert_equal(len(items), len(activities))
+        for item, activity in zip(items, activities):
+            assert_equal(item.pubdate, datetime.strptime(activity['timestamp'], '%Y-%m-%dT%H:%M:%S.%f'))
+            assert_equal(item.link, 'http://localhost/revision/%s' % activity['revision_id'])
+
+        assert_equal(query.parse_timestamp('2016-06-30T15:42:52'), datetime(2016, 6, 30, 15, 42, 52))
+
+    @istest
+    def test_compressed_feed(self):
+
+        url = helpers.url_for('object_feed', filter_type='dataset', id=self.dataset['name'])
+        plain = self.webtest_app.get(url=url, params='format=atom', status=200)
+        assert 'Content-Encoding' not in plain.headers
+        assert_equal(plain.header('Vary'), 'Accept-Encoding')
+
+        # compressed from the cached feed once, then cached too
+        stats = testhelpers.call_action('feeds_cache_stats')
+        for i in range(2):
+            resp = self.webtest_app.get(url=url, params='format=atom', status=200,
+                                        headers={'Accept-Encoding': 'gzip, deflate'})
+            assert_equal(resp.header('Content-Encoding'), 'gzip')
+            assert_equal(resp.header('ETag'), 'W/' + plain.header('ETag'))
+            assert_equal(zlib.decompress(resp.body, 16 + zlib.MAX_WBITS), plain.body)
+        assert_equal(testhelpers.call_action('feeds_cache_stats')['hits'], stats['hits'] + 2)
+
+        resp = self.webtest_app.get(url=url, params='format=atom', status=200,
+                                    headers={'Accept-Encoding': 'gzip;q=0, deflate'})
+        assert_equal(resp.header('Content-Encoding'), 'deflate')
+        assert_equal(zlib.decompress(resp.body), plain.body)
+
+        # compressed as it is streamed when it is not cached
+        cache.feed_cache.invalidate(cache.object_namespace(self.dataset['id']))
+        resp = self.webtest_app.get(url=url, params='format=atom', status=200,
+                                    headers={'Accept-Encoding': 'gzip'})
+        assert_equal(zlib.decompress(resp.body, 16 + zlib.MAX_WBITS), plain.body)
+
+        # the client has the current version of the feed
+        self.webtest_app.get(url=url, params='format=atom', status=304,
+                             headers={'Accept-Encoding': 'gzip', 'If-None-Match': resp.header('ETag')})
+
+    @istest
+    def test_adaptive_ttl(self):
+
+        url = helpers.url_for('object_feed', filter_type='dataset', id=self.dataset['name'])
+        namespace = cache.object_namespace(self.dataset['id'])
+
+        # disabled by default
+        resp = self.webtest_app.get(url=url, params='format=rss', status=200)
+        assert 'Cache-Control' not in resp.headers
+        etag = resp.header('ETag')
+
+        freshness.enabled = True
+        freshness.activity_rates = freshness.ActivityRates()
+        cache.feed_cache.invalidate(namespace)
+        try:
+            # the rate is unknown, the newest activity is recent
+            resp = self.webtest_app.get(url=url, params='format=rss', status=200)
+            assert_equal(resp.header('Cache-Control'), 'public, max-age=%d' % freshness.min_ttl)
+            assert_equal(resp.header('Retry-After'), str(freshness.min_ttl))
+            resp.mustcontain('<ttl>%d</ttl>' % (freshness.min_ttl // 60))
+            # the ttl of the body is a part of the ETag and of the cache key
+            assert resp.header('ETag') != etag
+
+            # the new activities of the dataset are counted
+            for i in range(2):
+                testhelpers.call_action('package_patch', context={'user': self.user['name']},
+                                        id=self.dataset['id'], notes='notes %d' % i)
+            assert freshness.activity_rates.interval(namespace) is not None
+
+            # the dashboards are private
+            env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+            resp = self.webtest_app.get(url=self.url, params='format=atom', status=200, extra_environ=env)
+            assert resp.header('Cache-Control').startswith('private, max-age=')
+            resp.mustcontain('<sy:updatePeriod')
+        finally:
+            freshness.enabled = False
+
+        # a feed with an activity every 30 minutes, then quiet
+        now = time.time()
+        freshness.activity_rates.observe(['test'], now - 3600)
+        freshness.activity_rates.observe(['test'], now - 1800)
+        assert_equal(freshness.feed_ttl('test', None, now), 1800)
+        assert_equal(freshness.feed_ttl('test', None, now + 86400), freshness.max_ttl)
+
+    @istest
+    def test_json_feed(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+        for i in range(3):
+            testhelpers.call_action('package_patch', context={'user': self.user['name']},
+                                    id=self.dataset['id'], notes='notes %d' % i)
+
+        resp = self.webtest_app.get(url=self.url, params='format=json&limit=2&mark_old=false',
+                                    status=200, extra_environ=env)
+        assert_equal(resp.content_type, 'application/feed+json')
+        feed = json.loads(resp.body)
+        assert_equal(feed['version'], 'https://jsonfeed.org/version/1.1')
+        assert_equal(len(feed['items']), 2)
+        for item in feed['items']:
+            assert item['content_text']
+            assert_equal(item['_feeds']['cursor'].split(',')[1], item['id'])
+
+        # the next page has the older activities
+        older = json.loads(self.webtest_app.get(url=feed['next_url'], status=200, extra_environ=env).body)
+        assert older['items']
+        assert older['items'][0]['_feeds']['cursor'] < feed['items'][-1]['_feeds']['cursor']
+
+        # conditional GET
+        self.webtest_app.get(url=self.url, params='format=json&limit=2&mark_old=false', status=304,
+                             headers={'If-None-Match': resp.header('ETag')}, extra_environ=env)
+
+        url = helpers.url_for('object_feed', filter_type='dataset', id=self.dataset['name'])
+        shared = json.loads(self.webtest_app.get(url=url, params='format=json', status=200).body)
+        assert_equal(len(shared['items']), len(query.activity_list(
+            {'model': model, 'session': model.Session, 'user': ''},
+            [('dataset', self.dataset['id'])], 31)))
+
+    @istest
+    def test_writers_match_feedgenerator(self):
+
+        meta = {'title': u'News feed \u2013 <all>', 'link': u'http://localhost/dashboard/',
+                'description': u'Subscribed Activity', 'language': u'en'}
+        now = datetime(2016, 6, 30, 15, 42, 52)
+        items = [{
+            'title': u'Changed Package',
+            'link': u'http://localhost/dataset/d%C3%A9j%C3%A0-vu?a=1&b=2',
+            'description': u'<a href="/user/x">x</a> updated the dataset "d\xe9j\xe0" & more',
+            'author_name': u'x',
+            'pubdate': now,
+            'unique_id': u'60e93d90-6fb9-4553-a91f-7089b91af0e3',
+        }, {
+            # no author nor description
+            'title': u'New Package',
+            'link': u'http://localhost/dataset/other',
+            'description': None,
+            'pubdate': now - timedelta(minutes=1),
+            'unique_id': u'c257ab4f-5b52-44c4-aee8-807ea6a8a78e',
+        }]
+
+        for feed_class, writer_class in [(feedgenerator.Atom1Feed, writers.AtomWriter),
+                                         (feedgenerator.Rss201rev2Feed, writers.Rss201Writer),
+                                         (feedgenerator.RssUserland091Feed, writers.Rss091Writer)]:
+            feed = feed_class(**meta)
+            for item in items:
+                feed.add_item(**item)
+            expected = feed.writeString('utf-8')
+            body = writer_class(**meta).write_string([writers.FeedItem(**item) for item in items])
+            # the same elements, attributes and text, in the same order
+            assert_equal(parsed_feed(body), parsed_feed(expected))
+
+    @istest
+    def test_feed_timing(self):
+
+        env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+
+        # disabled by default
+        resp = self.webtest_app.get(url=self.url, params='format=rss', status=200, extra_environ=env)
+        assert 'Server-Timing' not in resp.headers
+
+        timing.enabled = True
+        timing.stats.clear()
+        cache.feed_cache.invalidate(self.user['id'])
+        try:
+            resp = self.webtest_app.get(url=self.url, params='format=rss', status=200, extra_environ=env)
+
+            # an aborted request leaves no timer behind
+            url = helpers.url_for('object_feed', filter_type='dataset', id='no-such-dataset')
+            self.webtest_app.get(url=url, params='format=rss', status=404)
+            assert not timing.current().enabled
+        finally:
+            timing.enabled = False
+
+        server_timing = resp.header('Server-Timing')
+        for metric in ('auth;dur=', 'latest;dur=', 'query;dur=', 'details;dur=', 'snippets;dur=',
+                       'serialize;dur=', 'sql;desc=', 'items;desc=', 'total;dur='):
+            assert metric in server_timing, metric
+
+        sysadmin = factories.Sysadmin()
+        stats = testhelpers.call_action('feeds_timing_stats', context={'user': sysadmin['name']})
+        assert_equal(stats['requests'], 1)
+        assert_equal(stats['counters']['items']['p50'], resp.body.count('<item>'))
+        assert stats['durations']['total']['p99'] > 0
+
+    @istest
+    def test_websub(self):
+
+        websub.setup()
+        websub.enabled = True
+        websub.site_url = config.get('ckan.site_url', 'http://localhost').rstrip('/')
+        websub.hub_url = websub.site_url + '/feeds/hub'
+        websub.dispatcher = websub.Dispatcher(workers=1, retries=2, backoff=0.01, timeout=5)
+        subscriber = StandInSubscriber()
+        websub.allowed_callbacks = [subscriber.url + '/']
+        hub = helpers.url_for('websub_hub')
+        https = {'wsgi.url_scheme': 'https'}
+        try:
+            # the public feeds advertise the hub
+            url = helpers.url_for('object_feed', filter_type='dataset', id=self.dataset['name'])
+            resp = self.webtest_app.get(url=url, params='format=atom', status=200)
+            links = dict((link.get('rel'), link.get('href'))
+                         for link in ElementTree.fromstring(resp.body).findall(ATOM + 'link'))
+            assert_equal(links['hub'], websub.hub_url)
+            topic = links['self']
+            assert_equal(resp.header('Link'), websub.link_header(topic))
+
+            # the subscription is stored once the subscriber confirmed it
+            self.webtest_app.post(hub, {'hub.mode': 'subscribe', 'hub.topic': topic,
+                                        'hub.callback': subscriber.url + '/callback',
+                                        'hub.secret': 'secret'}, status=202, extra_environ=https)
+            websub.dispatcher.join()
+            assert_equal(subscriber.verifications[0]['hub.topic'], topic)
+            connection = model.meta.engine.connect()
+            try:
+                assert_equal(len(websub.subscriptions(connection, [self.dataset['id']])), 1)
+            finally:
+                connection.close()
+
+            # a new activity of the dataset is pushed, again after a failed attempt
+            subscriber.failures = 1
+            testhelpers.call_action('package_patch', context={'user': self.user['name']},
+                                    id=self.dataset['id'], notes='new notes')
+            websub.dispatcher.join()
+            assert_equal(subscriber.posts, 2)
+            headers, body = subscriber.deliveries[0]
+            assert_equal(headers['x-hub-signature'], websub.signature('secret', body))
+            assert_equal(len(ElementTree.fromstring(body).findall(ATOM + 'entry')), 1)
+
+            # the feeds of private datasets are never pushed
+            private = factories.Dataset(owner_org=self.owner_org['id'], private=True)
+            private_topic = websub.site_url + helpers.url_for(
+                'object_feed', filter_type='dataset', id=private['name']) + '?format=atom'
+            self.webtest_app.post(hub, {'hub.mode': 'subscribe', 'hub.topic': private_topic,
+                                        'hub.callback': subscriber.url + '/callback'}, status=403)
+            self.webtest_app.post(hub, {'hub.mode': 'subscribe', 'hub.topic': topic,
+                                        'hub.callback': 'ftp://example.com/'}, status=400)
+
+            # the hub doesn't send requests to the local network
+            for callback in ('http://127.0.0.1:1/callback', 'http://169.254.169.254/latest',
+                             'http://[::1]/callback', 'http://localhost/callback'):
+                self.webtest_app.post(hub, {'hub.mode': 'subscribe', 'hub.topic': topic,
+                                            'hub.callback': callback}, status=400)
+
+            # and verifies a bounded number of subscriptions at once
+            websub.max_pending = 0
+            self.webtest_app.post(hub, {'hub.mode': 'subscribe', 'hub.topic': topic,
+                                        'hub.callback': subscriber.url + '/other'}, status=503)
+            websub.max_pending = 100
+
+            # the secrets sent in clear are ignored
+            self.webtest_app.post(hub, {'hub.mode': 'subscribe', 'hub.topic': topic,
+                                        'hub.callback': subscriber.url + '/callback',
+                                        'hub.secret': 'secret'}, status=202)
+            websub.dispatcher.join()
+            connection = model.meta.engine.connect()
+            try:
+                rows = websub.subscriptions(connection, [self.dataset['id']])
+            finally:
+                connection.close()
+            assert_equal([row.secret for row in rows], [None])
+        finally:
+            websub.enabled = False
+            websub.allowed_callbacks = []
+            websub.max_pending = 100
+            subscriber.stop()
@@ -0,0 +1,244 @@
+# encoding: utf-8
+""" Timings of the stages of the feed requests """
+
+import logging
+log = logging.getLogger(__name__)
+
+import math
+import threading
+from collections import OrderedDict, deque
+from timeit import default_timer as clock
+
+from sqlalchemy import event
+
+import ckan.model as model
+
+
+# Whether the feed requests are timed, see FeedsPlugin.configure
+enabled = False
+
+# the number of requests the percentiles are computed from
+MAX_SAMPLES = 1000
+
+PERCENTILES = [50, 90, 99]
+
+
+class Timer(object):
+    '''
+    The durations of the stages of one feed request, and its counters
+
+    The durations of a stage add up, e.g. the enrichment of every chunk
+    of a feed.
+    '''
+
+    enabled = True
+
+    def __init__(self):
+        self.started = clock()
+        self.durations = OrderedDict()
+        self.counters = OrderedDict()
+
+    def clock(self):
+        return clock()
+
+    def add(self, stage, started):
+        '''Add the time since ``started``, a value of clock(), to a stage.'''
+        self.durations[stage] = self.durations.get(stage, 0.0) + clock() - started
+
+    def stage(self, name):
+        '''Return a context manager that adds the time of its block to a stage.'''
+        return _Stage(self, name)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def iter(self, stage, iterable):
+        '''Add the time spent reading the items of an iterable to a stage.'''
+        iterator = iter(iterable)
+        while True:
+            started = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, started)
+                return
+            self.add(stage, started)
+            yield item
+
+    def total(self):
+        return clock() - self.started
+
+    def server_timing(self):
+        '''Return the value of the Server-Timing header, durations in milliseconds.'''
+        metrics = ['%s;dur=%.1f' % (stage, duration * 1000)
+                   for stage, duration in self.durations.items()]
+        metrics.extend('%s;desc="%d"' % (name, value) for name, value in self.counters.items())
+        metrics.append('total;dur=%.1f' % (self.total() * 1000))
+        return ', '.join(metrics)
+
+
+class _Stage(object):
+
+    __slots__ = ('timer', 'name', 'started')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.started = clock()
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, self.started)
+
+
+class NullTimer(object):
+    '''The timer of the requests when the timings are disabled, does nothing.'''
+
+    enabled = False
+
+    def clock(self):
+        return 0
+
+    def add(self, stage, started):
+        pass
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def count(self, name, n=1):
+        pass
+
+    def iter(self, stage, iterable):
+        return iterable
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+NULL_TIMER = NullTimer()
+
+# the timer of the request of every thread
+_local = threading.local()
+
+
+def start():
+    '''Start timing the request of the current thread.
+
+    :rtype: Timer, or NullTimer if the timings are disabled
+    '''
+    if not enabled:
+        return NULL_TIMER
+    install()
+    _local.timer = Timer()
+    return _local.timer
+
+
+def install():
+    '''Count the SQL statements of the timed requests, once per process.'''
+    if not event.contains(model.meta.engine, 'before_cursor_execute', count_query):
+        event.listen(model.meta.engine, 'before_cursor_execute', count_query)
+
+
+def discard():
+    '''Stop timing the request of the current thread without recording it,
+    e.g. when it is aborted.'''
+    _local.timer = NULL_TIMER
+
+
+def current():
+    '''Return the timer of the request of the current thread.'''
+    if not enabled:
+        return NULL_TIMER
+    return getattr(_local, 'timer', NULL_TIMER)
+
+
+def finish(timer, **fields):
+    '''Record the timings of a request in the stats and log them on one line
+
+    :param fields: other values of the log line, e.g. the path
+    '''
+    if not timer.enabled:
+        return
+    _local.timer = NULL_TIMER
+    total = timer.total()
+    stats.record(total, timer.durations, timer.counters)
+    if log.isEnabledFor(logging.INFO):
+        values = list(fields.items())
+        values.append(('total_ms', '%.1f' % (total * 1000)))
+        values.extend(('%s_ms' % stage, '%.1f' % (duration * 1000))
+                      for stage, duration in timer.durations.items())
+        values.extend(timer.counters.items())
+        log.info('feed %s', ' '.join('%s=%s' % value for value in values))
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    '''Count the SQL statements of the timed requests, a before_cursor_execute listener.'''
+    current().count('sql')
+
+
+def percentile(ordered, p):
+    '''Return the p-th percentile of an ordered list, by the nearest rank.'''
+    index = int(math.ceil(p / 100.0 * len(ordered))) - 1
+    return ordered[min(max(index, 0), len(ordered) - 1)]
+
+
+class TimingStats(object):
+    '''
+    The timings of the last ``max_samples`` requests of the process
+    '''
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.requests = 0
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def _add(self, key, value):
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.max_samples)
+        samples.append(value)
+
+    def record(self, total, durations, counters):
+        with self._lock:
+            self.requests += 1
+            self._add(('durations', 'total'), total * 1000)
+            for stage, duration in durations.items():
+                self._add(('durations', stage), duration * 1000)
+            for name, value in counters.items():
+                self._add(('counters', name), value)
+
+    def stats(self):
+        '''Return the count, mean, percentiles and maximum of every stage
+        (in milliseconds) and counter.'''
+        with self._lock:
+            samples = [(key, sorted(values)) for key, values in self._samples.items()]
+            result = {'enabled': enabled, 'requests': self.requests,
+                      'durations': {}, 'counters': {}}
+        for (kind, name), ordered in samples:
+            summary = {
+                'count': len(ordered),
+                'mean': sum(ordered) / float(len(ordered)),
+                'max': ordered[-1],
+            }
+            for p in PERCENTILES:
+                summary['p%d' % p] = percentile(ordered, p)
+            result[kind][name] = summary
+        return result
+
+    def clear(self):
+        with self._lock:
+            self.requests = 0
+            self._samples = {}
+
+
+stats = TimingStats()
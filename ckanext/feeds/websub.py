@@ -0,0 +1,545 @@
+# encoding: utf-8
+""" WebSub hub of the shared feeds of the datasets, groups and organizations """
+
+import logging
+log = logging.getLogger(__name__)
+
+import hmac
+import time
+import httplib
+import uuid
+import Queue
+import socket
+import struct
+import urllib
+import urllib2
+import urlparse
+import hashlib
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import Table, Column, UnicodeText, DateTime, Index, and_
+
+import ckan.model as model
+
+from ckanext.feeds import query
+
+
+# One row per subscription of a callback to a topic, the url of the feed of
+# an object as advertised in its rel="self" link.
+subscription_table = Table(
+    'feeds_websub_subscription', model.meta.metadata,
+    Column('topic', UnicodeText, primary_key=True),
+    Column('callback', UnicodeText, primary_key=True),
+    Column('filter_type', UnicodeText, nullable=False),
+    Column('object_id', UnicodeText, nullable=False),
+    Column('format', UnicodeText, nullable=False),
+    Column('version', UnicodeText, nullable=False),
+    Column('secret', UnicodeText),
+    Column('expires', DateTime, nullable=False),
+    Index('idx_feeds_websub_object_id', 'object_id'),
+)
+
+# Whether the hub is enabled and its url, see FeedsPlugin.configure
+enabled = False
+hub_url = None
+site_url = None
+
+# the leases of the subscriptions, in seconds
+DEFAULT_LEASE_SECONDS = 10 * 24 * 3600
+MAX_LEASE_SECONDS = 30 * 24 * 3600
+
+# the number of activities a delivery sends at most
+MAX_ENTRIES = 200
+
+# The url prefixes of the callbacks that may be on any address, e.g. on the
+# local network, and the number of verifications waiting to be run at
+# most, see FeedsPlugin.configure
+allowed_callbacks = []
+max_pending = 100
+
+# the IPv4 networks the other callbacks can't be on: "this" network,
+# private, shared, loopback, link-local, reserved and multicast addresses
+BLOCKED_NETWORKS = [
+    ('0.0.0.0', 8), ('10.0.0.0', 8), ('100.64.0.0', 10), ('127.0.0.0', 8),
+    ('169.254.0.0', 16), ('172.16.0.0', 12), ('192.0.0.0', 24), ('192.168.0.0', 16),
+    ('198.18.0.0', 15), ('224.0.0.0', 4), ('240.0.0.0', 4),
+]
+
+
+def setup():
+    '''Create the subscription table if it does not exist yet.'''
+    subscription_table.create(model.meta.engine, checkfirst=True)
+
+
+def subscribe(connection, topic, callback, filter_type, object_id, format, version,
+              secret=None, lease_seconds=DEFAULT_LEASE_SECONDS):
+    '''Add or renew the subscription of a callback to a topic, and drop the expired ones.'''
+    now = datetime.utcnow()
+    trans = connection.begin()
+    try:
+        connection.execute(subscription_table.delete().where(
+            subscription_table.c.expires <= now))
+        _delete(connection, topic, callback)
+        connection.execute(subscription_table.insert(), {
+            'topic': topic, 'callback': callback, 'filter_type': filter_type,
+            'object_id': object_id, 'format': format, 'version': version,
+            'secret': secret, 'expires': now + timedelta(seconds=lease_seconds),
+        })
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+
+
+def unsubscribe(connection, topic, callback):
+    '''Remove the subscription of a callback to a topic.
+
+    :returns: the number of subscriptions removed
+    '''
+    return _delete(connection, topic, callback)
+
+
+def _delete(connection, topic, callback):
+    return connection.execute(subscription_table.delete().where(and_(
+        subscription_table.c.topic == topic,
+        subscription_table.c.callback == callback,
+    ))).rowcount
+
+
+def subscriptions(connection, object_ids):
+    '''Return the current subscriptions to the feeds of the given objects.
+
+    :rtype: list of rows of the subscription table
+    '''
+    if not object_ids:
+        return []
+    table = subscription_table
+    return connection.execute(table.select().where(and_(
+        table.c.object_id.in_(object_ids),
+        table.c.expires > datetime.utcnow(),
+    ))).fetchall()
+
+
+def _ipv4(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+_BLOCKED_NETWORKS = [(_ipv4(network), (0xffffffff << (32 - bits)) & 0xffffffff)
+                     for network, bits in BLOCKED_NETWORKS]
+
+
+def public_address(address):
+    '''Return True if an IPv4 or IPv6 address is on the public internet.'''
+    if ':' not in address:
+        number = _ipv4(address)
+        return not any(number & mask == network for network, mask in _BLOCKED_NETWORKS)
+    packed = socket.inet_pton(socket.AF_INET6, address)
+    if packed[:12] == '\0' * 10 + '\xff' * 2:
+        # an IPv4-mapped address
+        return public_address(socket.inet_ntoa(packed[12:]))
+    first, second = ord(packed[0]), ord(packed[1])
+    return not (
+        packed[:15] == '\0' * 15 or                  # unspecified and loopback
+        first & 0xfe == 0xfc or                      # unique local, fc00::/7
+        first == 0xfe and second & 0xc0 == 0x80 or   # link-local, fe80::/10
+        first == 0xff                                # multicast, ff00::/8
+    )
+
+
+def callback_address(callback):
+    '''Return the address the hub sends the requests of a callback to, or
+    None if it may not send them
+
+    The callbacks of allowed_callbacks may be on any address, the others
+    only if their host only resolves to public addresses: the hub must not
+    be a way to reach the services of the local network.
+    '''
+    parsed = urlparse.urlparse(callback)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return None
+    try:
+        addresses = [address[4][0] for address in socket.getaddrinfo(
+            parsed.hostname, parsed.port or None, 0, socket.SOCK_STREAM)]
+    except (socket.error, UnicodeError):
+        return None
+    if not addresses:
+        return None
+    if any(callback.startswith(prefix) for prefix in allowed_callbacks):
+        return addresses[0]
+    if not all(public_address(address.split('%')[0]) for address in addresses):
+        return None
+    return addresses[0]
+
+
+def allowed_callback(callback):
+    '''Return True if the hub may send requests to a callback, see callback_address.'''
+    return callback_address(callback) is not None
+
+
+class _NoRedirection(urllib2.HTTPRedirectHandler):
+    '''Don't follow the redirections of the callbacks, they could lead
+    anywhere: a redirection is an HTTPError.'''
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class _PinnedHTTPConnection(httplib.HTTPConnection):
+    '''Connects to the address the callback was checked for rather than to
+    a new resolution of its host, that could be another one.'''
+
+    def __init__(self, address, host, **kwargs):
+        httplib.HTTPConnection.__init__(self, host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(httplib.HTTPSConnection):
+
+    def __init__(self, address, host, **kwargs):
+        httplib.HTTPSConnection.__init__(self, host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        # the certificate is checked for the host of the callback
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+class _PinnedHTTPHandler(urllib2.HTTPHandler):
+
+    def __init__(self, address):
+        urllib2.HTTPHandler.__init__(self)
+        self.address = address
+
+    def http_open(self, req):
+        return self.do_open(
+            lambda host, **kwargs: _PinnedHTTPConnection(self.address, host, **kwargs), req)
+
+
+class _PinnedHTTPSHandler(urllib2.HTTPSHandler):
+
+    def __init__(self, address):
+        urllib2.HTTPSHandler.__init__(self)
+        self.address = address
+
+    def https_open(self, req):
+        return self.do_open(
+            lambda host, **kwargs: _PinnedHTTPSConnection(self.address, host, **kwargs), req)
+
+
+def _open(url_or_request, timeout):
+    url = url_or_request.get_full_url() if isinstance(url_or_request, urllib2.Request) \
+        else url_or_request
+    # the host may resolve to another address since the subscription
+    address = callback_address(url)
+    if address is None:
+        raise urllib2.URLError('callback not allowed: %s' % url)
+    opener = urllib2.build_opener(_NoRedirection, _PinnedHTTPHandler(address),
+                                  _PinnedHTTPSHandler(address))
+    return opener.open(url_or_request, timeout=timeout)
+
+
+# the number of verifications queued or running
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+def reserve_verification():
+    '''Count a new pending verification.
+
+    :returns: False if there are already max_pending of them
+    '''
+    global _pending
+    with _pending_lock:
+        if _pending >= max_pending:
+            return False
+        _pending += 1
+        return True
+
+
+def release_verification():
+    '''Count a pending verification as done.'''
+    global _pending
+    with _pending_lock:
+        _pending = max(_pending - 1, 0)
+
+
+def signature(secret, body):
+    '''Return the X-Hub-Signature header of a delivery.'''
+    return 'sha256=%s' % hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+
+def link_header(topic):
+    '''Return the Link header of a topic, with its hub and self links.'''
+    return '<%s>; rel="hub", <%s>; rel="self"' % (hub_url, topic)
+
+
+# ---------------------------------------------------------------------------
+# Verification of the subscriptions and delivery of the new entries, run by
+# the threads of the dispatcher
+# ---------------------------------------------------------------------------
+
+class Verification(object):
+    '''
+    Verifies the intent of a subscriber: the hub asks the callback to echo
+    a challenge, and only subscribes it (or unsubscribes it) if it does.
+    '''
+
+    # the subscriber answered, there is no point in asking again
+    retry = False
+
+    def __init__(self, mode, topic, callback, filter_type, object_id, format, version,
+                 secret=None, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.mode = mode
+        self.topic = topic
+        self.callback = callback
+        self.filter_type = filter_type
+        self.object_id = object_id
+        self.format = format
+        self.version = version
+        self.secret = secret
+        self.lease_seconds = lease_seconds
+
+    def __call__(self, timeout):
+        try:
+            self.verify(timeout)
+        finally:
+            release_verification()
+
+    def verify(self, timeout):
+        challenge = uuid.uuid4().hex
+        params = [('hub.mode', self.mode), ('hub.topic', self.topic),
+                  ('hub.challenge', challenge)]
+        if self.mode == 'subscribe':
+            params.append(('hub.lease_seconds', str(self.lease_seconds)))
+        separator = '&' if urlparse.urlparse(self.callback).query else '?'
+        url = self.callback + separator + urllib.urlencode(
+            [(k, unicode(v).encode('utf-8')) for k, v in params])
+
+        try:
+            # the callback only has to echo the challenge, don't read more
+            response = _open(url, timeout)
+            try:
+                answer = response.read(len(challenge) + 2)
+            finally:
+                response.close()
+        except urllib2.HTTPError as e:
+            log.info('%s refused the %s to %s: %s', self.callback, self.mode, self.topic, e.code)
+            return
+        except urllib2.URLError as e:
+            log.info('%s could not confirm the %s to %s: %s', self.callback, self.mode,
+                     self.topic, e.reason)
+            return
+        if answer.strip() != challenge:
+            log.info('%s did not confirm the %s to %s', self.callback, self.mode, self.topic)
+            return
+
+        connection = model.meta.engine.connect()
+        try:
+            if self.mode == 'subscribe':
+                subscribe(connection, self.topic, self.callback, self.filter_type, self.object_id,
+                          self.format, self.version, self.secret, self.lease_seconds)
+            else:
+                unsubscribe(connection, self.topic, self.callback)
+        finally:
+            connection.close()
+        log.info('%s: %s to %s', self.mode, self.callback, self.topic)
+
+
+class Delivery(object):
+    '''
+    Sends the new entries of a topic to its subscribers: the feed of the
+    activities of the object since ``since`` is rendered once and posted
+    to every callback that did not get it yet.
+    '''
+
+    retry = True
+
+    def __init__(self, topic, filter_type, object_id, format, version, since, callbacks):
+        self.topic = topic
+        self.filter_type = filter_type
+        self.object_id = object_id
+        self.format = format
+        self.version = version
+        self.since = since
+        # callback -> secret, the callbacks that still have to get the entries
+        self.callbacks = dict(callbacks)
+        self.body = None
+
+    def render(self):
+        from ckanext.feeds.plugin import DashboardFeedController
+
+        controller = DashboardFeedController()
+        context = {'model': model, 'session': model.Session, 'user': '', 'for_view': True,
+                   'site_url': site_url}
+        page_url = controller._page_url(self.format, self.version, route=(
+            'object_feed', {'filter_type': self.filter_type, 'id': self.object_id}))
+        try:
+            return ''.join(controller.stream_feed(
+                context, self.format, self.version, [(self.filter_type, self.object_id)],
+                0, MAX_ENTRIES, since=self.since, page_url=page_url, hub_topic=self.topic,
+                channel=controller.object_channel(self.filter_type, self.object_id)))
+        finally:
+            model.Session.remove()
+
+    def __call__(self, timeout):
+        from ckanext.feeds.plugin import DashboardFeedController
+
+        if self.body is None:
+            self.body = self.render()
+        content_type = DashboardFeedController.CONTENT_TYPES[self.format]
+
+        failed = []
+        for callback, secret in sorted(self.callbacks.items()):
+            request = urllib2.Request(callback, self.body, {
+                'Content-Type': content_type,
+                'Link': link_header(self.topic),
+            })
+            if secret:
+                request.add_header('X-Hub-Signature', signature(secret, self.body))
+            try:
+                # the status is the answer, the body is not read
+                _open(request, timeout).close()
+            except urllib2.HTTPError as e:
+                if e.code == 410:
+                    # the subscriber is gone for good
+                    connection = model.meta.engine.connect()
+                    try:
+                        unsubscribe(connection, self.topic, callback)
+                    finally:
+                        connection.close()
+                    continue
+                log.warning('Delivery of %s to %s failed: %s', self.topic, callback, e)
+                failed.append(callback)
+            except (urllib2.URLError, IOError) as e:
+                log.warning('Delivery of %s to %s failed: %s', self.topic, callback, e)
+                failed.append(callback)
+
+        # the next attempt only posts to the callbacks that failed
+        self.callbacks = dict((callback, self.callbacks[callback]) for callback in failed)
+        if failed:
+            raise IOError('%d deliveries of %s failed' % (len(failed), self.topic))
+
+
+def _setup_thread():
+    '''
+    Give the thread what rendering a feed outside a request needs, like
+    the paster commands do: a translator (the feeds are rendered in the
+    default messages) and the routes to build the urls.
+    '''
+    import pylons
+    import routes
+    from paste.registry import Registry
+    from ckan.lib.cli import MockTranslator
+
+    registry = Registry()
+    registry.prepare()
+    registry.register(pylons.translator, MockTranslator())
+
+    parsed = urlparse.urlparse(site_url)
+    request_config = routes.request_config()
+    request_config.mapper = pylons.config['routes.map']
+    request_config.host = parsed.netloc + parsed.path
+    request_config.protocol = parsed.scheme
+
+
+class Dispatcher(object):
+    '''
+    A bounded pool of threads running the verifications and deliveries
+
+    Tasks are queued up to ``max_queue``, further ones are dropped. A task
+    that fails is tried again up to ``retries`` times, after ``backoff``
+    seconds, then twice as long every time.
+    '''
+
+    def __init__(self, workers=2, max_queue=1000, retries=3, backoff=2.0, timeout=10):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._queue = Queue.Queue(max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, task):
+        '''Queue a task, start the threads on the first one.
+
+        :returns: False if the queue is full and the task was dropped
+        '''
+        with self._lock:
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._work, name='feeds-websub-%d' % i)
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+        try:
+            self._queue.put_nowait(task)
+        except Queue.Full:
+            log.warning('WebSub queue full, dropping %s', type(task).__name__)
+            return False
+        return True
+
+    def join(self):
+        '''Wait until all the queued tasks are done.'''
+        self._queue.join()
+
+    def _work(self):
+        _setup_thread()
+        while True:
+            task = self._queue.get()
+            try:
+                self._run(task)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, task):
+        for attempt in range(self.retries + 1):
+            try:
+                task(self.timeout)
+                return
+            except Exception:
+                log.warning('WebSub %s failed (attempt %d)', type(task).__name__, attempt + 1,
+                            exc_info=True)
+                if not task.retry:
+                    return
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        log.error('WebSub %s given up after %d attempts', type(task).__name__, self.retries + 1)
+
+
+# The dispatcher of the hub, see FeedsPlugin.configure
+dispatcher = Dispatcher()
+
+
+def publish(connection, activities, object_ids):
+    '''Queue the deliveries of new activities to the subscribers of their objects
+
+    :param connection: database connection
+    :param activities: the new activities
+    :type activities: list of (id, user_id, object_id, activity_type,
+        timestamp) tuples
+    :param object_ids: the objects whose feeds show the activities, see
+        FeedsPlugin.activities_created
+
+    :returns: the number of topics with new entries
+    '''
+    rows = subscriptions(connection, object_ids)
+    if not rows:
+        return 0
+
+    # the feeds are rendered since right before the oldest new activity
+    oldest = min(activity[4] for activity in activities)
+    since = query.Cursor(oldest - timedelta(microseconds=1), None)
+
+    topics = {}
+    for row in rows:
+        topics.setdefault((row.topic, row.filter_type, row.object_id, row.format, row.version),
+                          {})[row.callback] = row.secret
+    for (topic, filter_type, object_id, format, version), callbacks in topics.items():
+        dispatcher.submit(Delivery(topic, filter_type, object_id, format, version, since, callbacks))
+    return len(topics)
@@ -0,0 +1,387 @@
+# encoding: utf-8
+""" Atom, RSS and JSON Feed writers of the feeds """
+
+from datetime import datetime
+from collections import OrderedDict
+from json.encoder import encode_basestring
+
+from webhelpers.util import iri_to_uri
+
+ATOM_NS = u'http://www.w3.org/2005/Atom'
+JSON_FEED_VERSION = u'https://jsonfeed.org/version/1.1'
+DC_NS = u'http://purl.org/dc/elements/1.1/'
+SY_NS = u'http://purl.org/rss/1.0/modules/syndication/'
+
+XML_DECLARATION = u'<?xml version="1.0" encoding="%s"?>\n'
+
+# RFC 822 dates are in english whatever the locale of the server
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# the update periods of the syndication module, and their seconds
+UPDATE_PERIODS = [(u'hourly', 3600), (u'daily', 86400), (u'weekly', 604800)]
+
+
+def escape(text):
+    '''Escape the text of an element.'''
+    return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+
+
+def quoteattr(text):
+    '''Escape and quote the value of an attribute.'''
+    return u'"%s"' % escape(text).replace(u'"', u'&quot;').replace(u'\n', u'&#10;') \
+        .replace(u'\r', u'&#13;').replace(u'\t', u'&#9;')
+
+
+def rfc3339_date(date):
+    return u'%04d-%02d-%02dT%02d:%02d:%02dZ' % (
+        date.year, date.month, date.day, date.hour, date.minute, date.second)
+
+
+def rfc2822_date(date):
+    return u'%s, %02d %s %04d %02d:%02d:%02d -0000' % (
+        WEEKDAYS[date.weekday()], date.day, MONTHS[date.month - 1], date.year,
+        date.hour, date.minute, date.second)
+
+
+def update_period(ttl):
+    '''Return the sy:updatePeriod and sy:updateFrequency of a ttl in seconds.'''
+    for period, seconds in UPDATE_PERIODS:
+        if ttl <= seconds:
+            return period, max(1, seconds // ttl)
+    return UPDATE_PERIODS[-1][0], 1
+
+
+# (writer class, feed metadata) -> the encoded start of the feed up to its date
+_static_headers = {}
+
+
+class FeedItem(object):
+    '''
+    An entry of a feed: the fields the feeds use of the keyword arguments
+    of webhelpers' ``SyndicationFeed.add_item``, and the id and paging
+    cursor of its activity. Only title and link are required.
+    '''
+
+    __slots__ = ('title', 'link', 'description', 'author_name', 'pubdate', 'unique_id',
+                 'activity_id', 'cursor')
+
+    def __init__(self, title, link, description=None, author_name=None, pubdate=None,
+                 unique_id=None, activity_id=None, cursor=None):
+        self.title = title
+        self.link = link
+        self.description = description
+        self.author_name = author_name
+        self.pubdate = pubdate
+        self.unique_id = unique_id
+        self.activity_id = activity_id
+        self.cursor = cursor
+
+
+class FeedWriter(object):
+    '''
+    Base class of the feed writers
+
+    A feed is written in one pass, without building a document: the start
+    of the feed, every item and the end are returned as encoded strings::
+
+        yield writer.start(first_item)
+        for item in items:
+            yield writer.write_item(item)
+        yield writer.end(next=next_url)
+
+    Items are FeedItem instances. The documents are the same as the ones of the webhelpers feed generators,
+    but the static start of a feed is only escaped and encoded once.
+
+    The paging links of RFC 5005 are passed as the ``previous_url``
+    keyword argument (or set in ``feed`` before ``start``) and as keyword
+    arguments of ``end``. The ``hub_url`` and ``self_url`` of WebSub are
+    written the same way, at the start of the feed. The ``ttl`` keyword
+    argument is the number of seconds readers can wait before polling the
+    feed again.
+    '''
+
+    def __init__(self, title, link, description, language=None, encoding='utf-8', **kwargs):
+        self.encoding = encoding
+        self.feed = {
+            'title': title,
+            'link': iri_to_uri(link),
+            'description': description,
+            'language': language,
+        }
+        self.feed.update(kwargs)
+
+    def start(self, first_item=None):
+        '''
+        Return the start of the feed. Its date is the date of
+        ``first_item``, the newest item of the feed.
+        '''
+        key = (type(self), self.feed['title'], self.feed['link'],
+               self.feed['description'], self.feed['language'], self.encoding)
+        header = _static_headers.get(key)
+        if header is None:
+            header = _static_headers[key] = (self.declaration() +
+                                             self.static_header()).encode(self.encoding)
+
+        pubdate = first_item and first_item.pubdate
+        if pubdate is None:
+            pubdate = datetime.now()
+        parts = [self.date_element(pubdate)]
+        if self.feed.get('ttl'):
+            parts.append(self.ttl_element(self.feed['ttl']))
+        # the WebSub links of the feeds pushed by the hub
+        for rel in (u'hub', u'self'):
+            if self.feed.get(rel + '_url'):
+                parts.append(self.paging_link(rel, self.feed[rel + '_url']))
+        if self.feed.get('previous_url'):
+            parts.append(self.paging_link(u'previous', self.feed['previous_url']))
+        return header + self.encode(u''.join(parts))
+
+    def write_item(self, item):
+        '''Return an item of the feed.'''
+        return self.encode(self.item(item))
+
+    def end(self, **links):
+        '''
+        Return the end of the feed.
+
+        :param links: paging links only known at the end of the feed,
+            e.g. next='http://...'
+        '''
+        parts = [self.paging_link(rel, href) for rel, href in sorted(links.items())]
+        parts.append(self.footer())
+        return self.encode(u''.join(parts))
+
+    def write_string(self, items):
+        '''Return the whole feed of the items, newest first.'''
+        parts = [self.start(items[0] if items else None)]
+        parts.extend(self.write_item(item) for item in items)
+        if self.feed.get('next_url'):
+            parts.append(self.end(next=self.feed['next_url']))
+        else:
+            parts.append(self.end())
+        return ''.join(parts)
+
+    def encode(self, text):
+        return text.encode(self.encoding, 'xmlcharrefreplace')
+
+    def declaration(self):
+        return XML_DECLARATION % self.encoding
+
+    def static_header(self):
+        raise NotImplementedError
+
+    def date_element(self, date):
+        raise NotImplementedError
+
+    def paging_link(self, rel, href):
+        raise NotImplementedError
+
+    def ttl_element(self, ttl):
+        '''The formats without a ttl leave it out.'''
+        return u''
+
+    def item(self, item):
+        raise NotImplementedError
+
+    def footer(self):
+        raise NotImplementedError
+
+
+class AtomWriter(FeedWriter):
+
+    def static_header(self):
+        feed = self.feed
+        if feed['language'] is not None:
+            root = u'<feed xmlns=%s xml:lang=%s>' % (quoteattr(ATOM_NS), quoteattr(feed['language']))
+        else:
+            root = u'<feed xmlns=%s>' % quoteattr(ATOM_NS)
+        return u'%s<title>%s</title><link href=%s rel="alternate"></link><id>%s</id>' % (
+            root, escape(feed['title']), quoteattr(feed['link']), escape(feed['link']))
+
+    def date_element(self, date):
+        return u'<updated>%s</updated>' % rfc3339_date(date)
+
+    def paging_link(self, rel, href):
+        return u'<link href=%s rel=%s></link>' % (quoteattr(href), quoteattr(rel))
+
+    def ttl_element(self, ttl):
+        # Atom has no ttl, the one of the RSS 1.0 syndication module
+        period, frequency = update_period(ttl)
+        return (u'<sy:updatePeriod xmlns:sy="%s">%s</sy:updatePeriod>'
+                u'<sy:updateFrequency xmlns:sy="%s">%d</sy:updateFrequency>' % (
+                    SY_NS, period, SY_NS, frequency))
+
+    def item(self, item):
+        parts = [u'<entry><title>', escape(item.title), u'</title><link href=',
+                 quoteattr(iri_to_uri(item.link)), u' rel="alternate"></link>']
+        if item.pubdate is not None:
+            # an activity is never updated: webhelpers' Atom1Feed also writes
+            # its date as the published one
+            date = rfc3339_date(item.pubdate)
+            parts.extend([u'<updated>', date, u'</updated><published>', date, u'</published>'])
+        if item.author_name is not None:
+            parts.extend([u'<author><name>', escape(item.author_name), u'</name></author>'])
+        parts.extend([u'<id>', escape(item.unique_id), u'</id>'])
+        if item.description is not None:
+            parts.extend([u'<summary type="html">', escape(item.description), u'</summary>'])
+        parts.append(u'</entry>')
+        return u''.join(parts)
+
+    def footer(self):
+        return u'</feed>'
+
+
+class RssWriter(FeedWriter):
+    '''RSS has no paging links, the feeds use the ones of Atom.'''
+
+    version = None
+
+    def static_header(self):
+        feed = self.feed
+        parts = [u'<rss xmlns:atom=%s version=%s><channel><title>%s</title><link>%s</link>'
+                 u'<description>%s</description>' % (
+                     quoteattr(ATOM_NS), quoteattr(self.version), escape(feed['title']),
+                     escape(feed['link']), escape(feed['description']))]
+        if feed['language'] is not None:
+            parts.append(u'<language>%s</language>' % escape(feed['language']))
+        return u''.join(parts)
+
+    def date_element(self, date):
+        return u'<lastBuildDate>%s</lastBuildDate>' % rfc2822_date(date)
+
+    def paging_link(self, rel, href):
+        return u'<atom:link href=%s rel=%s></atom:link>' % (quoteattr(href), quoteattr(rel))
+
+    def footer(self):
+        return u'</channel></rss>'
+
+
+class Rss091Writer(RssWriter):
+
+    version = u'0.91'
+
+    def item(self, item):
+        parts = [u'<item><title>', escape(item.title), u'</title><link>',
+                 escape(iri_to_uri(item.link)), u'</link>']
+        if item.description is not None:
+            parts.extend([u'<description>', escape(item.description), u'</description>'])
+        parts.append(u'</item>')
+        return u''.join(parts)
+
+
+class Rss201Writer(RssWriter):
+
+    version = u'2.0'
+
+    def ttl_element(self, ttl):
+        # in minutes
+        return u'<ttl>%d</ttl>' % -(-ttl // 60)
+
+    def item(self, item):
+        parts = [u'<item><title>', escape(item.title), u'</title><link>',
+                 escape(iri_to_uri(item.link)), u'</link>']
+        if item.description is not None:
+            parts.extend([u'<description>', escape(item.description), u'</description>'])
+        if item.author_name:
+            parts.extend([u'<dc:creator xmlns:dc="%s">' % DC_NS, escape(item.author_name),
+                          u'</dc:creator>'])
+        if item.pubdate is not None:
+            parts.extend([u'<pubDate>', rfc2822_date(item.pubdate), u'</pubDate>'])
+        if item.unique_id is not None:
+            parts.extend([u'<guid>', escape(item.unique_id), u'</guid>'])
+        parts.append(u'</item>')
+        return u''.join(parts)
+
+
+class JsonFeedWriter(FeedWriter):
+    '''
+    JSON Feed 1.1 (https://jsonfeed.org/version/1.1)
+
+    Written in one pass like the XML feeds: the items are members of the
+    "items" array, separated once the first one is written. JSON Feed has
+    no previous page, the previous_url and the cursors of the items, to
+    page with the before and since parameters, are in "_feeds" extension
+    objects. The WebSub hub_url and self_url are "hubs" and "feed_url".
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(JsonFeedWriter, self).__init__(*args, **kwargs)
+        self._separator = u''
+
+    def static_header(self):
+        feed = self.feed
+        parts = [u'{"version":%s,"title":%s,"home_page_url":%s,"description":%s' % (
+            encode_basestring(JSON_FEED_VERSION), encode_basestring(feed['title']),
+            encode_basestring(feed['link']), encode_basestring(feed['description']))]
+        if feed['language'] is not None:
+            parts.append(u',"language":%s' % encode_basestring(feed['language']))
+        return u''.join(parts)
+
+    def declaration(self):
+        return u''
+
+    def start(self, first_item=None):
+        return super(JsonFeedWriter, self).start(first_item) + self.encode(u',"items":[')
+
+    def date_element(self, date):
+        # the items have dates, the feed doesn't
+        return u''
+
+    def paging_link(self, rel, href):
+        href = encode_basestring(href)
+        if rel == u'hub':
+            return u',"hubs":[{"type":"WebSub","url":%s}]' % href
+        if rel == u'self':
+            return u',"feed_url":%s' % href
+        if rel == u'next':
+            return u',"next_url":%s' % href
+        return u',"_feeds":{%s:%s}' % (encode_basestring(rel + u'_url'), href)
+
+    def item(self, item):
+        parts = [self._separator, u'{"id":', encode_basestring(item.activity_id or item.link),
+                 u',"url":', encode_basestring(iri_to_uri(item.link)),
+                 u',"title":', encode_basestring(item.title)]
+        self._separator = u','
+        if item.description is not None:
+            parts.extend([u',"content_text":', encode_basestring(item.description)])
+        else:
+            parts.append(u',"content_text":""')
+        if item.pubdate is not None:
+            parts.extend([u',"date_published":"', rfc3339_date(item.pubdate), u'"'])
+        if item.author_name:
+            parts.extend([u',"authors":[{"name":', encode_basestring(item.author_name), u'}]'])
+        if item.cursor is not None:
+            parts.extend([u',"_feeds":{"cursor":', encode_basestring(item.cursor), u'}'])
+        parts.append(u'}')
+        return u''.join(parts)
+
+    def end(self, **links):
+        parts = [u']']
+        parts.extend(self.paging_link(rel, href) for rel, href in sorted(links.items()))
+        parts.append(self.footer())
+        return self.encode(u''.join(parts))
+
+    def footer(self):
+        return u'}'
+
+
+# The writers of the feed formats, by version, the one of None for the
+# other versions, and the content types of the formats
+WRITERS = OrderedDict([
+    ('atom', {None: AtomWriter}),
+    ('rss', {None: Rss201Writer, '0.91': Rss091Writer}),
+    ('json', {None: JsonFeedWriter}),
+])
+
+CONTENT_TYPES = {
+    'atom': 'application/atom+xml',
+    'rss': 'application/rss+xml',
+    'json': 'application/feed+json',
+}
+
+
+def writer_class(format, version=None):
+    '''Return the writer of a version of a feed format, see WRITERS.'''
+    versions = WRITERS[format]
+    return versions.get(version, versions[None])
@@ -80,6 +80,8 @@ setup(
     entry_points='''
         [ckan.plugins]
         feeds=ckanext.feeds.plugin:FeedsPlugin
+        [paste.paster_command]
+        feeds=ckanext.feeds.commands:FeedsCommand
 	[babel.extractors]
 	ckan = ckan.lib.extract:extract_ckan
     ''',